@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Compare the memory used by User and PublicKey instances with their previous __dict__ based layout.
+
+Run with creds installed (e.g. pip install -e .):
+
+    $ python benchmarks/bench_memory.py [number of users]
+"""
+from __future__ import (unicode_literals, print_function)
+
+import sys
+import tracemalloc
+
+from creds.ssh import PublicKey
+from creds.users import User
+
+RAW_PUBLIC_KEY = ('ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC1TOE/w1BKqh2vaGfwqJLADaHDkMPDf25W/wj0/53NB9/EWJ08EqFuny869J'
+                  'pu4LA7UhXoz4aECBDvk9VzTimcDtJdLtmPmr+F5lOzVOiKUfdwVvjp1fOnme9ObDMJ/kJv/2gtzrVSNSCmt9NdFQRLMsjz4EHL'
+                  'AesriOVjdZcUeBKAQH8FzWZbu2EgW5z2PdJJa6UQQj4GE6R8y4/3zoh4lZ94c/6Fi4DeehgKRGO5tIY2FwhrNIGb0BKq3FwjH'
+                  'HSHM8rdo707uXQZWizeRorCYPhvHxkOh9G6WJIXbQUzs6Qy2EppDgv7qkzcNmTIIICnsuCI+w4uO1yynZvqsuov '
+                  '{0}@example.com')
+
+
+class DictPublicKey(object):
+    """The previous PublicKey layout, with attributes held in a per-instance __dict__."""
+
+    def __init__(self, raw=None, b64encoded=None):
+        self._raw = raw
+        self._b64encoded = b64encoded
+
+
+class DictUser(object):
+    """The previous User layout, with attributes held in a per-instance __dict__."""
+
+    def __init__(self, name=None, passwd=None, uid=None, gid=None, gecos=None,
+                 home_dir=None, shell=None, public_keys=None, sudoers_entry=None):
+        self.name = name
+        self.passwd = passwd
+        self.uid = uid
+        self.gid = gid
+        self._gecos = gecos
+        self.home_dir = home_dir
+        self.shell = shell
+        self.public_keys = public_keys
+        self.sudoers_entry = sudoers_entry
+
+
+def measure(user_class=None, key_class=None, count=None):
+    """Return the bytes allocated to create count users, each with one key."""
+    # Build the strings up front so only the objects themselves are measured
+    fields = [('user{0}'.format(index), '"user {0}"'.format(index), RAW_PUBLIC_KEY.format(index))
+              for index in range(count)]
+    tracemalloc.start()
+    users = [user_class(name=name, passwd='x', uid=2000 + index, gid=2000 + index, gecos=gecos,
+                        home_dir='/home/user', shell='/bin/sh', public_keys=[key_class(raw=raw_key)])
+             for index, (name, gecos, raw_key) in enumerate(fields)]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+    return allocated
+
+
+def main(count=None):
+    before = measure(user_class=DictUser, key_class=DictPublicKey, count=count)
+    after = measure(user_class=User, key_class=PublicKey, count=count)
+    print('users: {0}'.format(count))
+    print('__dict__ layout: {0:>12} bytes ({1:.0f} per user)'.format(before, float(before) / count))
+    print('__slots__ layout: {0:>11} bytes ({1:.0f} per user)'.format(after, float(after) / count))
+    print('saving: {0:.0%}'.format(1 - float(after) / before))
+
+
+if __name__ == '__main__':
+    main(count=int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
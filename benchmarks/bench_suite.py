@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Time discovery, manifest loading, planning and execution against synthetic users.
+
+A synthetic root (passwd, sudoers and authorized_keys) and matching manifest are generated in a temporary
+directory for each size. Commands that would change the system are stubbed, so execute_plan measures the
+overhead of creds itself. Run with creds and PyYAML installed (e.g. pip install -e .):
+
+    $ python benchmarks/bench_suite.py --sizes 100,1000,10000
+    $ python benchmarks/bench_suite.py --sizes 1000 --output baseline.json
+    $ python benchmarks/bench_suite.py --sizes 1000 --compare baseline.json
+"""
+from __future__ import (unicode_literals, print_function)
+
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic  # noqa: E402
+from creds import plan as creds_plan  # noqa: E402
+from creds.plan import (create_plan, execute_plan)  # noqa: E402
+from creds.users import (Users, compare_user)  # noqa: E402
+
+REGRESSION_THRESHOLD = 0.2  # Report a regression if ops/sec drops by more than this fraction
+
+
+@contextmanager
+def stubbed_commands():
+    """Replace everything execute_plan runs on the system with no-ops."""
+
+    def execute_command(command=None):
+        return (b'', b''), 0
+
+    stubs = dict(execute_command=execute_command, write_authorized_keys=lambda user, root_path=None: None,
+                 write_sudoers_entry=lambda username=None, sudoers_entry=None, root_path=None: None,
+                 remove_sudoers_entry=lambda username=None, root_path=None: None)
+    originals = dict((name, getattr(creds_plan, name)) for name in stubs)
+    for name, stub in stubs.items():
+        setattr(creds_plan, name, stub)
+    try:
+        yield
+    finally:
+        for name, original in originals.items():
+            setattr(creds_plan, name, original)
+
+
+class Context(object):
+    """The synthetic data for one size, and the results of earlier benchmarks that later ones depend on."""
+
+    def __init__(self, directory=None, count=None):
+        self.count = count
+        self.root_path = os.path.join(directory, 'root')
+        synthetic.build_root(root_path=self.root_path, count=count)
+        self.manifest = synthetic.build_manifest(count=count)
+        self.yaml_path, self.json_path = synthetic.write_manifests(directory=directory, manifest=self.manifest)
+        self.existing_users = self.discover()
+        self.proposed_users = Users.from_dict(self.manifest)
+        self.plan = self.create_plan()
+
+    def discover(self):
+        return Users.from_passwd(uid_min=synthetic.FIRST_UID, uid_max=synthetic.FIRST_UID + self.count,
+                                 root_path=self.root_path)
+
+    def create_plan(self):
+        return create_plan(existing_users=self.existing_users, proposed_users=self.proposed_users,
+                           purge_undefined=True, protected_users=['root'])
+
+
+def bench_from_passwd(context=None):
+    context.discover()
+    return context.count
+
+
+def bench_from_yaml(context=None):
+    return len(Users.from_yaml(file_path=context.yaml_path))
+
+
+def bench_from_yaml_compiled(context=None):
+    return len(Users.from_yaml(file_path=context.yaml_path, compiled_cache=True))
+
+
+def bench_from_json(context=None):
+    return len(Users.from_json(file_path=context.json_path))
+
+
+def bench_create_plan(context=None):
+    context.create_plan()
+    return len(context.proposed_users)
+
+
+def bench_compare_user(context=None):
+    compared = 0
+    for proposed_user in context.proposed_users:
+        if context.existing_users.describe_users(users_filter=dict(name=proposed_user.name)):
+            compare_user(passed_user=proposed_user, user_list=context.existing_users)
+            compared += 1
+    return compared
+
+
+def bench_execute_plan(context=None):
+    with stubbed_commands():
+        execute_plan(plan=context.plan)
+    return len(context.plan)
+
+
+BENCHMARKS = OrderedDict([
+    ('from_passwd', bench_from_passwd),
+    ('from_yaml', bench_from_yaml),
+    ('from_yaml_compiled', bench_from_yaml_compiled),
+    ('from_json', bench_from_json),
+    ('create_plan', bench_create_plan),
+    ('compare_user', bench_compare_user),
+    ('execute_plan', bench_execute_plan),
+])
+
+
+def measure(benchmark=None, context=None, repeat=None):
+    """Return the best ops/sec over repeat runs, and the peak memory of a separate traced run."""
+    best = None
+    operations = 0
+    for _ in range(repeat):
+        start = time.time()
+        operations = benchmark(context)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    benchmark(context)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(operations=operations, seconds=best, ops_per_sec=operations / best if best else 0.0,
+                peak_memory=peak_memory)
+
+
+def run(sizes=None, names=None, repeat=None):
+    results = list()
+    for count in sizes:
+        directory = tempfile.mkdtemp(prefix='creds_bench_')
+        try:
+            context = Context(directory=directory, count=count)
+            for name in names:
+                result = measure(benchmark=BENCHMARKS[name], context=context, repeat=repeat)
+                result.update(name=name, size=count)
+                results.append(result)
+                print('{name:<20}{size:>8} users {ops_per_sec:>14,.0f} ops/sec {seconds:>10.4f} s '
+                      '{peak_memory:>14,} bytes peak'.format(**result))
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+def compare(results=None, baseline_path=None):
+    """Print the change in ops/sec against a baseline, returning True if any benchmark regressed."""
+    with io.open(baseline_path, encoding='utf-8') as baseline_file:
+        baseline = dict(((result['name'], result['size']), result) for result in json.load(baseline_file))
+    regressed = False
+    for result in results:
+        previous = baseline.get((result['name'], result['size']))
+        if not previous or not previous['ops_per_sec']:
+            continue
+        change = result['ops_per_sec'] / previous['ops_per_sec'] - 1
+        marker = ''
+        if change < -REGRESSION_THRESHOLD:
+            marker = ' REGRESSION'
+            regressed = True
+        print('{0:<20}{1:>8} users {2:>+8.1%}{3}'.format(result['name'], result['size'], change, marker))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma separated numbers of users (default: %(default)s)')
+    parser.add_argument('--benchmarks', default=','.join(BENCHMARKS),
+                        help='comma separated benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark (default: %(default)s)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with those in this JSON file')
+    args = parser.parse_args(argv)
+    results = run(sizes=[int(size) for size in args.sizes.split(',')], names=args.benchmarks.split(','),
+                  repeat=args.repeat)
+    if args.output:
+        with io.open(args.output, mode='w', encoding='utf-8') as output_file:
+            output_file.write(json.dumps(results, indent=2))
+    if args.compare and compare(results=results, baseline_path=args.compare):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Generate synthetic filesystem roots and manifests for benchmarking."""
+from __future__ import (unicode_literals, print_function)
+
+import base64
+import io
+import json
+import os
+import random
+
+FIRST_UID = 10000  # Synthetic users are numbered from this uid
+KEY_PREFIX = 'AAAAC3NzaC1lZDI1NTE5AAAAI'  # Start of the base64 blob of an ed25519 public key
+
+
+def username(index=None):
+    return 'user{0:06d}'.format(index)
+
+
+def public_key(seed=None):
+    """Return a syntactically valid ed25519 public key that's stable for the seed."""
+    key_bytes = bytearray(random.Random(seed).getrandbits(8) for _ in range(32))
+    blob = '{0}{1}'.format(KEY_PREFIX, base64.b64encode(bytes(key_bytes)).decode('ascii'))
+    return 'ssh-ed25519 {0} {1}@example.com'.format(blob, seed)
+
+
+def build_root(root_path=None, count=None, sudoers_every=10):
+    """Create passwd, sudoers and authorized_keys files for count users under root_path.
+
+    args:
+        root_path (str): directory to use as the filesystem root
+        count (int): number of users
+        sudoers_every (int): give every nth user a sudoers entry
+    """
+    etc = os.path.join(root_path, 'etc')
+    os.makedirs(etc)
+    with io.open(os.path.join(etc, 'passwd'), mode='w', encoding='utf-8') as passwd_file:
+        passwd_file.write('root:x:0:0:root:/root:/bin/bash\n')
+        for index in range(count):
+            name = username(index)
+            passwd_file.write('{0}:x:{1}:{1}:{0} gecos:/home/{0}:/bin/sh\n'.format(name, FIRST_UID + index))
+    with io.open(os.path.join(etc, 'sudoers'), mode='w', encoding='utf-8') as sudoers_file:
+        sudoers_file.write('Defaults env_reset\nroot ALL=(ALL:ALL) ALL\n')
+        for index in range(0, count, sudoers_every):
+            sudoers_file.write('{0} ALL=(ALL) NOPASSWD: ALL\n'.format(username(index)))
+    for index in range(count):
+        ssh_dir = os.path.join(root_path, 'home', username(index), '.ssh')
+        os.makedirs(ssh_dir)
+        with io.open(os.path.join(ssh_dir, 'authorized_keys'), mode='w', encoding='utf-8') as keys_file:
+            keys_file.write('{0}\n'.format(public_key(seed=index)))
+
+
+def build_manifest(count=None, changed_every=20, added=None, sudoers_every=10):
+    """Return a manifest matching the users created by build_root, with some changes.
+
+    args:
+        count (int): number of users in the existing root
+        changed_every (int): change the shell and key of every nth user
+        added (int): number of new users (defaults to 5% of count)
+        sudoers_every (int): give every nth user a sudoers entry
+
+    returns:
+        dict: manifest in the form accepted by Users.from_dict
+    """
+    if added is None:
+        added = max(1, count // 20)
+    users = list()
+    for index in range(count + added):
+        name = username(index)
+        changed = index % changed_every == 0
+        key = public_key(seed=index if not changed else 'changed{0}'.format(index))
+        user = dict(name=name, uid=FIRST_UID + index, gid=FIRST_UID + index, gecos='{0} gecos'.format(name),
+                    home_dir='/home/{0}'.format(name), shell='/bin/bash' if changed else '/bin/sh',
+                    public_keys=[base64.b64encode(key.encode('ascii')).decode('ascii')])
+        if index % sudoers_every == 0:
+            user['sudoers_entry'] = 'ALL=(ALL) NOPASSWD: ALL'
+        users.append(user)
+    return dict(users=users)
+
+
+def write_manifests(directory=None, manifest=None):
+    """Write the manifest as YAML and JSON files, returning their paths."""
+    import yaml
+    yaml_path = os.path.join(directory, 'manifest.yml')
+    json_path = os.path.join(directory, 'manifest.json')
+    with io.open(yaml_path, mode='w', encoding='utf-8') as yaml_file:
+        yaml.safe_dump(manifest, yaml_file, default_flow_style=False)
+    with io.open(json_path, mode='w', encoding='utf-8') as json_file:
+        json_file.write(json.dumps(manifest))
+    return yaml_path, json_path
@@ -2,12 +2,24 @@
 """
 This package contains all of the modules utilised by the creds library.
 
+cache: A persistent cache of discovered users.
+
 constants: Functions to define and discover OS constants.
 
+database: Functions to read and write the local account databases directly.
+
+fanout: Functions to apply one manifest to many targets.
+
+helper: A long-lived privileged helper process.
+
 plan: Functions to generate a list of steps to transition from the current state to the desired state.
 
+script: Functions to compile a plan to a single shell script.
+
 ssh: Contains a class to represent a users' keys and functions to manage them.
 
+sudoers: Classes and functions to read and update the sudoers file.
+
 users: Functions  to managing users and classes...
  Users - representation of a user list and methods to read, write and manage them
  User - representation of a single user with their associated credentials
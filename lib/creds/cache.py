@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""Persistent caches of discovered users and of parsed manifests, so unchanged files aren't parsed again."""
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import json
+import marshal
+import os
+import stat
+import sys
+import tempfile
+
+from creds.constants import PASSWD_PATH
+from creds.database import PasswdEntry, read_passwd
+from creds.ssh import PublicKey, read_authorized_keys_bulk
+from creds.sudoers import Sudoers, load_sudoers
+from creds.utils import file_signature, rooted_path
+from external.six import iteritems
+
+CACHE_VERSION = 2
+COMPILED_MANIFEST_SUFFIX = '.creds-cache'
+
+
+def _signature(path=None):
+    """Return a file signature in the form stored in the cache (JSON has no tuples)."""
+    signature = file_signature(path)
+    if signature is not None:
+        return list(signature)
+
+
+def _write_atomically(path=None, data=None):
+    """Replace a file with the bytes provided, readable only by its owner."""
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.creds_cache_')
+    try:
+        with io.open(file_descriptor, mode='wb') as cache_file:
+            cache_file.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def _read_trusted(path=None, owners=None):
+    """Return the contents of a cache file, or None if it's missing or could have been written by someone else.
+
+    The file must be a regular file, not a symlink, owned by one of the owners and not writable by its group or
+    others.
+    """
+    try:
+        file_descriptor = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+    except OSError:
+        return None
+    with io.open(file_descriptor, mode='rb') as cache_file:
+        file_stat = os.fstat(cache_file.fileno())
+        if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_uid not in owners or \
+                file_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return None
+        return cache_file.read()
+
+
+class DiscoveryCache(object):
+    """On-disk record of discovered users and the state (mtime, inode and size) of the files they were read from.
+
+    The passwd and sudoers files are only parsed again if they have changed, and only the authorized_keys files
+    that have changed (or can't be checked) are read again.
+    """
+
+    def __init__(self, path=None, root_path=None):
+        """Open a discovery cache, starting afresh if it doesn't exist or can't be used.
+
+        args:
+            path (str): location of the cache file
+            root_path (str): alternate filesystem root the cached users are discovered from
+        """
+        self.path = path
+        self.root_path = root_path
+        self.hits = 0
+        self.misses = 0
+        self.data = self._load()
+
+    def __repr__(self):
+        return '<DiscoveryCache {0}>'.format(self.path)
+
+    def _load(self):
+        """Read the cache file, discarding it if it's from another version or root.
+
+        The cached users are trusted as the state of the system, so the file is also discarded unless it is a
+        regular file, not a symlink, owned by this user and not writable by its group or others.
+        """
+        empty = dict(version=CACHE_VERSION, root_path=self.root_path, passwd=None, sudoers=None,
+                     authorized_keys=dict(), digests=dict())
+        try:
+            cached = _read_trusted(path=self.path, owners=(os.geteuid(),))
+            if cached is None:
+                return empty
+            data = json.loads(cached.decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return empty
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION or \
+                data.get('root_path') != self.root_path:
+            return empty
+        return data
+
+    def save(self):
+        """Atomically write the cache file, readable only by its owner."""
+        _write_atomically(path=self.path, data=json.dumps(self.data, ensure_ascii=False).encode('utf-8'))
+
+    def digests(self):
+        """Return the digest of each user found by the last discovery, e.g. to tell which users have changed since.
+
+        returns:
+            dict: user name to digest
+        """
+        return dict(self.data.get('digests') or dict())
+
+    def set_digests(self, digests=None):
+        """Record the digest of each discovered user, replacing those from the previous discovery.
+
+        args:
+            digests (dict): user name to digest
+        """
+        self.data['digests'] = dict(digests)
+
+    def passwd_entries(self, uid_min=None, uid_max=None):
+        """Return the passwd entries in the uid range, parsing the passwd file only if it has changed.
+
+        args:
+            uid_min (int): lowest uid to include
+            uid_max (int): highest uid to include
+
+        returns:
+            list: PasswdEntry instances
+        """
+        signature = _signature(rooted_path(PASSWD_PATH, root_path=self.root_path))
+        cached = self.data.get('passwd')
+        if signature is not None and cached and cached['signature'] == signature and \
+                cached['uid_min'] == uid_min and cached['uid_max'] == uid_max:
+            # The range is checked again, so a cache that's been tampered with can't return e.g. root
+            entries = [PasswdEntry(*entry) for entry in cached['entries']]
+            return [entry for entry in entries if (uid_min is None or entry.pw_uid >= uid_min) and
+                    (uid_max is None or entry.pw_uid <= uid_max)]
+        entries = list(read_passwd(root_path=self.root_path, uid_min=uid_min, uid_max=uid_max))
+        self.data['passwd'] = dict(signature=signature, uid_min=uid_min, uid_max=uid_max,
+                                   entries=[list(entry) for entry in entries])
+        return entries
+
+    def sudoers(self):
+        """Return the sudoers model, parsing the sudoers files only if any of them have changed.
+
+        returns:
+            Sudoers: the parsed model
+        """
+        cached = self.data.get('sudoers')
+        if cached:
+            sudoers = Sudoers(entries=cached['entries'],
+                              sources=[tuple(source) if source is not None else None for source in cached['sources']],
+                              included_entries=cached['included_entries'])
+            if sudoers.is_current():
+                return sudoers
+        sudoers = load_sudoers(root_path=self.root_path)
+        self.data['sudoers'] = dict(entries=sudoers.entries, included_entries=sudoers.included_entries,
+                                    sources=[list(source) if source is not None else None
+                                             for source in sudoers.sources])
+        return sudoers
+
+    def authorized_keys(self, home_dirs=None):
+        """Return the keys of each user, reading only the authorized_keys files that have changed.
+
+        args:
+            home_dirs (dict): user name to home directory (as seen from this process).
+
+        returns:
+            dict: user name to a list of their authorised keys.
+        """
+        cached_keys = self.data['authorized_keys']
+        authorized_keys = dict()
+        changed_home_dirs = dict()
+        signatures = dict()
+        for username, home_dir in iteritems(home_dirs):
+            signature = _signature('{0}/.ssh/authorized_keys'.format(home_dir))
+            cached = cached_keys.get(username)
+            if signature is not None and cached and cached['home_dir'] == home_dir and \
+                    cached['signature'] == signature:
+                # Keys are stored as read from the file, i.e. one per line
+                authorized_keys[username] = [PublicKey(raw='{0}\n'.format(raw)) for raw in cached['keys']]
+                self.hits += 1
+            else:
+                changed_home_dirs[username] = home_dir
+                signatures[username] = signature
+                self.misses += 1
+        if changed_home_dirs:
+            for username, keys in iteritems(read_authorized_keys_bulk(home_dirs=changed_home_dirs)):
+                authorized_keys[username] = keys
+                cached_keys[username] = dict(home_dir=changed_home_dirs[username], signature=signatures[username],
+                                             keys=[key.raw for key in keys])
+        # Forget users that no longer exist
+        for username in set(cached_keys).difference(home_dirs):
+            del cached_keys[username]
+        return authorized_keys
+
+
+def compiled_manifest_path(file_path=None):
+    """Return the location of the compiled form of a manifest, a hidden file alongside it."""
+    directory, name = os.path.split(os.path.abspath(file_path))
+    return os.path.join(directory, '.{0}{1}'.format(name, COMPILED_MANIFEST_SUFFIX))
+
+
+def load_compiled_manifest(file_path=None, parse=None):
+    """Return the users defined in a manifest, from its compiled form if the manifest hasn't changed.
+
+    The compiled form is the marshalled list of user dicts, keyed on a hash of the manifest and the marshal and
+    Python versions. If it is missing or stale the manifest is parsed and a new compiled form written, unless
+    the directory isn't writable or the users contain values marshal can't store. Anyone able to replace the
+    compiled form could inject users, so it is ignored unless it is a regular file owned by this user (or the
+    manifest's owner) that only its owner can write.
+
+    args:
+        file_path (str): path to the manifest
+        parse (callable): returns the list of user dicts from the manifest's text
+
+    returns:
+        list: a dict for each user
+    """
+    with io.open(file_path, mode='rb') as manifest_file:
+        source = manifest_file.read()
+        manifest_owner = os.fstat(manifest_file.fileno()).st_uid
+    key = hashlib.sha256(source)
+    key.update('{0}:{1}:{2}'.format(CACHE_VERSION, marshal.version, sys.version_info[:2]).encode('ascii'))
+    key = key.hexdigest()
+    cache_path = compiled_manifest_path(file_path=file_path)
+    try:
+        cached = _read_trusted(path=cache_path, owners=(os.geteuid(), manifest_owner))
+        if cached is not None:
+            cached_key, raw_users = marshal.loads(cached)
+            if cached_key == key:
+                return raw_users
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    raw_users = parse(source.decode('utf-8'))
+    try:
+        _write_atomically(path=cache_path, data=marshal.dumps((key, raw_users)))
+    except (IOError, OSError, ValueError):
+        pass
+    return raw_users
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from typing import Callable, Dict, List, Optional, Tuple
+
+from creds.database import PasswdEntry
+from creds.ssh import PublicKey
+from creds.sudoers import Sudoers
+
+CACHE_VERSION: int
+COMPILED_MANIFEST_SUFFIX: str
+
+
+def _write_atomically(path: str, data: bytes) -> None: pass
+
+
+def _read_trusted(path: str, owners: Tuple[int, ...]) -> Optional[bytes]: pass
+
+
+class DiscoveryCache(object):
+    def __init__(self, path: str, root_path: Optional[str]) -> None:
+        self.path = path
+        self.root_path = root_path
+        self.hits = 0
+        self.misses = 0
+        self.data = dict()
+
+    def save(self) -> None: pass
+
+    def digests(self) -> Dict[str, str]: pass
+
+    def set_digests(self, digests: Dict[str, str]) -> None: pass
+
+    def passwd_entries(self, uid_min: int, uid_max: int) -> List[PasswdEntry]: pass
+
+    def sudoers(self) -> Sudoers: pass
+
+    def authorized_keys(self, home_dirs: Dict[str, str]) -> Dict[str, List[PublicKey]]: pass
+
+
+def compiled_manifest_path(file_path: str) -> str: pass
+
+
+def load_compiled_manifest(file_path: str, parse: Callable[[str], List[Dict]]) -> List[Dict]: pass
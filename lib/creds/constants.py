@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
-"""Functions to define and discover OS constants."""
+"""Functions to define and discover OS constants.
+
+Constants that depend on the host (the paths of commands and the uid range from /etc/login.defs) are discovered
+the first time they are accessed, e.g. as constants.CMD_SUDO, rather than on import.
+"""
 from __future__ import (unicode_literals, print_function)
 
 import io
 import os
-from distutils import spawn
+import sys
+import threading
 
 from external.six import (text_type, PY2, PY3)
 
@@ -12,29 +17,63 @@ SUPPORTED_PLATFORMS = ['Linux', 'FreeBSD', 'OpenBSD']
 
 RANDOM_FILE_EXT_LENGTH = 20  # Number of random characters to add to transient file names
 
+BULK_READ_CHUNK_SIZE = 500  # Maximum number of files to read with a single privileged command
+
 PURGE_UNDEFINED = False  # Purge any users that fall between UID_MIN and UID_MAX that are not defined
 
 DEFAULT_UID_MIN = 1000  # The lowest uid to consider safe to manage
 DEFAULT_UID_MAX = 60000  # The maximum uid to consider safe to manage
 
-CMD_SUDO = spawn.find_executable("sudo")
+PASSWD_PATH = '/etc/passwd'
+SHADOW_PATH = '/etc/shadow'
+GROUP_PATH = '/etc/group'
+GSHADOW_PATH = '/etc/gshadow'
+PASSWD_LOCK_PATH = '/etc/.pwd.lock'  # Locked with fcntl by lckpwdf, and so by the shadow utilities
+SKEL_PATH = '/etc/skel'
+SUDOERS_PATH = '/etc/sudoers'
+
+# Names of the commands whose paths are discovered on first use
+EXECUTABLES = dict(
+    CMD_SUDO='sudo',
+    CMD_GREP='grep',
+    # LINUX/OPENBSD COMMANDS
+    LINUX_CMD_USERADD='useradd',
+    LINUX_CMD_USERMOD='usermod',
+    LINUX_CMD_USERDEL='userdel',
+    LINUX_CMD_GROUP_ADD='groupadd',
+    LINUX_CMD_GROUP_DEL='groupdel',
+    LINUX_CMD_VISUDO='visudo',
+    LINUX_CMD_NEWUSERS='newusers',
+    LINUX_CMD_CHPASSWD='chpasswd',
+    LINUX_CMD_NSCD='nscd',
+    LINUX_CMD_SSS_CACHE='sss_cache',
+    # FREEBSD COMMANDS
+    FREEBSD_CMD_PW='pw',
+)
+
+_DISCOVERY_LOCK = threading.Lock()
+
+
+def find_executable(name=None):
+    """Return the path of an executable found on PATH, or None if there isn't one (as distutils did)."""
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return None
 
-# LINUX/OPENBSD COMMANDS
-LINUX_CMD_USERADD = spawn.find_executable("useradd")
-LINUX_CMD_USERMOD = spawn.find_executable("usermod")
-LINUX_CMD_USERDEL = spawn.find_executable("userdel")
-LINUX_CMD_GROUP_ADD = spawn.find_executable("groupadd")
-LINUX_CMD_GROUP_DEL = spawn.find_executable("groupdel")
-LINUX_CMD_VISUDO = spawn.find_executable("visudo")
-# FREEBSD COMMANDS
-FREEBSD_CMD_PW = spawn.find_executable("pw")
 
+def login_defs(root_path=None):
+    """Discover the minimum and maximum UID number.
 
-def login_defs():
-    """Discover the minimum and maximum UID number."""
+    args:
+        root_path (str): read login.defs from an alternate filesystem root, e.g. a chroot or container image
+    """
     uid_min = None
     uid_max = None
     login_defs_path = '/etc/login.defs'
+    if root_path:
+        login_defs_path = os.path.join(root_path, login_defs_path.lstrip(os.sep))
     if os.path.exists(login_defs_path):
         with io.open(text_type(login_defs_path), encoding=text_type('utf-8')) as log_defs_file:
             login_data = log_defs_file.readlines()
@@ -54,6 +93,31 @@ def login_defs():
     return uid_min, uid_max
 
 
-UID_MIN, UID_MAX = login_defs()
+def _discover(name=None):
+    """Return the discovered value of a constant, and any others discovered at the same time, as a dict."""
+    if name in EXECUTABLES:
+        return {name: find_executable(EXECUTABLES[name])}
+    if name in ('UID_MIN', 'UID_MAX'):
+        uid_min, uid_max = login_defs()
+        return dict(UID_MIN=uid_min, UID_MAX=uid_max)
+    return None
+
+
+def __getattr__(name):
+    """Discover a constant the first time it is accessed, then store it as a module attribute (PEP 562)."""
+    with _DISCOVERY_LOCK:
+        if name not in globals():
+            discovered = _discover(name)
+            if discovered is None:
+                raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+            globals().update(discovered)
+    return globals()[name]
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    # Module level __getattr__ isn't supported, so discover everything now
+    for _name in list(EXECUTABLES) + ['UID_MIN']:
+        __getattr__(_name)
+
 ALLOW_NON_UNIQUE_ID = False  # Allow multiple users to share uids
 PROTECTED_USERS = list()  # Users that must not be affected
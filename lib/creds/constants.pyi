@@ -1,21 +1,44 @@
 # -*- coding: utf-8 -*-
-from typing import Tuple, List
+from typing import Any, Dict, List, Optional, Tuple
 
 UID_MIN: int
 UID_MAX: int
 SUPPORTED_PLATFORMS: List[str]
 RANDOM_FILE_EXT_LENGTH: int
+BULK_READ_CHUNK_SIZE: int
 PURGE_UNDEFINED: bool
 DEFAULT_UID_MIN: int
 DEFAULT_UID_MAX: int
+PASSWD_PATH: str
+SHADOW_PATH: str
+GROUP_PATH: str
+GSHADOW_PATH: str
+PASSWD_LOCK_PATH: str
+SKEL_PATH: str
+SUDOERS_PATH: str
 CMD_SUDO: str
+CMD_GREP: str
 LINUX_CMD_USERADD: str
 LINUX_CMD_USERMOD: str
 LINUX_CMD_USERDEL: str
 LINUX_CMD_GROUP_ADD: str
 LINUX_CMD_GROUP_DEL: str
 LINUX_CMD_VISUDO: str
+LINUX_CMD_NEWUSERS: str
+LINUX_CMD_CHPASSWD: str
+LINUX_CMD_NSCD: str
+LINUX_CMD_SSS_CACHE: str
 FREEBSD_CMD_PW: str
+EXECUTABLES: Dict[str, str]
 
 
-def login_defs() -> Tuple: pass
+def find_executable(name: str) -> Optional[str]: pass
+
+
+def login_defs(root_path: Optional[str]) -> Tuple: pass
+
+
+def _discover(name: str) -> Optional[Dict[str, Any]]: pass
+
+
+def __getattr__(name: str) -> Any: pass
@@ -0,0 +1,548 @@
+# -*- coding: utf-8 -*-
+"""Functions to read and write the local account databases (passwd, shadow and group) directly."""
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import io
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from creds import constants
+from creds.constants import (GROUP_PATH, GSHADOW_PATH, PASSWD_LOCK_PATH, PASSWD_PATH, SHADOW_PATH, SKEL_PATH,
+                             login_defs)
+from creds.utils import execute_command, file_signature, rooted_path
+from external.six import text_type
+
+SELINUX_XATTR = 'security.selinux'
+
+_PASSWD_INDEX_CACHE = dict()
+_PASSWD_INDEX_CACHE_LOCK = threading.Lock()
+
+# Mirrors the attribute names of pwd.struct_passwd so entries can be used in place of pwd results
+PasswdEntry = namedtuple('PasswdEntry', ['pw_name', 'pw_passwd', 'pw_uid', 'pw_gid', 'pw_gecos', 'pw_dir',
+                                         'pw_shell'])
+ShadowEntry = namedtuple('ShadowEntry', ['sp_namp', 'sp_pwdp'])
+
+
+def _database_lines(path=None):
+    """Yield the lines of an account database, skipping comments and NIS compat entries."""
+    with io.open(text_type(path), encoding=text_type('utf-8'), errors=text_type('replace')) as database_file:
+        for line in database_file:
+            if not line.strip() or line[0] in ('#', '+', '-'):
+                continue
+            yield line.rstrip('\r\n')
+
+
+def read_passwd(root_path=None, uid_min=None, uid_max=None):
+    """Stream entries from the passwd file without going through NSS.
+
+    Only lines with a uid inside the requested range are fully parsed.
+
+    args:
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
+        uid_min (int): lowest uid to return
+        uid_max (int): highest uid to return
+
+    returns:
+        generator: PasswdEntry instances
+    """
+    for line in _database_lines(path=rooted_path(PASSWD_PATH, root_path=root_path)):
+        fields = line.split(':')
+        if len(fields) != 7:
+            continue
+        try:
+            uid = int(fields[2])
+        except ValueError:
+            continue
+        if (uid_min is not None and uid < uid_min) or (uid_max is not None and uid > uid_max):
+            continue
+        try:
+            gid = int(fields[3])
+        except ValueError:
+            continue
+        yield PasswdEntry(pw_name=fields[0], pw_passwd=fields[1], pw_uid=uid, pw_gid=gid, pw_gecos=fields[4],
+                          pw_dir=fields[5], pw_shell=fields[6])
+
+
+def get_passwd_entry(username=None, root_path=None):
+    """Return the passwd entry of a user, or None if they don't exist.
+
+    The passwd file is indexed by name when it is first read, and the index reused until the file changes, so
+    looking up each user of a plan doesn't read the whole file for every user.
+
+    args:
+        username (str): user name
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
+
+    returns:
+        PasswdEntry: the user's entry
+    """
+    passwd_path = rooted_path(PASSWD_PATH, root_path=root_path)
+    signature = file_signature(passwd_path)
+    with _PASSWD_INDEX_CACHE_LOCK:
+        cached = _PASSWD_INDEX_CACHE.get(passwd_path)
+        if cached is None or signature is None or cached[0] != signature:
+            index = dict()
+            for passwd_entry in read_passwd(root_path=root_path):
+                index.setdefault(passwd_entry.pw_name, passwd_entry)
+            cached = signature, index
+            if signature is not None:
+                _PASSWD_INDEX_CACHE[passwd_path] = cached
+    return cached[1].get(username)
+
+
+def read_shadow(root_path=None, usernames=None):
+    """Stream the name and password hash of entries in the shadow file.
+
+    The ageing fields are left unparsed. Reading the shadow file requires root.
+
+    args:
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
+        usernames (set): only return entries for these users (all entries if not provided)
+
+    returns:
+        generator: ShadowEntry instances
+    """
+    for line in _database_lines(path=rooted_path(SHADOW_PATH, root_path=root_path)):
+        fields = line.split(':', 2)
+        if len(fields) < 2:
+            continue
+        if usernames is not None and fields[0] not in usernames:
+            continue
+        yield ShadowEntry(sp_namp=fields[0], sp_pwdp=fields[1])
+
+
+LOCK_TIMEOUT = 15  # Seconds to wait for the account database lock, as lckpwdf does
+
+
+def _security_context(path=None):
+    """Return a file's SELinux context, or None if it hasn't got one or it can't be read."""
+    if not hasattr(os, 'getxattr'):
+        return None
+    try:
+        return os.getxattr(path, SELINUX_XATTR)
+    except OSError:
+        # No context (ENODATA), or no SELinux support (ENOTSUP)
+        return None
+
+
+def invalidate_name_service_caches():
+    """Tell nscd and sssd that users and groups have changed, as the shadow utilities do, if they are installed.
+
+    Lookups through NSS (e.g. of a home directory with expanduser) would otherwise return the cached entries.
+    """
+    for command in ([constants.LINUX_CMD_NSCD, '-i', 'passwd'], [constants.LINUX_CMD_NSCD, '-i', 'group'],
+                    [constants.LINUX_CMD_SSS_CACHE, '-E']):
+        if command[0]:
+            # Fails if the daemon isn't running, in which case there's nothing to invalidate
+            execute_command(command=command)
+
+
+class _Table(object):
+    """The lines of an account database file, with its entries indexed by name.
+
+    Comments, blank lines and NIS compat entries are kept as they are, so the file is written back unchanged
+    apart from the entries that have been modified.
+    """
+
+    def __init__(self, path=None):
+        """Read a table, which is empty if the file doesn't exist.
+
+        args:
+            path (str): location of the file (as seen from this process)
+        """
+        self.path = path
+        self.lines = list()
+        self.index = dict()
+        self.changed = False
+        self.exists = os.path.exists(path)
+        if self.exists:
+            with io.open(text_type(path), encoding=text_type('utf-8'), errors=text_type('replace')) as table_file:
+                for line in table_file:
+                    line = line.rstrip('\r\n')
+                    if line.strip() and line[0] not in ('#', '+', '-'):
+                        fields = line.split(':')
+                        self.index[fields[0]] = len(self.lines)
+                        self.lines.append(fields)
+                    else:
+                        self.lines.append(line)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name=None):
+        """Return a copy of an entry's fields, or None if it doesn't exist."""
+        position = self.index.get(name)
+        return list(self.lines[position]) if position is not None else None
+
+    def set(self, name=None, fields=None):
+        """Replace an entry, or append it if it doesn't exist."""
+        fields = ['' if field is None else text_type(field) for field in fields]
+        position = self.index.get(name)
+        if position is None:
+            self.index[name] = len(self.lines)
+            self.lines.append(fields)
+        else:
+            self.lines[position] = fields
+        self.changed = True
+
+    def remove(self, name=None):
+        """Remove an entry, if it exists."""
+        position = self.index.pop(name, None)
+        if position is not None:
+            self.lines[position] = None
+            self.changed = True
+
+    def entries(self):
+        """Return the fields of every entry."""
+        return [line for line in self.lines if isinstance(line, list)]
+
+    def render(self):
+        """Return the contents of the file."""
+        return ''.join('{0}\n'.format(':'.join(line) if isinstance(line, list) else line)
+                       for line in self.lines if line is not None)
+
+    def save(self):
+        """Replace the file if it has changed, keeping the previous version as a backup (e.g. /etc/passwd-).
+
+        Each file is written alongside the original, synced, given the original's mode, owner and SELinux context
+        and renamed over it, so it is replaced atomically. The context can't be read on Python 2 (there is no
+        os.getxattr), so the new file takes the default context of the directory there, e.g. etc_t rather than
+        shadow_t; don't write the databases directly with Python 2 on SELinux hosts.
+        """
+        if not self.changed:
+            return
+        if self.exists:
+            shutil.copy2(self.path, '{0}-'.format(self.path))
+            file_stat = os.stat(self.path)
+            security_context = _security_context(path=self.path)
+        file_descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.creds_')
+        try:
+            with io.open(file_descriptor, mode='w', encoding='utf-8') as table_file:
+                table_file.write(self.render())
+                table_file.flush()
+                os.fsync(table_file.fileno())
+                if self.exists:
+                    os.fchmod(table_file.fileno(), stat.S_IMODE(file_stat.st_mode))
+                    if os.geteuid() == 0:
+                        os.fchown(table_file.fileno(), file_stat.st_uid, file_stat.st_gid)
+                    if security_context is not None:
+                        os.setxattr(table_file.fileno(), SELINUX_XATTR, security_context)
+                else:
+                    os.fchmod(table_file.fileno(), 0o644)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self.changed = False
+
+
+def _next_free_id(used=None, first=None, last=None):
+    """Return the lowest id in the range that isn't used."""
+    for candidate in range(first, last + 1):
+        if candidate not in used:
+            return candidate
+    raise ValueError('No free ids between {0} and {1}'.format(first, last))
+
+
+def _passwd_entry(fields=None):
+    """Return the PasswdEntry for the fields of a passwd line."""
+    return PasswdEntry(pw_name=fields[0], pw_passwd=fields[1], pw_uid=int(fields[2]), pw_gid=int(fields[3]),
+                       pw_gecos=fields[4], pw_dir=fields[5], pw_shell=fields[6])
+
+
+def _members(fields=None, position=None):
+    """Return the names in a comma separated list of users, e.g. the members of a group."""
+    return [member for member in fields[position].split(',') if member] if len(fields) > position else list()
+
+
+class AccountDatabase(object):
+    """In-memory copies of the passwd, shadow, group and gshadow files, changed by many operations then written once.
+
+    This is an alternative to running useradd, usermod and userdel for each user, each of which rewrites the
+    files. Use open_account_database to hold the lock while the files are read, changed and written.
+
+    The ids in use, the users of each primary group, group memberships and home directories are indexed when the
+    files are read, so each operation costs the same however many users there are.
+    """
+
+    def __init__(self, root_path=None):
+        """Read the account databases.
+
+        args:
+            root_path (str): alternate filesystem root, e.g. a chroot or container image
+        """
+        self.root_path = root_path
+        self.passwd = _Table(path=rooted_path(PASSWD_PATH, root_path=root_path))
+        self.shadow = _Table(path=rooted_path(SHADOW_PATH, root_path=root_path))
+        self.group = _Table(path=rooted_path(GROUP_PATH, root_path=root_path))
+        self.gshadow = _Table(path=rooted_path(GSHADOW_PATH, root_path=root_path))
+        self.uid_min, self.uid_max = login_defs(root_path=root_path)
+        self._used_uids = set()
+        self._primary_gids = dict()  # gid to the number of users with it as their primary group
+        self._home_dirs = dict()  # home directory to the number of users with it
+        for fields in self.passwd.entries():
+            if len(fields) == 7 and fields[2].isdigit() and fields[3].isdigit():
+                self._index_user(passwd_entry=_passwd_entry(fields=fields), count=1)
+        self._used_gids = set(int(fields[2]) for fields in self.group.entries()
+                              if len(fields) > 2 and fields[2].isdigit())
+        self._memberships = dict()  # user name to the groups listing them in group or gshadow
+        for table, positions in ((self.group, (3,)), (self.gshadow, (2, 3))):
+            for fields in table.entries():
+                for position in positions:
+                    for member in _members(fields=fields, position=position):
+                        self._memberships.setdefault(member, set()).add(fields[0])
+        # Lowest ids that might be free, so allocation doesn't scan the ids already handed out
+        self._free_uid = self.uid_min
+        self._free_gid = self.uid_min
+
+    def __repr__(self):
+        return '<AccountDatabase {0}>'.format(self.root_path or '/')
+
+    def _index_user(self, passwd_entry=None, count=None):
+        """Add (count 1) or remove (count -1) a user from the indexes."""
+        if count > 0:
+            self._used_uids.add(passwd_entry.pw_uid)
+        else:
+            self._used_uids.discard(passwd_entry.pw_uid)
+            self._free_uid = min(self._free_uid, max(passwd_entry.pw_uid, self.uid_min))
+        for index, key in ((self._primary_gids, passwd_entry.pw_gid),
+                           (self._home_dirs, os.path.normpath(passwd_entry.pw_dir))):
+            index[key] = index.get(key, 0) + count
+
+    def _add_group(self, name=None, gid=None):
+        """Add a group with no members, and its gshadow entry if the system has one."""
+        self.group.set(name=name, fields=[name, 'x', gid, ''])
+        if self.gshadow.exists:
+            self.gshadow.set(name=name, fields=[name, '!', '', ''])
+        self._used_gids.add(gid)
+
+    def _remove_group(self, name=None, gid=None):
+        """Remove a group and its gshadow entry."""
+        self.group.remove(name=name)
+        self.gshadow.remove(name=name)
+        self._used_gids.discard(gid)
+        self._free_gid = min(self._free_gid, max(gid, self.uid_min))
+
+    def get_user(self, name=None):
+        """Return a user's entry, or None if they don't exist."""
+        fields = self.passwd.get(name=name)
+        return _passwd_entry(fields=fields) if fields is not None else None
+
+    def add_user(self, name=None, uid=None, gid=None, gecos=None, home_dir=None, shell=None):
+        """Add a user, with a group of the same name unless a gid is given, and a locked password.
+
+        args:
+            name (str): user name
+            uid (int): uid (the lowest free uid in the login.defs range if not given)
+            gid (int): primary gid (the group named after the user, created if it doesn't exist, if not given)
+            gecos (str): comment field, unquoted
+            home_dir (str): home directory (defaults to /home/name)
+            shell (str): login shell
+
+        returns:
+            PasswdEntry: the new entry
+
+        raises:
+            ValueError: if the user already exists or no uid is free
+        """
+        if name in self.passwd:
+            raise ValueError('User {0} already exists'.format(name))
+        if uid is None:
+            uid = _next_free_id(used=self._used_uids, first=self._free_uid, last=self.uid_max)
+            self._free_uid = uid + 1
+        if gid is None:
+            group = self.group.get(name=name)
+            if group is not None and len(group) > 2 and group[2].isdigit():
+                gid = int(group[2])
+            else:
+                if uid in self._used_gids:
+                    gid = _next_free_id(used=self._used_gids, first=self._free_gid, last=self.uid_max)
+                    self._free_gid = gid + 1
+                else:
+                    gid = uid
+                self._add_group(name=name, gid=gid)
+        passwd_entry = PasswdEntry(pw_name=name, pw_passwd='x', pw_uid=uid, pw_gid=gid, pw_gecos=gecos or '',
+                                   pw_dir=home_dir or '/home/{0}'.format(name), pw_shell=shell or '')
+        self.passwd.set(name=name, fields=list(passwd_entry))
+        if self.shadow.exists:
+            self.shadow.set(name=name, fields=[name, '!', int(time.time() // 86400), '', '', '', '', '', ''])
+        self._index_user(passwd_entry=passwd_entry, count=1)
+        return passwd_entry
+
+    def modify_user(self, name=None, uid=None, gid=None, gecos=None, home_dir=None, shell=None):
+        """Change the fields of a user that are given. The home directory isn't moved; see reown_home.
+
+        returns:
+            PasswdEntry: the user's entry before the change
+
+        raises:
+            ValueError: if the user doesn't exist
+        """
+        previous = self.get_user(name=name)
+        if previous is None:
+            raise ValueError('User {0} does not exist'.format(name))
+        fields = list(previous)
+        for position, value in ((2, uid), (3, gid), (4, gecos), (5, home_dir), (6, shell)):
+            if value is not None:
+                fields[position] = value
+        self.passwd.set(name=name, fields=fields)
+        self._index_user(passwd_entry=previous, count=-1)
+        self._index_user(passwd_entry=_passwd_entry(fields=[text_type(field) for field in fields]), count=1)
+        return previous
+
+    def delete_user(self, name=None):
+        """Remove a user, their group if no other user has it as their primary group, and their group memberships.
+
+        returns:
+            PasswdEntry: the removed entry, or None if the user didn't exist
+        """
+        passwd_entry = self.get_user(name=name)
+        if passwd_entry is None:
+            return None
+        self.passwd.remove(name=name)
+        self.shadow.remove(name=name)
+        self._index_user(passwd_entry=passwd_entry, count=-1)
+        group = self.group.get(name=name)
+        if group is not None and len(group) > 2 and group[2] == text_type(passwd_entry.pw_gid) and \
+                not self._primary_gids.get(passwd_entry.pw_gid):
+            self._remove_group(name=name, gid=passwd_entry.pw_gid)
+        for group_name in self._memberships.pop(name, set()):
+            for table, positions in ((self.group, (3,)), (self.gshadow, (2, 3))):
+                fields = table.get(name=group_name)
+                if fields is None:
+                    continue
+                for position in positions:
+                    if len(fields) > position:
+                        fields[position] = ','.join(member for member in _members(fields=fields, position=position)
+                                                    if member != name)
+                table.set(name=group_name, fields=fields)
+        return passwd_entry
+
+    def save(self):
+        """Write each file that has changed, once, then invalidate the name service caches of the running system."""
+        tables = (self.group, self.gshadow, self.shadow, self.passwd)
+        changed = any(table.changed for table in tables)
+        for table in tables:
+            table.save()
+        if changed and not self.root_path:
+            invalidate_name_service_caches()
+
+    def create_home(self, passwd_entry=None):
+        """Create a user's home directory from the skeleton directory, unless it already exists.
+
+        The directory is only given to the user when running as root.
+
+        args:
+            passwd_entry (PasswdEntry): the user's entry
+        """
+        home_dir = rooted_path(passwd_entry.pw_dir, root_path=self.root_path)
+        if os.path.lexists(home_dir):
+            return
+        skel_dir = rooted_path(SKEL_PATH, root_path=self.root_path)
+        if os.path.isdir(skel_dir):
+            shutil.copytree(skel_dir, home_dir, symlinks=True)
+        else:
+            os.makedirs(home_dir)
+        os.chmod(home_dir, 0o700)
+        if os.geteuid() == 0:
+            for directory, directories, files in os.walk(home_dir):
+                os.lchown(directory, passwd_entry.pw_uid, passwd_entry.pw_gid)
+                for name in directories + files:
+                    os.lchown(os.path.join(directory, name), passwd_entry.pw_uid, passwd_entry.pw_gid)
+
+    def reown_home(self, previous=None, passwd_entry=None):
+        """Give the files in a user's home directory owned by their previous uid or primary gid the new ones.
+
+        As usermod -u and -g do, only files owned by the previous ids change, and symlinks aren't followed.
+        Nothing is changed unless running as root.
+
+        args:
+            previous (PasswdEntry): the user's entry before it was changed
+            passwd_entry (PasswdEntry): the user's current entry
+        """
+        if os.geteuid() != 0 or (previous.pw_uid, previous.pw_gid) == (passwd_entry.pw_uid, passwd_entry.pw_gid):
+            return
+        home_dir = rooted_path(passwd_entry.pw_dir, root_path=self.root_path)
+        if not os.path.isdir(home_dir) or os.path.islink(home_dir):
+            return
+        for directory, directories, files in os.walk(home_dir):
+            for path in [directory] + [os.path.join(directory, name) for name in directories + files]:
+                path_stat = os.lstat(path)
+                os.lchown(path, passwd_entry.pw_uid if path_stat.st_uid == previous.pw_uid else -1,
+                          passwd_entry.pw_gid if path_stat.st_gid == previous.pw_gid else -1)
+
+    def remove_home(self, passwd_entry=None):
+        """Remove a user's home directory, as userdel -r does, if it is theirs alone.
+
+        The directory is left in place if it is /, isn't a directory (e.g. is a symlink), is owned by someone else
+        or is the home directory of another user.
+
+        args:
+            passwd_entry (PasswdEntry): the entry of the deleted user
+
+        returns:
+            bool: whether the directory was removed
+        """
+        home_dir = os.path.normpath(passwd_entry.pw_dir)
+        if home_dir == os.sep or self._home_dirs.get(home_dir):
+            return False
+        home_dir = rooted_path(home_dir, root_path=self.root_path)
+        try:
+            home_stat = os.lstat(home_dir)
+        except OSError:
+            return False
+        if not stat.S_ISDIR(home_stat.st_mode) or home_stat.st_uid != passwd_entry.pw_uid:
+            return False
+        shutil.rmtree(home_dir)
+        return True
+
+
+@contextmanager
+def lock_account_database(root_path=None, timeout=LOCK_TIMEOUT):
+    """Hold the lock taken by lckpwdf (and so by the shadow utilities) on the account databases.
+
+    args:
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
+        timeout (int): seconds to wait for the lock
+
+    raises:
+        OSError: if the lock couldn't be taken in time
+    """
+    lock_descriptor = os.open(rooted_path(PASSWD_LOCK_PATH, root_path=root_path), os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.lockf(lock_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError) as error:
+                if error.errno not in (errno.EACCES, errno.EAGAIN) or time.time() > deadline:
+                    raise OSError(errno.EBUSY, 'Unable to lock the account databases', PASSWD_LOCK_PATH)
+                time.sleep(0.1)
+        yield
+    finally:
+        os.close(lock_descriptor)
+
+
+@contextmanager
+def open_account_database(root_path=None):
+    """Lock and read the account databases, writing any changes back when the context exits without an error.
+
+    args:
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
+
+    returns:
+        AccountDatabase: the databases
+    """
+    with lock_account_database(root_path=root_path):
+        database = AccountDatabase(root_path=root_path)
+        yield database
+        database.save()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from typing import ContextManager, Iterator, List, NamedTuple, Optional, Set
+
+PasswdEntry = NamedTuple('PasswdEntry', [('pw_name', str), ('pw_passwd', str), ('pw_uid', int), ('pw_gid', int),
+                                         ('pw_gecos', str), ('pw_dir', str), ('pw_shell', str)])
+ShadowEntry = NamedTuple('ShadowEntry', [('sp_namp', str), ('sp_pwdp', str)])
+
+
+def read_passwd(root_path: Optional[str], uid_min: Optional[int], uid_max: Optional[int]) -> Iterator[PasswdEntry]: pass
+
+
+def get_passwd_entry(username: str, root_path: Optional[str]) -> Optional[PasswdEntry]: pass
+
+
+def read_shadow(root_path: Optional[str], usernames: Optional[Set[str]]) -> Iterator[ShadowEntry]: pass
+
+
+LOCK_TIMEOUT = ...  # type: int
+SELINUX_XATTR = ...  # type: str
+
+
+def _security_context(path: str) -> Optional[bytes]: pass
+
+
+def invalidate_name_service_caches() -> None: pass
+
+
+class _Table(object):
+    path = ...  # type: str
+    lines = ...  # type: list
+    index = ...  # type: dict
+    changed = ...  # type: bool
+    exists = ...  # type: bool
+
+    def __init__(self, path: str) -> None: pass
+
+    def __contains__(self, name: str) -> bool: pass
+
+    def get(self, name: str) -> Optional[List[str]]: pass
+
+    def set(self, name: str, fields: list) -> None: pass
+
+    def remove(self, name: str) -> None: pass
+
+    def entries(self) -> List[List[str]]: pass
+
+    def render(self) -> str: pass
+
+    def save(self) -> None: pass
+
+
+def _next_free_id(used: Set[int], first: int, last: int) -> int: pass
+
+
+def _passwd_entry(fields: List[str]) -> PasswdEntry: pass
+
+
+def _members(fields: List[str], position: int) -> List[str]: pass
+
+
+class AccountDatabase(object):
+    root_path = ...  # type: Optional[str]
+    passwd = ...  # type: _Table
+    shadow = ...  # type: _Table
+    group = ...  # type: _Table
+    gshadow = ...  # type: _Table
+    uid_min = ...  # type: int
+    uid_max = ...  # type: int
+
+    def __init__(self, root_path: Optional[str]) -> None: pass
+
+    def _index_user(self, passwd_entry: PasswdEntry, count: int) -> None: pass
+
+    def _add_group(self, name: str, gid: int) -> None: pass
+
+    def _remove_group(self, name: str, gid: int) -> None: pass
+
+    def get_user(self, name: str) -> Optional[PasswdEntry]: pass
+
+    def add_user(self, name: str, uid: Optional[int], gid: Optional[int], gecos: Optional[str],
+                 home_dir: Optional[str], shell: Optional[str]) -> PasswdEntry: pass
+
+    def modify_user(self, name: str, uid: Optional[int], gid: Optional[int], gecos: Optional[str],
+                    home_dir: Optional[str], shell: Optional[str]) -> PasswdEntry: pass
+
+    def delete_user(self, name: str) -> Optional[PasswdEntry]: pass
+
+    def save(self) -> None: pass
+
+    def create_home(self, passwd_entry: PasswdEntry) -> None: pass
+
+    def reown_home(self, previous: PasswdEntry, passwd_entry: PasswdEntry) -> None: pass
+
+    def remove_home(self, passwd_entry: PasswdEntry) -> bool: pass
+
+
+def lock_account_database(root_path: Optional[str], timeout: int) -> ContextManager[None]: pass
+
+
+def open_account_database(root_path: Optional[str]) -> ContextManager[AccountDatabase]: pass
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Apply one manifest to many targets, parsing it once and planning and executing on each target concurrently.
+
+The manifest is shipped to each target as a compressed JSON payload, over a transport: LocalTransport applies it
+to filesystem roots (e.g. chroots) on this machine and SSHTransport runs creds on remote hosts over ssh.
+
+    $ python -m creds.fanout users.yml host1 host2 host3 --workers 10 --purge-undefined
+"""
+from __future__ import (unicode_literals, print_function)
+
+import argparse
+import json
+import subprocess
+import sys
+import zlib
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from creds.plan import (create_plan, execute_plan)
+from creds.users import Users
+from external.six import iteritems
+
+PAYLOAD_VERSION = 1
+PLAN_OPTIONS = ('purge_undefined', 'protected_users', 'allow_non_unique_id', 'manage_home', 'manage_keys')
+
+
+def serialise(users=None, **options):
+    """Return the compact form of a manifest that is shipped to each target.
+
+    args:
+        users (Users): the proposed users
+        options: arguments for create_plan, e.g. purge_undefined or protected_users
+
+    returns:
+        bytes: zlib compressed JSON
+    """
+    unknown_options = set(options).difference(PLAN_OPTIONS)
+    if unknown_options:
+        raise ValueError('Unknown plan options: {0}'.format(', '.join(sorted(unknown_options))))
+    raw_users = list()
+    for user in users:
+        raw_user = user.to_dict()
+        raw_user['sudoers_entry'] = user.sudoers_entry
+        raw_users.append(raw_user)
+    payload = dict(version=PAYLOAD_VERSION, users=raw_users, options=options)
+    return zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+
+
+def deserialise(payload=None):
+    """Return the users and plan options from a payload created by serialise.
+
+    returns:
+        tuple: (Users, dict of options for create_plan)
+    """
+    try:
+        payload = json.loads(zlib.decompress(payload).decode('utf-8'))
+    except (zlib.error, ValueError):
+        raise ValueError('Payload could not be decoded')
+    if payload.get('version') != PAYLOAD_VERSION:
+        raise ValueError('Unsupported payload version: {0}'.format(payload.get('version')))
+    return Users.construct_user_list(raw_users=payload['users']), payload['options']
+
+
+def summarise_plan(plan=None, execution_result=None):
+    """Return the actions of a plan (and the return codes of any commands run) in a form that can be serialised."""
+    summary = list()
+    for task in plan:
+        summary.append(dict(action=task['action'],
+                            username=task['username'] if task['action'] == 'delete' else task['proposed_user'].name))
+    for task_summary, task_result in zip(summary, execution_result or list()):
+        if task_result.get('command_output'):
+            task_summary['returncode'] = task_result['command_output'][1]
+    return summary
+
+
+def apply_payload(payload=None, root_path=None, dry_run=False):
+    """Plan, and unless it's a dry run execute, the changes needed to make a target match a payload.
+
+    args:
+        payload (bytes): created by serialise
+        root_path (str): alternate filesystem root of the target
+        dry_run (bool): only create the plan
+
+    returns:
+        dict: summary of the plan and whether it was executed
+    """
+    proposed_users, options = deserialise(payload=payload)
+    existing_users = Users.from_passwd(root_path=root_path)
+    plan = create_plan(existing_users=existing_users, proposed_users=proposed_users,
+                       **dict((str(name), value) for name, value in iteritems(options)))
+    execution_result = None
+    if not dry_run:
+        execution_result = execute_plan(plan=plan, root_path=root_path)['results']
+    return dict(plan=summarise_plan(plan=plan, execution_result=execution_result), executed=not dry_run)
+
+
+class Transport(object):
+    """Delivers a payload to a target and applies it there. Subclasses implement apply."""
+
+    def apply(self, target=None, payload=None):
+        """Apply a payload on a target.
+
+        args:
+            target (str): the target, e.g. a host name or directory
+            payload (bytes): created by serialise
+
+        returns:
+            dict: the result returned by apply_payload on the target
+
+        raises:
+            Exception: if the payload couldn't be applied
+        """
+        raise NotImplementedError
+
+
+class LocalTransport(Transport):
+    """Applies payloads in this process, to targets that are filesystem roots (e.g. chroots or image trees)."""
+
+    def __init__(self, dry_run=True):
+        """Create a local transport.
+
+        args:
+            dry_run (bool): only plan the changes
+        """
+        self.dry_run = dry_run
+
+    def apply(self, target=None, payload=None):
+        return apply_payload(payload=payload, root_path=target, dry_run=self.dry_run)
+
+
+class SSHTransport(Transport):
+    """Applies payloads on remote hosts by running creds there over ssh. creds must be installed on each host."""
+
+    def __init__(self, ssh_command=None, python='python', dry_run=False):
+        """Create an ssh transport.
+
+        args:
+            ssh_command (list): the ssh command and any options (defaults to ssh in batch mode)
+            python (str): the python interpreter on the remote hosts
+            dry_run (bool): only plan the changes
+        """
+        self.ssh_command = ssh_command if ssh_command is not None else ['ssh', '-o', 'BatchMode=yes']
+        self.python = python
+        self.dry_run = dry_run
+
+    def apply(self, target=None, payload=None):
+        command = self.ssh_command + [target, self.python, '-m', 'creds.fanout', '--apply']
+        if self.dry_run:
+            command.append('--dry-run')
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate(payload)
+        if process.returncode != 0:
+            raise OSError('Remote command exited with {0}: {1}'.format(
+                process.returncode, stderr.decode('utf-8', 'replace').strip()))
+        return json.loads(stdout.decode('utf-8'))
+
+
+def _apply_to_target(target=None, transport=None, payload=None):
+    """Apply a payload to one target, returning the result rather than raising if it fails."""
+    try:
+        result = transport.apply(target=target, payload=payload)
+        result.update(target=target, ok=True)
+    except Exception as error:
+        result = dict(target=target, ok=False, error='{0}: {1}'.format(type(error).__name__, error))
+    return result
+
+
+def fan_out(users=None, targets=None, transport=None, workers=10, **options):
+    """Apply the users to each target, yielding each target's result as soon as it completes.
+
+    args:
+        users (Users): the proposed users, serialised once for every target
+        targets (list): targets understood by the transport
+        transport (Transport): delivers the users to each target
+        workers (int): maximum number of targets to apply to at once
+        options: arguments for create_plan, e.g. purge_undefined or protected_users
+
+    returns:
+        generator: a dict for each target with its name, whether it succeeded and either its plan or the error
+    """
+    payload = serialise(users=users, **options)
+    targets = list(targets)
+    if not targets:
+        return
+    pool = ThreadPool(processes=max(1, min(workers, len(targets))))
+    try:
+        for result in pool.imap_unordered(partial(_apply_to_target, transport=transport, payload=payload), targets):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(argv=None):
+    """Fan a manifest out to hosts over ssh, printing each host's result as a line of JSON.
+
+    With --apply, read a payload from stdin and apply it to this host instead (as run on each host).
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('manifest', nargs='?', help='YAML or JSON file of users')
+    parser.add_argument('hosts', nargs='*', help='hosts to apply the manifest to')
+    parser.add_argument('--workers', type=int, default=10, help='hosts to apply to at once (default: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true', help='only plan the changes')
+    parser.add_argument('--purge-undefined', action='store_true', help='remove users not in the manifest')
+    parser.add_argument('--protected-users', default='', help='comma separated users to leave untouched')
+    parser.add_argument('--ssh-python', default='python', help='python interpreter on the hosts')
+    parser.add_argument('--apply', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.apply:
+        input_stream = getattr(sys.stdin, 'buffer', sys.stdin)
+        print(json.dumps(apply_payload(payload=input_stream.read(), dry_run=args.dry_run)))
+        return 0
+    if not args.manifest or not args.hosts:
+        parser.error('a manifest and at least one host are required')
+    if args.manifest.endswith('.json'):
+        users = Users.from_json(file_path=args.manifest)
+    else:
+        users = Users.from_yaml(file_path=args.manifest)
+    options = dict(purge_undefined=args.purge_undefined,
+                   protected_users=[name for name in args.protected_users.split(',') if name])
+    failed = False
+    for result in fan_out(users=users, targets=args.hosts, workers=args.workers,
+                          transport=SSHTransport(python=args.ssh_python, dry_run=args.dry_run), **options):
+        failed = failed or not result['ok']
+        print(json.dumps(result))
+        sys.stdout.flush()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
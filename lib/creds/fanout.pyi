@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from creds.users import Users
+
+PAYLOAD_VERSION: int
+PLAN_OPTIONS: Tuple[str, ...]
+
+
+def serialise(users: Users, **options: Any) -> bytes: pass
+
+
+def deserialise(payload: bytes) -> Tuple[Users, Dict[str, Any]]: pass
+
+
+def summarise_plan(plan: List[Dict], execution_result: Optional[List[Dict]]) -> List[Dict]: pass
+
+
+def apply_payload(payload: bytes, root_path: Optional[str], dry_run: bool) -> Dict: pass
+
+
+class Transport(object):
+    def apply(self, target: str, payload: bytes) -> Dict: pass
+
+
+class LocalTransport(Transport):
+    def __init__(self, dry_run: bool) -> None:
+        self.dry_run = dry_run
+
+    def apply(self, target: str, payload: bytes) -> Dict: pass
+
+
+class SSHTransport(Transport):
+    def __init__(self, ssh_command: Optional[List[str]], python: str, dry_run: bool) -> None:
+        self.ssh_command = ssh_command
+        self.python = python
+        self.dry_run = dry_run
+
+    def apply(self, target: str, payload: bytes) -> Dict: pass
+
+
+def _apply_to_target(target: str, transport: Transport, payload: bytes) -> Dict: pass
+
+
+def fan_out(users: Users, targets: Iterable[str], transport: Transport, workers: int,
+            **options: Any) -> Iterator[Dict]: pass
+
+
+def main(argv: Optional[List[str]]) -> int: pass
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""A long-lived privileged helper process, so sudo is run once per run rather than once per command.
+
+The helper is started with sudo and serves requests over its stdin and stdout. Each message is a 4 byte big-endian
+length followed by that many bytes of UTF-8 encoded JSON. Binary data (command output and file contents) is base64
+encoded.
+"""
+from __future__ import unicode_literals
+
+import atexit
+import base64
+import errno
+import io
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+
+from creds import constants
+
+HEADER = struct.Struct(str('>I'))  # Length of the JSON payload that follows
+
+_HELPER = None
+_HELPER_LOCK = threading.Lock()
+
+
+def read_message(stream=None):
+    """Read a framed message from a binary stream.
+
+    returns:
+        dict: the decoded message, or None if the stream was closed.
+    """
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    length = HEADER.unpack(header)[0]
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return json.loads(payload.decode('utf-8'))
+
+
+def write_message(stream=None, message=None):
+    """Write a framed message to a binary stream."""
+    payload = json.dumps(message).encode('utf-8')
+    stream.write(HEADER.pack(len(payload)) + payload)
+    stream.flush()
+
+
+def _encode(data=None):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _decode(data=None):
+    return base64.b64decode(data.encode('ascii'))
+
+
+def _exec(command=None):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return dict(stdout=_encode(stdout), stderr=_encode(stderr), returncode=process.returncode)
+
+
+def _read_file(path=None):
+    with io.open(path, mode='rb') as read_file:
+        return _encode(read_file.read())
+
+
+def _write_file(path=None, data=None, mode=None, uid=-1, gid=-1):
+    # Written alongside the target and renamed over it, so the file is replaced atomically
+    file_descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.creds_')
+    try:
+        with io.open(file_descriptor, mode='wb') as write_file:
+            write_file.write(_decode(data))
+            write_file.flush()
+            os.fsync(write_file.fileno())
+            os.fchown(write_file.fileno(), uid, gid)
+            if mode is not None:
+                os.fchmod(write_file.fileno(), mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def _makedirs(path=None, mode=0o777):
+    if not os.path.isdir(path):
+        os.makedirs(path, mode)
+
+
+def _chmod(path=None, mode=None):
+    os.chmod(path, mode)
+
+
+def _chown(path=None, uid=-1, gid=-1):
+    os.chown(path, uid, gid)
+
+
+def _ping():
+    return os.geteuid()
+
+
+def _write_authorized_keys(authorized_keys_dir=None, data=None, uid=-1):
+    # Imported here, as creds.ssh imports this module
+    from creds.ssh import _write_keys_file
+    _write_keys_file(authorized_keys_dir=authorized_keys_dir, data=_decode(data), uid=uid)
+
+
+# exec is a keyword on Python 2, so it can't be passed to dict()
+OPERATIONS = {
+    'exec': _exec,
+    'read_file': _read_file,
+    'write_file': _write_file,
+    'write_authorized_keys': _write_authorized_keys,
+    'makedirs': _makedirs,
+    'chmod': _chmod,
+    'chown': _chown,
+    'ping': _ping,
+}
+
+
+def serve(input_stream=None, output_stream=None):
+    """Answer requests until the input stream is closed.
+
+    args:
+        input_stream (file): binary stream requests are read from
+        output_stream (file): binary stream responses are written to
+    """
+    while True:
+        request = read_message(input_stream)
+        if request is None:
+            return
+        try:
+            result = OPERATIONS[request['op']](**request.get('args', dict()))
+            response = dict(ok=True, result=result)
+        except Exception as error:
+            response = dict(ok=False, error=str(error), errno=getattr(error, 'errno', None))
+        write_message(output_stream, response)
+
+
+def main():
+    """Serve requests on stdin and stdout, sending anything else written to stdout to stderr instead."""
+    input_stream = io.open(sys.stdin.fileno(), mode='rb', closefd=False)
+    output_stream = io.open(os.dup(sys.stdout.fileno()), mode='wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve(input_stream=input_stream, output_stream=output_stream)
+
+
+class PrivilegedHelper(object):
+    """Client for a helper process. Requests may be made from many threads; they are answered one at a time."""
+
+    def __init__(self, sudo=None):
+        """Start a helper process.
+
+        args:
+            sudo (str): command used to elevate the helper (none if empty, e.g. when already root)
+
+        raises:
+            OSError: if the helper can't be started.
+        """
+        lib_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        # The helper runs as root, so nothing may be imported from the caller's working directory (which -c puts
+        # first on the path) or from the environment (-E) or user site directory (-s)
+        bootstrap = ('import sys; sys.path[:] = [path for path in sys.path if path not in ("", ".")]; '
+                     'sys.path.insert(0, {0!r}); from creds.helper import main; main()').format(str(lib_path))
+        command = [sys.executable, '-E', '-s', '-c', bootstrap]
+        if sudo:
+            command.insert(0, sudo)
+        self.lock = threading.Lock()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.euid = self.request('ping')
+
+    def __repr__(self):
+        return '<PrivilegedHelper pid {0}>'.format(self.process.pid)
+
+    def request(self, op=None, **args):
+        """Send a request to the helper and wait for its response.
+
+        args:
+            op (str): name of the operation
+            args: arguments for the operation
+
+        returns:
+            the result of the operation
+
+        raises:
+            OSError: if the operation failed or the helper has exited.
+        """
+        with self.lock:
+            try:
+                write_message(self.process.stdin, dict(op=op, args=args))
+                response = read_message(self.process.stdout)
+            except (IOError, OSError):
+                response = None
+        if response is None:
+            raise OSError(errno.EPIPE, 'Privileged helper exited')
+        if not response['ok']:
+            raise OSError(response['errno'] or errno.EIO, response['error'])
+        return response['result']
+
+    def execute(self, command=None):
+        """Run a command as the helper, returning its output in the form returned by execute_command."""
+        result = self.request('exec', command=command)
+        return (_decode(result['stdout']), _decode(result['stderr'])), result['returncode']
+
+    def read_file(self, path=None):
+        """Return the contents of a file as bytes."""
+        return _decode(self.request('read_file', path=path))
+
+    def write_file(self, path=None, data=None, mode=None, uid=-1, gid=-1):
+        """Atomically replace a file with the bytes provided, setting its mode and owner."""
+        self.request('write_file', path=path, data=_encode(data), mode=mode, uid=uid, gid=gid)
+
+    def write_authorized_keys(self, authorized_keys_dir=None, data=None, uid=-1):
+        """Atomically replace the authorized_keys file in a keys directory, without following symlinks.
+
+        The check is made by the helper itself, as this process may not be able to see into the home directory.
+        """
+        self.request('write_authorized_keys', authorized_keys_dir=authorized_keys_dir, data=_encode(data), uid=uid)
+
+    def makedirs(self, path=None, mode=0o777):
+        """Create a directory and any missing parents."""
+        self.request('makedirs', path=path, mode=mode)
+
+    def chmod(self, path=None, mode=None):
+        self.request('chmod', path=path, mode=mode)
+
+    def chown(self, path=None, uid=-1, gid=-1):
+        self.request('chown', path=path, uid=uid, gid=gid)
+
+    def close(self):
+        """Close the helper's input, so it exits, and wait for it."""
+        with self.lock:
+            if self.process.returncode is None:
+                self.process.stdin.close()
+                self.process.wait()
+                self.process.stdout.close()
+
+
+def start_helper(sudo=None):
+    """Start the helper used by execute_command, unless it is already running.
+
+    args:
+        sudo (str): command used to elevate the helper (defaults to sudo)
+
+    returns:
+        PrivilegedHelper: the running helper.
+    """
+    global _HELPER
+    with _HELPER_LOCK:
+        if _HELPER is None:
+            _HELPER = PrivilegedHelper(sudo=sudo if sudo is not None else constants.CMD_SUDO)
+        return _HELPER
+
+
+def stop_helper():
+    """Stop the helper used by execute_command, if it is running."""
+    global _HELPER
+    with _HELPER_LOCK:
+        helper, _HELPER = _HELPER, None
+    if helper is not None:
+        helper.close()
+
+
+def active_helper():
+    """Return the running helper, or None."""
+    return _HELPER
+
+
+atexit.register(stop_helper)
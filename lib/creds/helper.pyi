@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import struct
+import subprocess
+import threading
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+
+HEADER: struct.Struct
+OPERATIONS: Dict[str, Callable]
+
+
+def read_message(stream: BinaryIO) -> Optional[Dict]: pass
+
+
+def write_message(stream: BinaryIO, message: Dict) -> None: pass
+
+
+def serve(input_stream: BinaryIO, output_stream: BinaryIO) -> None: pass
+
+
+def main() -> None: pass
+
+
+class PrivilegedHelper(object):
+    def __init__(self, sudo: Optional[str]) -> None:
+        self.lock = threading.Lock()
+        self.process = subprocess.Popen([])
+        self.euid = 0
+
+    def request(self, op: str, **args: Any) -> Any: pass
+
+    def execute(self, command: List[str]) -> Tuple[Tuple[bytes, bytes], int]: pass
+
+    def read_file(self, path: str) -> bytes: pass
+
+    def write_file(self, path: str, data: bytes, mode: Optional[int], uid: int, gid: int) -> None: pass
+
+    def write_authorized_keys(self, authorized_keys_dir: str, data: bytes, uid: int) -> None: pass
+
+    def makedirs(self, path: str, mode: int) -> None: pass
+
+    def chmod(self, path: str, mode: int) -> None: pass
+
+    def chown(self, path: str, uid: int, gid: int) -> None: pass
+
+    def close(self) -> None: pass
+
+
+def start_helper(sudo: Optional[str]) -> PrivilegedHelper: pass
+
+
+def stop_helper() -> None: pass
+
+
+def active_helper() -> Optional[PrivilegedHelper]: pass
@@ -2,11 +2,25 @@
 """Functions to generate a list of steps to transition from the current state to the desired state."""
 from __future__ import (unicode_literals, print_function)
 
+import base64
+import io
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+
 from creds import constants
+from creds.database import open_account_database
 from creds.ssh import write_authorized_keys
-from creds.users import (generate_add_user_command, generate_modify_user_command,
-                         generate_delete_user_command, compare_user, get_user_by_uid)
-from creds.utils import execute_command, write_sudoers_entry, remove_sudoers_entry
+from creds.sudoers import SudoersBatch, load_sudoers
+from creds.users import (generate_add_user_command, generate_bulk_add_user_command, generate_lock_passwords_command,
+                         generate_modify_user_command, generate_delete_user_command, generate_newusers_entry,
+                         compare_user)
+from creds.utils import (check_environment, command_caller, execute_command, get_platform, record_commands,
+                         write_sudoers_entry, remove_sudoers_entry)
 from external.six import iteritems
 
 
@@ -16,7 +30,8 @@ def create_plan(existing_users=None, proposed_users=None, purge_undefined=None,
 
     args:
         existing_users (Users): List of discovered users
-        proposed_users (Users): List of proposed users
+        proposed_users (iterable): Proposed users, e.g. a Users instance or Users.iter_from_yaml. They are
+                                   consumed in a single pass and only those requiring a change are kept.
         purge_undefined (bool): Remove discovered users that have not been defined in proposed users list
         protected_users (list): List of users' names that should not be evaluated as part of the plan creation process
         allow_non_unique_id (bool): Allow more than one user to have the same uid
@@ -29,7 +44,6 @@ def create_plan(existing_users=None, proposed_users=None, purge_undefined=None,
     """
 
     plan = list()
-    proposed_usernames = list()
 
     if not purge_undefined:
         purge_undefined = constants.PURGE_UNDEFINED
@@ -38,76 +52,324 @@ def create_plan(existing_users=None, proposed_users=None, purge_undefined=None,
     if not allow_non_unique_id:
         allow_non_unique_id = constants.ALLOW_NON_UNIQUE_ID
 
-    # Create list of modifications to make based on proposed users compared to existing users
+    # Classify each proposed user by set membership, so only those that already exist are compared field by field
+    existing_names = existing_users.names()
+    existing_uids = existing_users.uids()
+    proposed_names = set()
     for proposed_user in proposed_users:
-        proposed_usernames.append(proposed_user.name)
-        user_matching_name = existing_users.describe_users(users_filter=dict(name=proposed_user.name))
-        user_matching_id = get_user_by_uid(uid=proposed_user.uid, users=existing_users)
-        # If user does not exist
-        if not allow_non_unique_id and user_matching_id and not user_matching_name:
-            plan.append(
-                dict(action='fail', error='uid_clash', proposed_user=proposed_user, state='existing', result=None))
-        elif not user_matching_name:
-            plan.append(
-                dict(action='add', proposed_user=proposed_user, state='missing', result=None, manage_home=manage_home,
-                     manage_keys=manage_keys))
-        # If they do, then compare
-        else:
+        proposed_names.add(proposed_user.name)
+        if proposed_user.name in existing_names:
+            # Most users are unchanged, which is confirmed with a single comparison of their digests
+            existing_user = existing_users.describe_users(users_filter=dict(name=proposed_user.name))[0]
+            if existing_user.digest == proposed_user.digest:
+                continue
             user_comparison = compare_user(passed_user=proposed_user, user_list=existing_users)
             if user_comparison.get('result'):
                 plan.append(
                     dict(action='update', proposed_user=proposed_user, state='existing',
                          user_comparison=user_comparison, manage_home=manage_home, manage_keys=manage_keys))
+        # A new user can't take a uid that's already in use (unless allowed)
+        elif not allow_non_unique_id and proposed_user.uid in existing_uids:
+            plan.append(
+                dict(action='fail', error='uid_clash', proposed_user=proposed_user, state='existing', result=None))
+        else:
+            plan.append(
+                dict(action='add', proposed_user=proposed_user, state='missing', result=None, manage_home=manage_home,
+                     manage_keys=manage_keys))
     # Application of the proposed user list will not result in deletion of users that need to be removed
-    # If 'PURGE_UNDEFINED' then look for existing users that are not defined in proposed usernames and mark for removal
+    # If 'PURGE_UNDEFINED' then remove existing users that are neither proposed nor protected
     if purge_undefined:
+        undefined_names = existing_names - proposed_names - set(protected_users)
         for existing_user in existing_users:
-            if existing_user.name not in proposed_usernames:
-                if existing_user.name not in protected_users:
-                    plan.append(
-                        dict(action='delete', username=existing_user.name, state='existing', manage_home=manage_home,
-                             manage_keys=manage_keys))
+            if existing_user.name in undefined_names:
+                plan.append(
+                    dict(action='delete', username=existing_user.name, state='existing', manage_home=manage_home,
+                         manage_keys=manage_keys))
     return plan
 
 
-def execute_plan(plan=None):
-    """Create, Modify or Delete, depending on plan item."""
-    execution_result = list()
-    for task in plan:
-        action = task['action']
-        if action == 'delete':
-            command = generate_delete_user_command(username=task.get('username'), manage_home=task['manage_home'])
-            command_output = execute_command(command)
-            execution_result.append(dict(task=task, command_output=command_output))
-            remove_sudoers_entry(username=task.get('username'))
-        elif action == 'add':
-            command = generate_add_user_command(proposed_user=task.get('proposed_user'), manage_home=task['manage_home'])
-            command_output = execute_command(command)
-            if task['proposed_user'].public_keys and task['manage_home'] and task['manage_keys']:
-                write_authorized_keys(task['proposed_user'])
-            if task['proposed_user'].sudoers_entry:
-                write_sudoers_entry(username=task['proposed_user'].name,
-                                    sudoers_entry=task['proposed_user'].sudoers_entry)
-            execution_result.append(dict(task=task, command_output=command_output))
-        elif action == 'update':
-            result = task['user_comparison'].get('result')
-            # Don't modify user if only keys have changed
-            action_count = 0
-            for k, _ in iteritems(result):
-                if '_action' in k:
-                    action_count += 1
-            command_output = None
-            if task['manage_home'] and task['manage_keys'] and action_count == 1 and 'public_keys_action' in result:
-                write_authorized_keys(task['proposed_user'])
-            elif action_count == 1 and 'sudoers_entry_action' in result:
-                write_sudoers_entry(username=task['proposed_user'].name,
-                                    sudoers_entry=task['user_comparison']['result']['replacement_sudoers_entry'])
+# User database commands (useradd, usermod, userdel) and sudoers rewrites touch shared files and must not overlap
+ACCOUNT_DATABASE_LOCK = threading.Lock()
+SUDOERS_LOCK = threading.Lock()
+
+
+@contextmanager
+def _timed_step(steps=None, phase=None):
+    """Time a phase of execution and record the commands it runs, appending the step to steps once it completes."""
+    start = time.time()
+    with record_commands() as commands:
+        yield
+    steps.append(dict(phase=phase, commands=commands, elapsed=time.time() - start))
+
+
+def _count_results(task_results=None, steps=None):
+    """Return the number of tasks of each action, and of the commands run and those that failed."""
+    counters = dict(tasks=len(task_results), add=0, update=0, delete=0, fail=0, commands=0, failed_commands=0)
+    for task_result in task_results:
+        counters[task_result['task']['action']] += 1
+    for step in chain(steps, chain.from_iterable(task_result['steps'] for task_result in task_results)):
+        counters['commands'] += len(step['commands'])
+        counters['failed_commands'] += sum(1 for command in step['commands'] if command['returncode'] != 0)
+    return counters
+
+
+def _send_metrics(report=None, metrics_sink=None):
+    """Send the timings and counters of an executed plan to a metrics sink."""
+    for task_result in report['results']:
+        for step in task_result['steps']:
+            metrics_sink('creds.step.seconds', step['elapsed'], dict(phase=step['phase'],
+                                                                     action=task_result['task']['action']))
+    for step in report['steps']:
+        metrics_sink('creds.step.seconds', step['elapsed'], dict(phase=step['phase'], action='batch'))
+    for name, value in iteritems(report['counters']):
+        metrics_sink('creds.plan.{0}'.format(name), value, dict())
+    metrics_sink('creds.plan.seconds', report['elapsed'], dict())
+
+
+def _bulk_add_users(tasks=None, root_path=None):
+    """Create the users of add tasks with a single run of newusers, then lock their passwords with one of chpasswd.
+
+    newusers always sets a password, so each user is given a random one which is then replaced with !, leaving
+    the account locked as useradd does.
+
+    returns:
+        tuple: the output of newusers, in the form returned by execute_command
+
+    raises:
+        OSError: if the users were created but their passwords couldn't be locked.
+    """
+    users_descriptor, users_path = tempfile.mkstemp(prefix='creds_newusers_')
+    passwords_descriptor, passwords_path = tempfile.mkstemp(prefix='creds_chpasswd_')
+    try:
+        with io.open(users_descriptor, mode='w', encoding='utf-8') as users_file:
+            for task in tasks:
+                password = base64.b64encode(os.urandom(24)).decode('ascii')
+                users_file.write('{0}\n'.format(generate_newusers_entry(proposed_user=task['proposed_user'],
+                                                                        password=password)))
+        with io.open(passwords_descriptor, mode='w', encoding='utf-8') as passwords_file:
+            passwords_file.writelines('{0}:!\n'.format(task['proposed_user'].name) for task in tasks)
+        command_output = execute_command(generate_bulk_add_user_command(input_path=users_path, root_path=root_path))
+        if command_output[1] == 0:
+            lock_output = execute_command(generate_lock_passwords_command(input_path=passwords_path,
+                                                                          root_path=root_path))
+            if lock_output[1] != 0:
+                raise OSError(lock_output[0][1])
+        return command_output
+    finally:
+        os.unlink(users_path)
+        os.unlink(passwords_path)
+
+
+def _apply_to_account_database(tasks=None, root_path=None):
+    """Apply the user database changes of add, update and delete tasks to the passwd, shadow and group files directly.
+
+    The files are read once, changed in memory and each written once, holding the lock the shadow utilities
+    take, and the nscd and sssd caches are invalidated as the shadow utilities do. Once the files have been
+    written, home directories are created (from the skeleton directory), given to users whose uid or gid changed
+    or removed (unless shared or owned by someone else, as with userdel -r).
+
+    returns:
+        tuple: the users added and the users deleted, as PasswdEntry instances
+    """
+    added = list()
+    modified = list()
+    deleted = list()
+    with open_account_database(root_path=root_path) as database:
+        for task in tasks:
+            if task['action'] == 'delete':
+                passwd_entry = database.delete_user(name=task['username'])
+                if passwd_entry and task['manage_home']:
+                    deleted.append(passwd_entry)
+                continue
+            user = task['proposed_user']
+            if task['action'] == 'add':
+                # gecos is double quoted for the user commands; the passwd file takes it verbatim
+                passwd_entry = database.add_user(name=user.name, uid=user.uid, gid=user.gid,
+                                                 gecos=user.gecos[1:-1] if user.gecos else None,
+                                                 home_dir=user.home_dir, shell=user.shell)
+                if task['manage_home']:
+                    added.append(passwd_entry)
             else:
-                command = generate_modify_user_command(task=task)
+                result = task['user_comparison']['result']
+                gecos = result.get('replacement_gecos_value')
+                previous = database.modify_user(name=user.name, uid=result.get('replacement_uid_value'),
+                                                gid=result.get('replacement_gid_value'),
+                                                gecos=gecos[1:-1] if gecos else None,
+                                                shell=result.get('replacement_shell_value'))
+                modified.append(previous)
+    for passwd_entry in added:
+        database.create_home(passwd_entry=passwd_entry)
+    for previous in modified:
+        database.reown_home(previous=previous, passwd_entry=database.get_user(name=previous.pw_name))
+    for passwd_entry in deleted:
+        database.remove_home(passwd_entry=passwd_entry)
+    return added, deleted
+
+
+def _changes_user_database(task=None):
+    """Return whether applying a task changes the user database, rather than only keys or sudoers."""
+    if task['action'] in ('add', 'delete'):
+        return True
+    if task['action'] != 'update':
+        return False
+    actions = [name for name in task['user_comparison']['result'] if name.endswith('_action')]
+    return bool(set(actions).difference(('public_keys_action', 'sudoers_entry_action')))
+
+
+def execute_plan(plan=None, workers=None, batch_sudoers=False, root_path=None, metrics_sink=None, bulk_add=False,
+                 write_database=False):
+    """Create, Modify or Delete, depending on plan item.
+
+    args:
+        plan (list): tasks generated by create_plan
+        workers (int): number of tasks to run concurrently. Changes to the user database and sudoers are
+                       always serialised; only the remaining work (e.g. writing keys) overlaps.
+        batch_sudoers (bool): apply every sudoers change in the plan with a single rewrite of the sudoers file,
+                              once all other tasks have completed
+        root_path (str): apply the plan to an alternate filesystem root, e.g. a chroot or container image
+        metrics_sink (callable): called as metrics_sink(name, value, tags) with each step's timing, the counters
+                                 and the total time once the plan has been executed
+        bulk_add (bool): create the users of every add task that manages home directories with a single run of
+                         newusers (Linux only), before the other tasks. Their keys and sudoers entries are written
+                         as usual. If newusers fails, each user is created with useradd instead.
+        write_database (bool): apply every user database change in the plan by writing the passwd, shadow and
+                               group files directly (Linux only), each once, instead of running useradd, usermod
+                               and userdel for each task. Takes precedence over bulk_add.
+
+    returns:
+        dict: the result of each task in plan order (results), steps run for the plan as a whole, such as a
+              batched sudoers rewrite (steps), counts of tasks and commands (counters) and the total wall-clock
+              time in seconds (elapsed)
+
+    raises:
+        OSError: if the platform isn't supported or commands for managing users are missing
+    """
+    check_environment()
+    start = time.time()
+    manage_sudoers = not batch_sudoers
+    steps = list()
+    bulk_tasks = list()
+    bulk_output = None
+    database_written = False
+    if write_database and get_platform() == 'Linux':
+        with command_caller('execution'), ACCOUNT_DATABASE_LOCK, _timed_step(steps=steps, phase='user_database'):
+            _apply_to_account_database(tasks=[task for task in plan if _changes_user_database(task=task)],
+                                       root_path=root_path)
+        database_written = True
+    elif bulk_add and get_platform() == 'Linux' and constants.LINUX_CMD_NEWUSERS and constants.LINUX_CMD_CHPASSWD:
+        # newusers always creates home directories, so it can only stand in for useradd when they are managed
+        bulk_tasks = [task for task in plan if task['action'] == 'add' and task['manage_home'] and
+                      generate_newusers_entry(proposed_user=task['proposed_user'], password='') is not None]
+    if bulk_tasks:
+        with command_caller('execution'), ACCOUNT_DATABASE_LOCK, _timed_step(steps=steps, phase='user_database'):
+            bulk_output = _bulk_add_users(tasks=bulk_tasks, root_path=root_path)
+        if bulk_output[1] != 0:
+            bulk_tasks = list()
+    bulk_task_ids = set(id(task) for task in bulk_tasks)
+
+    def run_task(task):
+        created = id(task) in bulk_task_ids
+        task_result = execute_task(task, manage_sudoers=manage_sudoers, root_path=root_path,
+                                   manage_user_database=not (created or database_written))
+        if created:
+            task_result['command_output'] = bulk_output
+        return task_result
+
+    if not workers or workers < 2 or len(plan) < 2:
+        task_results = [run_task(task) for task in plan]
+    else:
+        pool = ThreadPool(processes=min(workers, len(plan)))
+        try:
+            task_results = pool.map(run_task, plan)
+        finally:
+            pool.close()
+            pool.join()
+    if batch_sudoers:
+        with command_caller('execution'), _timed_step(steps=steps, phase='sudoers'):
+            SudoersBatch.from_plan(plan=plan, root_path=root_path).apply()
+    report = dict(results=task_results, steps=steps, counters=_count_results(task_results=task_results, steps=steps),
+                  elapsed=time.time() - start)
+    if metrics_sink:
+        _send_metrics(report=report, metrics_sink=metrics_sink)
+    return report
+
+
+def execute_task(task=None, manage_sudoers=True, root_path=None, manage_user_database=True):
+    """Apply a single plan item.
+
+    args:
+        task (dict): a task generated by create_plan
+        manage_sudoers (bool): apply the task's sudoers changes (False if they are applied separately)
+        root_path (str): apply the task to an alternate filesystem root
+        manage_user_database (bool): run the task's user database command (False if its user has already been
+                                     created, changed or deleted)
+
+    returns:
+        dict: the task, the output of the user database command (if one was run), each phase of the task
+              (user_database, authorized_keys or sudoers) with the commands it ran and its wall-clock time in
+              seconds (steps) and the task's total time (elapsed)
+    """
+    with command_caller('execution'):
+        return _execute_task(task=task, manage_sudoers=manage_sudoers, root_path=root_path,
+                             manage_user_database=manage_user_database)
+
+
+def _execute_task(task=None, manage_sudoers=True, root_path=None, manage_user_database=True):
+    """Apply a single plan item, see execute_task."""
+    start = time.time()
+    steps = list()
+    action = task['action']
+    command_output = None
+    if action == 'delete':
+        if manage_user_database:
+            command = generate_delete_user_command(username=task.get('username'), manage_home=task['manage_home'],
+                                                   root_path=root_path)
+            with ACCOUNT_DATABASE_LOCK, _timed_step(steps=steps, phase='user_database'):
+                command_output = execute_command(command)
+        # The cached sudoers model avoids rewriting sudoers for users that never had an entry
+        if manage_sudoers and load_sudoers(root_path=root_path).get_entry(username=task.get('username')) is not None:
+            with SUDOERS_LOCK, _timed_step(steps=steps, phase='sudoers'):
+                remove_sudoers_entry(username=task.get('username'), root_path=root_path)
+    elif action == 'add':
+        if manage_user_database:
+            command = generate_add_user_command(proposed_user=task.get('proposed_user'),
+                                                manage_home=task['manage_home'], root_path=root_path)
+            with ACCOUNT_DATABASE_LOCK, _timed_step(steps=steps, phase='user_database'):
                 command_output = execute_command(command)
-                if task['manage_home'] and task['manage_keys'] and result.get('public_keys_action'):
-                    write_authorized_keys(task['proposed_user'])
-                if result.get('sudoers_entry_action'):
+        if task['proposed_user'].public_keys and task['manage_home'] and task['manage_keys']:
+            with _timed_step(steps=steps, phase='authorized_keys'):
+                write_authorized_keys(task['proposed_user'], root_path=root_path)
+        if manage_sudoers and task['proposed_user'].sudoers_entry:
+            with SUDOERS_LOCK, _timed_step(steps=steps, phase='sudoers'):
+                write_sudoers_entry(username=task['proposed_user'].name,
+                                    sudoers_entry=task['proposed_user'].sudoers_entry, root_path=root_path)
+    elif action == 'update':
+        result = task['user_comparison'].get('result')
+        # Don't modify user if only keys have changed
+        action_count = 0
+        for k, _ in iteritems(result):
+            if '_action' in k:
+                action_count += 1
+        if task['manage_home'] and task['manage_keys'] and action_count == 1 and 'public_keys_action' in result:
+            with _timed_step(steps=steps, phase='authorized_keys'):
+                write_authorized_keys(task['proposed_user'], root_path=root_path)
+        elif action_count == 1 and 'sudoers_entry_action' in result:
+            if manage_sudoers:
+                with SUDOERS_LOCK, _timed_step(steps=steps, phase='sudoers'):
+                    write_sudoers_entry(username=task['proposed_user'].name,
+                                        sudoers_entry=task['user_comparison']['result']['replacement_sudoers_entry'],
+                                        root_path=root_path)
+        else:
+            if manage_user_database:
+                command = generate_modify_user_command(task=task, root_path=root_path)
+                with ACCOUNT_DATABASE_LOCK, _timed_step(steps=steps, phase='user_database'):
+                    command_output = execute_command(command)
+            if task['manage_home'] and task['manage_keys'] and result.get('public_keys_action'):
+                with _timed_step(steps=steps, phase='authorized_keys'):
+                    write_authorized_keys(task['proposed_user'], root_path=root_path)
+            if manage_sudoers and result.get('sudoers_entry_action'):
+                with SUDOERS_LOCK, _timed_step(steps=steps, phase='sudoers'):
                     write_sudoers_entry(username=task['proposed_user'].name,
-                                        sudoers_entry=task['user_comparison']['result']['replacement_sudoers_entry'])
-            execution_result.append(dict(task=task, command_output=command_output))
+                                        sudoers_entry=task['user_comparison']['result']['replacement_sudoers_entry'],
+                                        root_path=root_path)
+    return dict(task=task, command_output=command_output, steps=steps, elapsed=time.time() - start)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
-from typing import List
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Tuple
 
+from creds.database import PasswdEntry
 from creds.users import Users
 
 
@@ -9,4 +10,33 @@ def create_plan(existing_users: Users, proposed_users: Users, purge_undefined: b
                 allow_non_unique_id: bool, manage_home: bool, manage_keys: bool) -> List: pass
 
 
-def execute_plan(plan: List[dict]) -> None: pass
+def _timed_step(steps: List[dict], phase: str) -> ContextManager[None]: pass
+
+
+def _count_results(task_results: List[dict], steps: List[dict]) -> Dict[str, int]: pass
+
+
+def _send_metrics(report: Dict[str, Any], metrics_sink: Callable[[str, float, Dict[str, str]], None]) -> None: pass
+
+
+def _bulk_add_users(tasks: List[dict], root_path: Optional[str]) -> Tuple[Tuple[bytes, bytes], int]: pass
+
+
+def _apply_to_account_database(tasks: List[dict],
+                               root_path: Optional[str]) -> Tuple[List[PasswdEntry], List[PasswdEntry]]: pass
+
+
+def _changes_user_database(task: dict) -> bool: pass
+
+
+def execute_plan(plan: List[dict], workers: Optional[int], batch_sudoers: bool,
+                 root_path: Optional[str],
+                 metrics_sink: Optional[Callable[[str, float, Dict[str, str]], None]],
+                 bulk_add: bool, write_database: bool) -> Dict[str, Any]: pass
+
+
+def execute_task(task: dict, manage_sudoers: bool, root_path: Optional[str], manage_user_database: bool) -> dict: pass
+
+
+def _execute_task(task: dict, manage_sudoers: bool, root_path: Optional[str],
+                  manage_user_database: bool) -> dict: pass
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Compile a plan to a single POSIX shell script, so it can be reviewed, kept and run with one sudo invocation.
+
+Write the result of compile_plan to a file, review it and run it with e.g. sudo sh plan.sh, or run it with
+execute_script.
+"""
+from __future__ import (unicode_literals, print_function)
+
+import io
+import os
+import shlex
+import tempfile
+
+from creds import constants
+from creds.constants import SUDOERS_PATH
+from creds.database import get_passwd_entry
+from creds.sudoers import SudoersBatch
+from creds.users import (generate_add_user_command, generate_delete_user_command, generate_modify_user_command)
+from creds.utils import (execute_command, rooted_path, sudo_check)
+from external.six import iteritems, text_type
+from external.six.moves import shlex_quote
+
+HEREDOC_DELIMITER = 'CREDS_EOF'
+
+
+def _shell_command(command=None):
+    """Return a command as a line of shell, without the sudo prefix (the script as a whole is run with sudo)."""
+    if command and constants.CMD_SUDO and command[0] == constants.CMD_SUDO:
+        command = command[1:]
+    return ' '.join(shlex_quote(argument) for argument in command)
+
+
+def _heredoc(lines=None):
+    """Return the lines as the body of a quoted here-document, choosing a delimiter none of them contain."""
+    delimiter = HEREDOC_DELIMITER
+    while delimiter in lines:
+        delimiter = '{0}_'.format(delimiter)
+    return "<<'{0}'\n{1}{0}".format(delimiter, ''.join('{0}\n'.format(line) for line in lines))
+
+
+def _write_keys(user=None, root_path=None):
+    """Return the shell that atomically replaces a user's authorized_keys file."""
+    home_dir = user.home_dir
+    passwd_entry = None
+    if not home_dir or (root_path and user.uid is None):
+        passwd_entry = get_passwd_entry(username=user.name, root_path=root_path)
+    if not home_dir:
+        home_dir = passwd_entry.pw_dir if passwd_entry else '/home/{0}'.format(user.name)
+    home_dir = shlex_quote(rooted_path(home_dir, root_path=root_path))
+    # Names are resolved by the running system, so users under an alternate root are given ownership by uid
+    owner = user.name
+    if root_path:
+        owner = user.uid if user.uid is not None else passwd_entry.pw_uid if passwd_entry else user.name
+    owner = shlex_quote(text_type(owner))
+    # The script runs as root in a directory the user controls, so the keys are written from a subshell inside
+    # the keys directory, once it is known not to be reached through a symlink, and only by names relative to it.
+    # Swapping the directory for a symlink after the check doesn't move the subshell, and chown doesn't follow
+    # links, so a symlink the user plants is never written through.
+    return [
+        'mkdir -p {0}'.format(home_dir),
+        '(',
+        '    cd -P {0}'.format(home_dir),
+        '    home_dir=$(pwd -P)',
+        '    mkdir -p .ssh',
+        '    cd -P .ssh',
+        '    [ "$(pwd -P)" = "$home_dir/.ssh" ] || '
+        '{ echo "creds: refusing to write keys through a symlink" >&2; exit 1; }',
+        '    chown -h {0} .'.format(owner),
+        '    chmod 700 .',
+        '    keys_tmp=$(mktemp ./.authorized_keys_XXXXXX)',
+        '    cat > "$keys_tmp" {0}'.format(_heredoc(lines=[key.raw.strip() for key in user.public_keys])),
+        '    chown -h {0} "$keys_tmp"'.format(owner),
+        '    chmod 600 "$keys_tmp"',
+        '    mv -f "$keys_tmp" authorized_keys',
+        ')',
+    ]
+
+
+def _rewrite_sudoers(batch=None, root_path=None):
+    """Return the shell that applies every sudoers change in a batch with one validated rewrite of the file."""
+    sudoers_path = shlex_quote(rooted_path(SUDOERS_PATH, root_path=root_path))
+    for username in batch.changes:
+        if not username or any(character.isspace() for character in username):
+            raise ValueError('Invalid user name for sudoers: {0!r}'.format(username))
+    # The names are split on spaces from a string literal in the awk program, which is itself quoted for the shell
+    names = ' '.join(sorted(batch.changes)).replace('\\', '\\\\').replace('"', '\\"')
+    awk_program = 'BEGIN {{ n = split("{0}", names, " "); for (i = 1; i <= n; i++) changed[names[i]] = 1 }} ' \
+        '!($1 in changed)'.format(names)
+    entries = ['{0} {1}'.format(username, sudoers_entry) for username, sudoers_entry in iteritems(batch.changes)
+               if sudoers_entry]
+    lines = [
+        'sudoers_tmp=$(mktemp {0})'.format(shlex_quote('{0}/.sudoers_XXXXXX'.format(
+            os.path.dirname(rooted_path(SUDOERS_PATH, root_path=root_path))))),
+        # Drop every line for the changed users, matching on the first token as sudoers_line_user does
+        'awk {0} {1} > "$sudoers_tmp"'.format(shlex_quote(awk_program), sudoers_path),
+    ]
+    if entries:
+        lines.append('cat >> "$sudoers_tmp" {0}'.format(_heredoc(lines=entries)))
+    lines.extend([
+        '{0} -cf "$sudoers_tmp" || {{ rm -f "$sudoers_tmp"; exit 1; }}'.format(
+            shlex_quote(constants.LINUX_CMD_VISUDO or 'visudo')),
+        'chown root:root "$sudoers_tmp"',
+        'chmod 440 "$sudoers_tmp"',
+        'mv -f "$sudoers_tmp" {0}'.format(sudoers_path),
+    ])
+    return lines
+
+
+def compile_plan(plan=None, root_path=None):
+    """Compile a plan to a POSIX shell script that makes the same changes as execute_plan.
+
+    User database commands are run in plan order, keys are written from here-documents and every sudoers change
+    is applied at the end with a single rewrite of the sudoers file, validated with visudo. The script stops at
+    the first command that fails.
+
+    args:
+        plan (list): tasks generated by create_plan
+        root_path (str): apply the plan to an alternate filesystem root, e.g. a chroot or container image
+
+    returns:
+        str: the script
+    """
+    lines = ['#!/bin/sh', '# Generated by creds from a plan of {0} tasks'.format(len(plan)), 'set -e']
+    for task in plan:
+        action = task['action']
+        lines.append('')
+        if action == 'fail':
+            lines.append('# skipped {0}: {1}'.format(task['proposed_user'].name, task['error']))
+            continue
+        if action == 'delete':
+            lines.append('# delete {0}'.format(task['username']))
+            lines.append(_shell_command(generate_delete_user_command(
+                username=task['username'], manage_home=task['manage_home'], root_path=root_path)))
+            continue
+        user = task['proposed_user']
+        lines.append('# {0} {1}'.format(action, user.name))
+        write_keys = user.public_keys and task['manage_home'] and task['manage_keys']
+        if action == 'add':
+            lines.append(_shell_command(generate_add_user_command(
+                proposed_user=user, manage_home=task['manage_home'], root_path=root_path)))
+        else:
+            result = task['user_comparison']['result']
+            actions = [name for name in result if name.endswith('_action')]
+            # usermod is only needed if something other than the keys or sudoers entry has changed
+            if set(actions).difference(('public_keys_action', 'sudoers_entry_action')):
+                lines.append(_shell_command(generate_modify_user_command(task=task, root_path=root_path)))
+            write_keys = write_keys and 'public_keys_action' in result
+        if write_keys:
+            lines.extend(_write_keys(user=user, root_path=root_path))
+    batch = SudoersBatch.from_plan(plan=plan, root_path=root_path)
+    if batch.changes:
+        lines.append('')
+        lines.append('# sudoers')
+        lines.extend(_rewrite_sudoers(batch=batch, root_path=root_path))
+    return '{0}\n'.format('\n'.join(lines))
+
+
+def execute_script(script=None):
+    """Run a compiled plan with a single (sudo) sh invocation.
+
+    args:
+        script (str): created by compile_plan
+
+    returns:
+        tuple: the output of the script in the form returned by execute_command
+    """
+    file_descriptor, script_path = tempfile.mkstemp(prefix='creds_plan_', suffix='.sh')
+    try:
+        with io.open(file_descriptor, mode='w', encoding='utf-8') as script_file:
+            script_file.write(script)
+        return execute_command(shlex.split(str('{0} sh {1}'.format(sudo_check(), script_path))))
+    finally:
+        os.unlink(script_path)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from typing import List, Optional, Tuple
+
+from creds.sudoers import SudoersBatch
+from creds.users import User
+
+HEREDOC_DELIMITER: str
+
+
+def _shell_command(command: List[str]) -> str: pass
+
+
+def _heredoc(lines: List[str]) -> str: pass
+
+
+def _write_keys(user: User, root_path: Optional[str]) -> List[str]: pass
+
+
+def _rewrite_sudoers(batch: SudoersBatch, root_path: Optional[str]) -> List[str]: pass
+
+
+def compile_plan(plan: List[dict], root_path: Optional[str]) -> str: pass
+
+
+def execute_script(script: str) -> Tuple[Tuple[bytes, bytes], int]: pass
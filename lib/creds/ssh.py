@@ -2,18 +2,34 @@
 """A class to represent a users' keys and functions to manage them."""
 from __future__ import (unicode_literals, print_function)
 
+import base64
+import errno
+import hashlib
+import io
 import os
+import pwd
 import shlex
 
-from creds.constants import RANDOM_FILE_EXT_LENGTH
+from creds import constants
+from creds.constants import BULK_READ_CHUNK_SIZE, RANDOM_FILE_EXT_LENGTH
+from creds.database import get_passwd_entry
+from creds.helper import active_helper
 from creds.utils import base64decode, base64encode
-from creds.utils import execute_command, random_string, sudo_check
-from external.six import text_type
+from creds.utils import execute_command, random_string, rooted_path, sudo_check
+from external.six import iteritems, text_type
+
+KEY_TYPE_PREFIXES = ('ssh-', 'ecdsa-', 'sk-')  # Prefixes of the key types accepted in authorized_keys
 
 
 class PublicKey(object):
 
-    """Representation of a public key."""
+    """Representation of a public key.
+
+    Each representation of the key (raw, base64 encoded, parsed and fingerprint) is computed at most once, on first
+    use. Keys compare equal, and hash, on their raw form so that sets of keys can be compared directly.
+    """
+
+    __slots__ = ('_raw', '_b64encoded', '_parsed', '_fingerprint', '_hash')
 
     def __init__(self, raw=None, b64encoded=None):
         """Make a public key.
@@ -24,8 +40,11 @@ class PublicKey(object):
         """
         if not any((raw, b64encoded)):
             raise AttributeError('Key not provided')
-        self._raw = raw
-        self._b64encoded = b64encoded
+        self._raw = text_type(raw).strip("\r\n") if raw else None
+        self._b64encoded = text_type(b64encoded).strip("\r\n") if b64encoded else None
+        self._parsed = None
+        self._fingerprint = None
+        self._hash = None
 
     @property
     def b64encoded(self):
@@ -34,10 +53,9 @@ class PublicKey(object):
         returns:
             str: base64 encoding of the public key
         """
-        if self._b64encoded:
-            return text_type(self._b64encoded).strip("\r\n")
-        else:
-            return base64encode(self.raw)
+        if self._b64encoded is None:
+            self._b64encoded = base64encode(self.raw)
+        return self._b64encoded
 
     @property
     def raw(self):
@@ -46,10 +64,59 @@ class PublicKey(object):
         returns:
             str: raw key
         """
-        if self._raw:
-            return text_type(self._raw).strip("\r\n")
-        else:
-            return text_type(base64decode(self._b64encoded)).strip("\r\n")
+        if self._raw is None:
+            self._raw = text_type(base64decode(self._b64encoded)).strip("\r\n")
+        return self._raw
+
+    @property
+    def parsed(self):
+        """Return the key split into its type, base64 blob and comment. Any options preceding the key are dropped.
+
+        returns:
+            tuple: (type, blob, comment), with None for any part that isn't present
+        """
+        if self._parsed is None:
+            tokens = self.raw.split()
+            self._parsed = (None, None, None)
+            for index, token in enumerate(tokens[:-1]):
+                if token.startswith(KEY_TYPE_PREFIXES) and tokens[index + 1].startswith('AAAA'):
+                    self._parsed = (token, tokens[index + 1], ' '.join(tokens[index + 2:]) or None)
+                    break
+        return self._parsed
+
+    @property
+    def fingerprint(self):
+        """Return the SHA256 fingerprint of the key, in the format displayed by ssh-keygen -l.
+
+        returns:
+            str: fingerprint, e.g. 'SHA256:...', or None if the key can't be parsed
+        """
+        if self._fingerprint is None:
+            blob = self.parsed[1]
+            if not blob:
+                return None
+            try:
+                digest = hashlib.sha256(base64.b64decode(blob.encode('ascii'))).digest()
+            except (TypeError, ValueError):
+                return None
+            self._fingerprint = 'SHA256:{0}'.format(base64.b64encode(digest).decode('ascii').rstrip('='))
+        return self._fingerprint
+
+    def __eq__(self, other):
+        if not isinstance(other, PublicKey):
+            return NotImplemented
+        return self.raw == other.raw
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self.raw)
+        return self._hash
 
     def __str__(self):
         return self.__repr__()
@@ -60,16 +127,31 @@ class PublicKey(object):
 
 # TODO: Keep temporary copy so we can check for race condition.
 
-def read_authorized_keys(username=None):
+def _home_dir(username=None, home_dir=None, root_path=None):
+    """Return a user's home directory as seen from this process.
+
+    Under an alternate root the user is looked up in that root's passwd file (unless their home directory is
+    already known), rather than resolved with this system's NSS.
+    """
+    if not root_path:
+        return os.path.expanduser('~{0}'.format(username))
+    if not home_dir:
+        passwd_entry = get_passwd_entry(username=username, root_path=root_path)
+        home_dir = passwd_entry.pw_dir if passwd_entry else '/home/{0}'.format(username)
+    return rooted_path(home_dir, root_path=root_path)
+
+
+def read_authorized_keys(username=None, root_path=None):
     """Read public keys from specified user's authorized_keys file.
 
     args:
         username (str): username.
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
 
     returns:
         list: Authorised keys for the specified user.
     """
-    authorized_keys_path = '{0}/.ssh/authorized_keys'.format(os.path.expanduser('~{0}'.format(username)))
+    authorized_keys_path = '{0}/.ssh/authorized_keys'.format(_home_dir(username=username, root_path=root_path))
     rnd_chars = random_string(length=RANDOM_FILE_EXT_LENGTH)
     tmp_authorized_keys_path = '/tmp/authorized_keys_{0}_{1}'.format(username, rnd_chars)
     authorized_keys = list()
@@ -87,17 +169,77 @@ def read_authorized_keys(username=None):
     return authorized_keys
 
 
-def write_authorized_keys(user=None):
+def read_authorized_keys_bulk(home_dirs=None):
+    """Read public keys from the authorized_keys files of many users in a single pass.
+
+    Files that can be read directly (always the case when running as root) are opened in-process. The
+    remainder are read with one privileged grep per BULK_READ_CHUNK_SIZE files, rather than copying each
+    file to a temporary location.
+
+    args:
+        home_dirs (dict): user name to home directory (as seen from this process).
+
+    returns:
+        dict: user name to a list of their authorised keys.
+    """
+    authorized_keys = dict()
+    privileged_paths = dict()
+    is_root = not sudo_check()
+    for username, home_dir in iteritems(home_dirs):
+        authorized_keys[username] = list()
+        authorized_keys_path = '{0}/.ssh/authorized_keys'.format(home_dir)
+        if is_root or os.access(authorized_keys_path, os.R_OK):
+            try:
+                with io.open(authorized_keys_path, encoding=text_type('utf-8')) as keys_file:
+                    for key in keys_file:
+                        authorized_keys[username].append(PublicKey(raw=key))
+            except (IOError, OSError) as error:
+                if error.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+        else:
+            privileged_paths[authorized_keys_path] = username
+    paths = sorted(privileged_paths)
+    for chunk_start in range(0, len(paths), BULK_READ_CHUNK_SIZE):
+        chunk = paths[chunk_start:chunk_start + BULK_READ_CHUNK_SIZE]
+        # Print every line of every file, each prefixed with its file name and a NUL separator
+        command = [sudo_check(), constants.CMD_GREP, '-a', '-s', '-H', '--null', '-e', '', '--'] + chunk
+        grep_result = execute_command(command)
+        result_message = grep_result[0][1].decode('UTF-8')
+        if 'you must have a tty to run sudo' in result_message:  # pragma: no cover
+            raise OSError("/etc/sudoers is blocked sudo. Remove entry: 'Defaults    requiretty'.")
+        for line in grep_result[0][0].decode('UTF-8').split('\n'):
+            authorized_keys_path, _, key = line.partition('\0')
+            if authorized_keys_path in privileged_paths:
+                authorized_keys[privileged_paths[authorized_keys_path]].append(PublicKey(raw='{0}\n'.format(key)))
+    return authorized_keys
+
+
+def write_authorized_keys(user=None, root_path=None):
     """Write public keys back to authorized_keys file. Create keys directory if it doesn't already exist.
 
     args:
         user (User): Instance of User containing keys.
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
 
     returns:
         list: Authorised keys for the specified user.
     """
     authorized_keys = list()
-    authorized_keys_dir = '{0}/.ssh'.format(os.path.expanduser('~{0}'.format(user.name)))
+    home_dir = _home_dir(username=user.name, home_dir=user.home_dir, root_path=root_path)
+    authorized_keys_dir = '{0}/.ssh'.format(home_dir)
+    if not sudo_check():
+        _write_authorized_keys_as_root(user=user, authorized_keys_dir=authorized_keys_dir, root_path=root_path)
+        return
+    helper = active_helper()
+    if helper is not None:
+        _write_authorized_keys_with_helper(helper=helper, user=user, authorized_keys_dir=authorized_keys_dir,
+                                           root_path=root_path)
+        return
+    # Refuse to follow a symlink planted by the user, which would let them redirect a write made as root
+    if os.path.islink(authorized_keys_dir):
+        raise OSError(errno.ELOOP, 'Refusing to write keys through a symlink', authorized_keys_dir)
+    # Names are resolved by this system's NSS, so users under an alternate root are given ownership by uid
+    owner = _key_owner(user=user, root_path=root_path) if root_path else user.name
     rnd_chars = random_string(length=RANDOM_FILE_EXT_LENGTH)
     authorized_keys_path = '{0}/authorized_keys'.format(authorized_keys_dir)
     tmp_authorized_keys_path = '/tmp/authorized_keys_{0}_{1}'.format(user.name, rnd_chars)
@@ -110,8 +252,89 @@ def write_authorized_keys(user=None):
         keys_file.writelines(authorized_keys)
     execute_command(
         shlex.split(str('{0} cp {1} {2}'.format(sudo_check(), tmp_authorized_keys_path, authorized_keys_path))))
-    execute_command(shlex.split(str('{0} chown -R {1} {2}'.format(sudo_check(), user.name, authorized_keys_dir))))
+    execute_command(shlex.split(str('{0} chown -R {1} {2}'.format(sudo_check(), owner, authorized_keys_dir))))
     execute_command(shlex.split(str('{0} chmod 700 {1}'.format(sudo_check(), authorized_keys_dir))))
     execute_command(shlex.split(str('{0} chmod 600 {1}'.format(sudo_check(), authorized_keys_path))))
     execute_command(shlex.split(str('{0} rm {1}'.format(sudo_check(), tmp_authorized_keys_path))))
 
+
+def _key_owner(user=None, root_path=None):
+    """Return the uid that should own the user's keys."""
+    if root_path:
+        passwd_entry = get_passwd_entry(username=user.name, root_path=root_path)
+        if passwd_entry:
+            return passwd_entry.pw_uid
+    else:
+        try:
+            return pwd.getpwnam(user.name).pw_uid
+        except KeyError:
+            pass
+    return user.uid if user.uid is not None else -1
+
+
+def _write_keys_file(authorized_keys_dir=None, data=None, uid=-1):
+    """Atomically replace the authorized_keys file in a keys directory as root, without following symlinks.
+
+    The keys directory is opened with O_NOFOLLOW and given to the user through that descriptor. The keys are
+    written to a new temporary file created in the opened directory, synced and renamed over the current file, so
+    a symlink planted by the user (as the directory or any file in it) is never followed. Only the directory and
+    the file are given to the user; the rest of the directory's contents are left alone.
+
+    args:
+        authorized_keys_dir (str): the user's keys directory (as seen from this process)
+        data (bytes): contents of the file
+        uid (int): owner of the directory and file
+
+    raises:
+        OSError: if the keys directory is a symlink or not a directory
+    """
+    if not os.path.isdir(os.path.dirname(authorized_keys_dir)):
+        os.makedirs(os.path.dirname(authorized_keys_dir))
+    try:
+        os.mkdir(authorized_keys_dir, 0o700)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+    directory_descriptor = os.open(authorized_keys_dir, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW)
+    try:
+        os.fchown(directory_descriptor, uid, -1)
+        os.fchmod(directory_descriptor, 0o700)
+        tmp_name = '.authorized_keys_{0}'.format(random_string(length=RANDOM_FILE_EXT_LENGTH))
+        if os.open in getattr(os, 'supports_dir_fd', set()):
+            tmp_path, keys_path = tmp_name, 'authorized_keys'
+            at = dict(dir_fd=directory_descriptor)
+            rename_at = dict(src_dir_fd=directory_descriptor, dst_dir_fd=directory_descriptor)
+        else:  # pragma: no cover
+            # Python 2 has no *at calls, but the descriptor's /proc entry names the opened directory wherever it is
+            directory_path = '/proc/self/fd/{0}'.format(directory_descriptor)
+            tmp_path = '{0}/{1}'.format(directory_path, tmp_name)
+            keys_path = '{0}/authorized_keys'.format(directory_path)
+            at, rename_at = dict(), dict()
+        file_descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600, **at)
+        try:
+            with io.open(file_descriptor, mode='wb') as keys_file:
+                keys_file.write(data)
+                keys_file.flush()
+                os.fsync(keys_file.fileno())
+                os.fchown(keys_file.fileno(), uid, -1)
+                os.fchmod(keys_file.fileno(), 0o600)
+            os.rename(tmp_path, keys_path, **rename_at)
+        except Exception:
+            os.unlink(tmp_path, **at)
+            raise
+    finally:
+        os.close(directory_descriptor)
+
+
+def _write_authorized_keys_as_root(user=None, authorized_keys_dir=None, root_path=None):
+    """Write a user's authorized_keys file in-process, without forking, when running as root."""
+    uid = _key_owner(user=user, root_path=root_path)
+    _write_keys_file(authorized_keys_dir=authorized_keys_dir, uid=uid,
+                     data=''.join('{0}\n'.format(key.raw) for key in user.public_keys).encode('utf-8'))
+
+
+def _write_authorized_keys_with_helper(helper=None, user=None, authorized_keys_dir=None, root_path=None):
+    """Write a user's authorized_keys file through the privileged helper, rather than running a command per step."""
+    uid = _key_owner(user=user, root_path=root_path)
+    helper.write_authorized_keys(authorized_keys_dir=authorized_keys_dir, uid=uid,
+                                 data=''.join('{0}\n'.format(key.raw) for key in user.public_keys).encode('utf-8'))
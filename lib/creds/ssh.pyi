@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
 from __future__ import (unicode_literals, print_function)
 
-from typing import AnyStr, Optional, List
+from typing import AnyStr, Dict, Optional, List, Tuple
 
+from creds.helper import PrivilegedHelper
 from creds.users import User
 
 
+KEY_TYPE_PREFIXES: Tuple[str, ...]
+
+
 class PublicKey(object):
     def __init__(self, raw: Optional[AnyStr], b64encoded: Optional[AnyStr]) -> None:
         self._raw = raw
         self._b64encoded = b64encoded
+        self._parsed = None
+        self._fingerprint = None
+        self._hash = None
 
     @property
     def b64encoded(self) -> Optional[AnyStr]: pass
@@ -17,10 +24,39 @@ class PublicKey(object):
     @property
     def raw(self) -> Optional[AnyStr]: pass
 
+    @property
+    def parsed(self) -> Tuple[Optional[str], Optional[str], Optional[str]]: pass
+
+    @property
+    def fingerprint(self) -> Optional[str]: pass
+
+    def __eq__(self, other: object) -> bool: pass
+
+    def __hash__(self) -> int: pass
+
 
 # TODO: Keep temporary copy so we can check for race condition.
 
-def read_authorized_keys(username: str) -> List: pass
+def _home_dir(username: str, home_dir: Optional[str], root_path: Optional[str]) -> str: pass
+
+
+def read_authorized_keys(username: str, root_path: Optional[str]) -> List: pass
+
+
+def read_authorized_keys_bulk(home_dirs: Dict[str, str]) -> Dict[str, List[PublicKey]]: pass
+
+
+def write_authorized_keys(user: User, root_path: Optional[str]) -> List: pass
+
+
+def _key_owner(user: User, root_path: Optional[str]) -> int: pass
+
+
+def _write_keys_file(authorized_keys_dir: str, data: bytes, uid: int) -> None: pass
+
+
+def _write_authorized_keys_as_root(user: User, authorized_keys_dir: str, root_path: Optional[str]) -> None: pass
 
 
-def write_authorized_keys(user: User) -> List: pass
+def _write_authorized_keys_with_helper(helper: PrivilegedHelper, user: User, authorized_keys_dir: str,
+                                       root_path: Optional[str]) -> None: pass
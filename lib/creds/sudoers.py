@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""Classes and functions to read and update the sudoers file."""
+from __future__ import unicode_literals
+
+import errno
+import io
+import os
+import shlex
+import threading
+from collections import OrderedDict
+
+from creds import constants
+from creds.constants import RANDOM_FILE_EXT_LENGTH, SUDOERS_PATH
+from creds.utils import (execute_command, file_signature, random_string, rooted_path, sudo_check,
+                         sudoers_line_user)
+from external.six import iteritems, text_type
+
+MAX_INCLUDE_DEPTH = 128  # Matches the nesting limit applied by sudo
+
+_SUDOERS_CACHE = dict()
+_SUDOERS_CACHE_LOCK = threading.Lock()
+
+
+def _read_sudoers_file(path=None):
+    """Return the lines of a sudoers file, using sudo if it can't be read directly, or None if it doesn't exist."""
+    if not sudo_check() or os.access(path, os.R_OK):
+        try:
+            with io.open(path, encoding=text_type('utf-8')) as sudoers_file:
+                return sudoers_file.readlines()
+        except (IOError, OSError) as error:
+            if error.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise
+    cat_result = execute_command([sudo_check(), 'cat', path])
+    if cat_result[1] > 0:
+        return None
+    return cat_result[0][0].decode('UTF-8').splitlines(True)
+
+
+def _list_sudoers_dir(path=None):
+    """Return the names of the files in an included directory that sudo would read, in the order it reads them."""
+    try:
+        names = os.listdir(path)
+    except OSError as error:
+        if error.errno in (errno.ENOENT, errno.ENOTDIR) or not sudo_check():
+            return list()
+        list_result = execute_command([sudo_check(), 'ls', '-1A', path])
+        names = list_result[0][0].decode('UTF-8').splitlines() if list_result[1] == 0 else list()
+    # sudo skips files ending in '~' or containing a '.', e.g. editor backups and package manager leftovers
+    return sorted(name for name in names if not name.endswith('~') and '.' not in name)
+
+
+class Sudoers(object):
+    """A parsed sudoers file, including the files it includes, with each user mapped to their entry.
+
+    Only the sudoers file itself is rewritten when entries change, so the entries in it are kept apart from those
+    in the files it includes (e.g. /etc/sudoers.d). Users are compared against the entries in the sudoers file,
+    otherwise a user with an entry in an included file would be planned as changed on every run.
+    """
+
+    def __init__(self, entries=None, sources=None, included_entries=None):
+        """Make a sudoers model.
+
+        args:
+            entries (dict): user name to sudoers entry (excluding the user name), from the sudoers file itself
+            sources (list): signatures of the files and directories read, used to detect changes
+            included_entries (dict): user name to sudoers entry, from the included files
+        """
+        self.entries = entries if entries is not None else dict()
+        self.sources = sources if sources is not None else list()
+        self.included_entries = included_entries if included_entries is not None else dict()
+
+    def __repr__(self):
+        return '<Sudoers {0} entries>'.format(len(self.entries))
+
+    def get_entry(self, username=None):
+        """Return the sudoers entry for the specified user in the sudoers file (or None if there isn't one).
+
+        args:
+            username (str): user name.
+
+        returns:
+            str: sudoers entry, e.g. 'ALL=(ALL:ALL) ALL'
+        """
+        return self.entries.get(username)
+
+    @property
+    def cacheable(self):
+        """Whether every source could be checked for changes."""
+        return None not in self.sources
+
+    def is_current(self):
+        """Check none of the files or directories the model was built from have changed."""
+        return self.cacheable and all(file_signature(source[0]) == source for source in self.sources)
+
+    @classmethod
+    def from_file(cls, path=None, root_path=None):
+        """Parse a sudoers file and the files it includes.
+
+        args:
+            path (str): path to the sudoers file.
+            root_path (str): alternate filesystem root the file belongs to. Absolute include paths are read
+                             from under it rather than from this system.
+
+        returns:
+            Sudoers: the parsed model.
+        """
+        sudoers = cls()
+        sudoers._parse(path=path, depth=0, root_path=root_path)
+        return sudoers
+
+    @staticmethod
+    def _include_path(path=None, argument=None, root_path=None):
+        """Return the path of an included file or directory, relative to the including file unless absolute."""
+        if os.path.isabs(argument):
+            return rooted_path(argument, root_path=root_path)
+        return os.path.join(os.path.dirname(path), argument)
+
+    def _parse(self, path=None, depth=None, root_path=None):
+        """Add the entries from a sudoers file, following #include and #includedir directives."""
+        if depth > MAX_INCLUDE_DEPTH:
+            raise ValueError('Too many levels of includes in sudoers: {0}'.format(path))
+        self.sources.append(file_signature(path))
+        sudoers_lines = _read_sudoers_file(path=path)
+        if not sudoers_lines:
+            return
+        line = ''
+        for raw_line in sudoers_lines:
+            line = '{0}{1}'.format(line, raw_line.strip())
+            # Join continuation lines before parsing
+            if line.endswith('\\'):
+                line = line[:-1]
+                continue
+            tokens = line.split(None, 1)
+            directive = tokens[0] if tokens else ''
+            argument = tokens[1].strip() if len(tokens) > 1 else ''
+            if directive in ('#include', '@include') and argument:
+                self._parse(path=self._include_path(path=path, argument=argument, root_path=root_path),
+                            depth=depth + 1, root_path=root_path)
+            elif directive in ('#includedir', '@includedir') and argument:
+                include_dir = self._include_path(path=path, argument=argument, root_path=root_path)
+                self.sources.append(file_signature(include_dir))
+                for name in _list_sudoers_dir(path=include_dir):
+                    self._parse(path=os.path.join(include_dir, name), depth=depth + 1, root_path=root_path)
+            elif line and not line.startswith('#'):
+                (self.included_entries if depth else self.entries).setdefault(directive, argument)
+            line = ''
+
+
+def load_sudoers(root_path=None):
+    """Return the parsed sudoers model, reusing the last one built unless its sources have changed.
+
+    args:
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
+
+    returns:
+        Sudoers: the parsed model.
+    """
+    sudoers_path = rooted_path(SUDOERS_PATH, root_path=root_path)
+    with _SUDOERS_CACHE_LOCK:
+        sudoers = _SUDOERS_CACHE.get(sudoers_path)
+        if sudoers is None or not sudoers.is_current():
+            sudoers = Sudoers.from_file(path=sudoers_path, root_path=root_path)
+            _SUDOERS_CACHE[sudoers_path] = sudoers
+        return sudoers
+
+
+def invalidate_sudoers_cache():
+    """Discard every cached sudoers model."""
+    with _SUDOERS_CACHE_LOCK:
+        _SUDOERS_CACHE.clear()
+
+
+class SudoersBatch(object):
+    """A set of sudoers entry changes applied with a single rewrite and validation of the sudoers file."""
+
+    def __init__(self, root_path=None):
+        """Create an empty batch.
+
+        args:
+            root_path (str): alternate filesystem root whose sudoers file is changed, e.g. a chroot
+        """
+        self.root_path = root_path
+        self.changes = OrderedDict()
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __repr__(self):
+        return '<SudoersBatch {0} changes>'.format(len(self.changes))
+
+    def set_entry(self, username=None, sudoers_entry=None):
+        """Replace any existing entry for the user with the one provided.
+
+        args:
+            username (str): user name.
+            sudoers_entry (str): the entry, excluding the user name, e.g. 'ALL=(ALL:ALL) ALL'.
+        """
+        self.changes[username] = sudoers_entry
+
+    def remove_entry(self, username=None):
+        """Remove any existing entry for the user.
+
+        args:
+            username (str): user name.
+        """
+        self.changes[username] = None
+
+    @classmethod
+    def from_plan(cls, plan=None, root_path=None):
+        """Collect every sudoers change made by a plan.
+
+        args:
+            plan (list): tasks generated by create_plan.
+            root_path (str): alternate filesystem root the plan is executed against
+
+        returns:
+            SudoersBatch: the changes required by the plan.
+        """
+        batch = cls(root_path=root_path)
+        sudoers = load_sudoers(root_path=root_path)
+        for task in plan:
+            action = task['action']
+            # Skip removals for users without an entry, saving a rewrite if nothing else changes
+            if action == 'delete' and sudoers.get_entry(username=task['username']) is not None:
+                batch.remove_entry(username=task['username'])
+            elif action == 'add' and task['proposed_user'].sudoers_entry:
+                batch.set_entry(username=task['proposed_user'].name,
+                                sudoers_entry=task['proposed_user'].sudoers_entry)
+            elif action == 'update' and task['user_comparison']['result'].get('sudoers_entry_action'):
+                batch.set_entry(username=task['proposed_user'].name,
+                                sudoers_entry=task['user_comparison']['result']['replacement_sudoers_entry'])
+        return batch
+
+    def render(self, sudoers_lines=None):
+        """Apply the changes to the lines of a sudoers file.
+
+        args:
+            sudoers_lines (list): lines of the current sudoers file.
+
+        returns:
+            list: lines of the updated sudoers file.
+        """
+        sudoers_output = [line for line in sudoers_lines if sudoers_line_user(line) not in self.changes]
+        if sudoers_output and not sudoers_output[-1].endswith('\n'):
+            sudoers_output[-1] = '{0}\n'.format(sudoers_output[-1])
+        for username, sudoers_entry in iteritems(self.changes):
+            if sudoers_entry:
+                sudoers_output.append('{0} {1}\n'.format(username, sudoers_entry))
+        return sudoers_output
+
+    def apply(self):
+        """Rewrite the sudoers file once with every change in the batch.
+
+        The updated file is validated with visudo before it atomically replaces the current one. If validation
+        fails the current file is left untouched.
+
+        raises:
+            ValueError: if the updated file fails validation.
+        """
+        if not self.changes:
+            return
+        sudoers_path = rooted_path(SUDOERS_PATH, root_path=self.root_path)
+        rnd_chars = random_string(length=RANDOM_FILE_EXT_LENGTH)
+        tmp_sudoers_path = '/tmp/sudoers_{0}'.format(rnd_chars)
+        # Staged alongside the sudoers file so the final rename is atomic
+        staged_sudoers_path = '{0}/.sudoers_{1}'.format(os.path.dirname(sudoers_path), rnd_chars)
+        execute_command(shlex.split(str('{0} cp {1} {2}'.format(sudo_check(), sudoers_path, tmp_sudoers_path))))
+        execute_command(shlex.split(str('{0} chown {1} {2}'.format(sudo_check(), os.geteuid(), tmp_sudoers_path))))
+        try:
+            with open(tmp_sudoers_path, mode=text_type('r')) as tmp_sudoers_file:
+                sudoers_entries = tmp_sudoers_file.readlines()
+            with open(tmp_sudoers_path, mode=text_type('w+')) as tmp_sudoers_file:
+                tmp_sudoers_file.writelines(self.render(sudoers_lines=sudoers_entries))
+            sudoers_check_result = execute_command(
+                shlex.split(str('{0} {1} -cf {2}'.format(sudo_check(), constants.LINUX_CMD_VISUDO, tmp_sudoers_path))))
+            if sudoers_check_result[1] > 0:
+                raise ValueError(sudoers_check_result[0][1])
+            execute_command(
+                shlex.split(str('{0} cp {1} {2}'.format(sudo_check(), tmp_sudoers_path, staged_sudoers_path))))
+            execute_command(shlex.split(str('{0} chown root:root {1}'.format(sudo_check(), staged_sudoers_path))))
+            execute_command(shlex.split(str('{0} chmod 440 {1}'.format(sudo_check(), staged_sudoers_path))))
+            move_result = execute_command(
+                shlex.split(str('{0} mv -f {1} {2}'.format(sudo_check(), staged_sudoers_path, sudoers_path))))
+            if move_result[1] > 0:
+                execute_command(shlex.split(str('{0} rm -f {1}'.format(sudo_check(), staged_sudoers_path))))
+                raise OSError(move_result[0][1])
+        finally:
+            execute_command(shlex.split(str('{0} rm -f {1}'.format(sudo_check(), tmp_sudoers_path))))
+            invalidate_sudoers_cache()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from typing import Dict, List, Optional, Tuple
+
+MAX_INCLUDE_DEPTH: int
+
+
+class Sudoers(object):
+    def __init__(self, entries: Optional[Dict[str, str]], sources: Optional[List[Tuple]],
+                 included_entries: Optional[Dict[str, str]]) -> None:
+        self.entries = entries
+        self.sources = sources
+        self.included_entries = included_entries
+
+    def get_entry(self, username: str) -> Optional[str]: pass
+
+    @property
+    def cacheable(self) -> bool: pass
+
+    def is_current(self) -> bool: pass
+
+    @classmethod
+    def from_file(cls, path: str, root_path: Optional[str]) -> Sudoers: pass
+
+    @staticmethod
+    def _include_path(path: str, argument: str, root_path: Optional[str]) -> str: pass
+
+    def _parse(self, path: str, depth: int, root_path: Optional[str]) -> None: pass
+
+
+def load_sudoers(root_path: Optional[str]) -> Sudoers: pass
+
+
+def invalidate_sudoers_cache() -> None: pass
+
+
+class SudoersBatch(object):
+    def __init__(self, root_path: Optional[str]) -> None:
+        self.changes = dict()
+
+    def set_entry(self, username: str, sudoers_entry: str) -> None: pass
+
+    def remove_entry(self, username: str) -> None: pass
+
+    @classmethod
+    def from_plan(cls, plan: List[dict], root_path: Optional[str]) -> SudoersBatch: pass
+
+    def render(self, sudoers_lines: List[str]) -> List[str]: pass
+
+    def apply(self) -> None: pass
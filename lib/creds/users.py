@@ -2,24 +2,33 @@
 """This module contains the classes for User (a user's details) and Users (a collection of User instances)."""
 from __future__ import unicode_literals
 
+import hashlib
 import io
 import json
 import os
 import shlex
-import sys
 from collections import MutableSequence
-from creds.constants import (SUPPORTED_PLATFORMS, UID_MAX, UID_MIN,
-                             LINUX_CMD_USERADD, LINUX_CMD_USERDEL, LINUX_CMD_USERMOD,
-                             FREEBSD_CMD_PW)
+from creds import constants
+from creds.cache import DiscoveryCache, load_compiled_manifest
+from creds.database import read_passwd
 from creds.ssh import PublicKey
-from creds.ssh import read_authorized_keys
-from creds.utils import (get_platform, sudo_check, read_sudoers, get_sudoers_entry, get_missing_commands)
-from external.six import text_type
+from creds.ssh import read_authorized_keys_bulk
+from creds.sudoers import load_sudoers
+from creds.utils import (check_environment, command_caller, command_with_input, get_platform, sudo_check,
+                         rooted_path)
+from external.six import integer_types, text_type, viewkeys
+
+JSON_CHUNK_SIZE = 65536  # Characters read at a time when decoding a JSON manifest
+JSON_NUMBER_CHARACTERS = '0123456789+-.eE'
 
 
 class User(object):
     """Representation of a user and their related credentials."""
 
+    # No per-instance __dict__, as discovery and manifests can hold a very large number of users
+    __slots__ = ('name', 'passwd', 'uid', 'gid', '_gecos', 'home_dir', 'shell', 'public_keys', 'sudoers_entry',
+                 '_digest')
+
     def __init__(self, name=None, passwd=None, uid=None, gid=None, gecos=None,
                  home_dir=None, shell=None, public_keys=None, sudoers_entry=None):
         """Make a user.
@@ -44,6 +53,7 @@ class User(object):
         self.shell = shell
         self.public_keys = public_keys
         self.sudoers_entry = sudoers_entry
+        self._digest = None
 
     @property
     def gecos(self):
@@ -62,6 +72,25 @@ class User(object):
         else:
             return '\"{0}\"'.format(self._gecos)
 
+    @property
+    def digest(self):
+        """Return a stable digest of the fields compared when planning changes, i.e. all but name and passwd.
+
+        Users with equal digests have no differences that compare_user would act on. The digest is remembered
+        until one of the fields changes.
+
+        returns:
+            str: hex encoded SHA-256 digest
+        """
+        gecos = self.gecos
+        fields = (self.uid, self.gid, gecos, self.home_dir, self.shell, self.sudoers_entry,
+                  tuple(self.public_keys or ()))
+        if self._digest is None or self._digest[0] != fields:
+            values = ['' if value is None else text_type(value) for value in fields[:-1]]
+            values.extend(sorted(key.raw for key in fields[-1]))
+            self._digest = (fields, hashlib.sha256('\x1f'.join(values).encode('utf-8')).hexdigest())
+        return self._digest[1]
+
     def __str__(self):
         return self.__repr__()
 
@@ -70,11 +99,103 @@ class User(object):
 
     def to_dict(self):
         """ Return the user as a dict. """
-        public_keys = [public_key.b64encoded for public_key in self.public_keys]
+        public_keys = [public_key.b64encoded for public_key in self.public_keys or list()]
         return dict(name=self.name, passwd=self.passwd, uid=self.uid, gid=self.gid, gecos=self.gecos,
                     home_dir=self.home_dir, shell=self.shell, public_keys=public_keys)
 
 
+def _import_yaml():
+    """Return the yaml module.
+
+    raises:
+        ImportError: if PyYAML isn't installed.
+    """
+    try:
+        import yaml
+    except ImportError:  # pragma: no cover
+        raise ImportError('PyYAML is not installed, but is required in order to parse YAML files.'
+                          '\nTo install, run:\n$ pip install PyYAML\nor visit'
+                          ' http://pyyaml.org/wiki/PyYAML for instructions.')
+    return yaml
+
+
+def _parse_yaml_users(source=None):
+    """Return the list of user dicts from the text of a YAML manifest, parsed with libyaml if it's available."""
+    yaml = _import_yaml()
+    users_yaml = yaml.load(source, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    if not isinstance(users_yaml, dict):
+        raise ValueError('No YAML object could be decoded')
+    return users_yaml.get('users') or list()
+
+
+def _parse_json_users(source=None):
+    """Return the list of user dicts from the text of a JSON manifest."""
+    try:
+        users_json = json.loads(source)
+    except ValueError:
+        raise ValueError('No JSON object could be decoded')
+    if not isinstance(users_json, dict):
+        raise ValueError('No JSON object could be decoded')
+    return users_json.get('users') or list()
+
+
+class _JSONReader(object):
+    """Decode the values of a JSON document one at a time, reading the stream in chunks as they are needed."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Append the next chunk of the stream to the unread part of the buffer, returning False at the end."""
+        chunk = self.stream.read(JSON_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = '{0}{1}'.format(self.buffer[self.position:], chunk)
+        self.position = 0
+        return True
+
+    def peek(self):
+        """Return the next character that isn't whitespace, or an empty string at the end of the stream."""
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in ' \t\r\n':
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters=None):
+        """Consume the next character, which must be one of those specified, and return it."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError('No JSON object could be decoded')
+        self.position += 1
+        return character
+
+    def value(self):
+        """Decode and return the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except ValueError:
+                # The value may continue in the next chunk
+                if self._fill():
+                    continue
+                raise ValueError('No JSON object could be decoded')
+            # A number may continue in the next chunk, e.g. a buffer ending in 12. is decoded as 12 up to the point
+            if isinstance(value, integer_types + (float,)) and not isinstance(value, bool) and not self.eof and \
+                    not self.buffer[end:].strip(JSON_NUMBER_CHARACTERS) and self._fill():
+                continue
+            self.position = end
+            return value
+
+
 class Users(MutableSequence):
     """A collection of users and methods to manage them."""
 
@@ -84,23 +205,46 @@ class Users(MutableSequence):
         args:
             oktypes (type): The acceptable types of instances..
         """
-        platform = get_platform()
-        # Check platform is supported
-        if not platform in SUPPORTED_PLATFORMS:
-            sys.exit('Linux, FreeBSD and OpenBSD are currently the only supported platforms for this library.')
-        # Check OS commands are available for managing users
-        missing_commands = get_missing_commands(platform)
-        if missing_commands:
-            sys.exit('Unable to find commands: {0}.\nPlease check PATH.'.format(', '.join(missing_commands)))
-
         self.oktypes = oktypes
         self._user_list = list()
+        # Indexes kept in step with _user_list so that lookups by name or uid don't scan the collection
+        self._name_index = dict()
+        self._uid_index = dict()
 
     def check(self, value):
         """Check types."""
         if not isinstance(value, self.oktypes):
             raise TypeError
 
+    def _index_user(self, user):
+        """Add a user to the name and uid indexes."""
+        self._name_index.setdefault(user.name, user)
+        if user.uid is not None:
+            self._uid_index.setdefault(user.uid, list()).append(user)
+
+    def _unindex_user(self, user):
+        """Remove a user from the name and uid indexes."""
+        if self._name_index.get(user.name) is user:
+            del self._name_index[user.name]
+            # Fall back to the next user sharing the name, if any
+            for other in self._user_list:
+                if other.name == user.name and other is not user:
+                    self._name_index[user.name] = other
+                    break
+        if user.uid is not None:
+            uid_matches = [other for other in self._uid_index.get(user.uid, list()) if other is not user]
+            if uid_matches:
+                self._uid_index[user.uid] = uid_matches
+            else:
+                self._uid_index.pop(user.uid, None)
+
+    def _reindex(self):
+        """Rebuild the name and uid indexes from the user list."""
+        self._name_index = dict()
+        self._uid_index = dict()
+        for user in self._user_list:
+            self._index_user(user)
+
     def __iter__(self):
         for user in self._user_list:
             yield user
@@ -118,10 +262,21 @@ class Users(MutableSequence):
         """Insert an instance of User into the collection."""
         self.check(value)
         self._user_list.insert(index, value)
+        self._index_user(value)
 
     def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            for user in value:
+                self.check(user)
+            self._user_list[index] = value
+            self._reindex()
+            return
         self.check(value)
+        replaced = self._user_list[index]
         self._user_list[index] = value
+        self._unindex_user(replaced)
+        self._index_user(value)
 
     def __repr__(self):
         user_list = ['{0}'.format(user) for user in self._user_list]
@@ -129,17 +284,54 @@ class Users(MutableSequence):
         return output
 
     def __delitem__(self, index):
+        if isinstance(index, slice):
+            del self._user_list[index]
+            self._reindex()
+            return
+        removed = self._user_list[index]
         del self._user_list[index]
+        self._unindex_user(removed)
 
     def remove(self, username=None):
         """Remove User instance based on supplied user name."""
+        if username not in self._name_index:
+            return
         self._user_list = [user for user in self._user_list if user.name != username]
+        self._reindex()
+
+    def digests(self):
+        """Return the digest of each user in the collection.
+
+        returns:
+            dict: user name to digest
+        """
+        return dict((user.name, user.digest) for user in self._user_list)
+
+    def names(self):
+        """Return the names of the users in the collection, as a set-like view."""
+        return viewkeys(self._name_index)
+
+    def uids(self):
+        """Return the uids of the users in the collection (excluding users without one), as a set-like view."""
+        return viewkeys(self._uid_index)
 
     def describe_users(self, users_filter=None):
-        """Return a list of users matching a filter (if provided)."""
-        user_list = Users(oktypes=User)
-        for user in self._user_list:
-            if users_filter and (users_filter.get('name') == user.name or users_filter.get('uid') == user.uid):
+        """Return a list of users matching a filter (if provided).
+
+        Lookups use the name and uid indexes, so the cost doesn't grow with the size of the collection.
+        Users without a uid are never matched by a uid filter.
+
+        returns:
+            list: the matching User instances (a plain list rather than a Users collection)
+        """
+        user_list = list()
+        if not users_filter:
+            return user_list
+        user_matching_name = self._name_index.get(users_filter.get('name'))
+        if user_matching_name:
+            user_list.append(user_matching_name)
+        for user in self._uid_index.get(users_filter.get('uid'), list()):
+            if user is not user_matching_name:
                 user_list.append(user)
         return user_list
 
@@ -149,59 +341,170 @@ class Users(MutableSequence):
         return cls.construct_user_list(raw_users=input_dict.get('users'))
 
     @classmethod
-    def from_yaml(cls, file_path=None):
-        """Create collection from a YAML file."""
-        try:
-            import yaml
-        except ImportError:  # pragma: no cover
-            yaml = None
-        if not yaml:
-            import sys
-            sys.exit('PyYAML is not installed, but is required in order to parse YAML files.'
-                     '\nTo install, run:\n$ pip install PyYAML\nor visit'
-                     ' http://pyyaml.org/wiki/PyYAML for instructions.')
+    def from_yaml(cls, file_path=None, compiled_cache=False):
+        """Create collection from a YAML file.
 
-        with io.open(file_path, encoding=text_type('utf-8')) as stream:
-            users_yaml = yaml.safe_load(stream)
-            if isinstance(users_yaml, dict):
-                return cls.construct_user_list(raw_users=users_yaml.get('users'))
-            else:
-                raise ValueError('No YAML object could be decoded')
+        args:
+            file_path (str): path to the YAML file
+            compiled_cache (bool): load the users from a compiled form of the file, kept alongside it, unless the
+                                   file has changed since it was compiled
+        """
+        if compiled_cache:
+            return cls.construct_user_list(raw_users=load_compiled_manifest(file_path=file_path,
+                                                                            parse=_parse_yaml_users))
+        users = Users(oktypes=User)
+        users.extend(cls.iter_from_yaml(file_path=file_path))
+        return users
+
+    @classmethod
+    def from_json(cls, file_path=None, compiled_cache=False):
+        """Create collection from a JSON file.
+
+        args:
+            file_path (str): path to the JSON file
+            compiled_cache (bool): load the users from a compiled form of the file, kept alongside it, unless the
+                                   file has changed since it was compiled
+        """
+        if compiled_cache:
+            return cls.construct_user_list(raw_users=load_compiled_manifest(file_path=file_path,
+                                                                            parse=_parse_json_users))
+        users = Users(oktypes=User)
+        users.extend(cls.iter_from_json(file_path=file_path))
+        return users
 
     @classmethod
-    def from_json(cls, file_path=None):
-        """Create collection from a JSON file."""
+    def iter_from_yaml(cls, file_path=None):
+        """Yield each user in a YAML file as it is parsed, without loading the whole document.
+
+        Users are yielded before the rest of the file is read, so a syntax error later in the file is only
+        raised once the users preceding it have been consumed.
+        """
+        yaml = _import_yaml()
         with io.open(file_path, encoding=text_type('utf-8')) as stream:
+            # The libyaml loader (CSafeLoader) can only compose whole documents, so the pure Python one is used
+            loader = yaml.SafeLoader(stream)
             try:
-                users_json = json.load(stream)
-            except ValueError:
+                loader.get_event()  # Start of stream
+                if not loader.check_event(yaml.DocumentStartEvent):
+                    raise ValueError('No YAML object could be decoded')
+                loader.get_event()
+                if not loader.check_event(yaml.MappingStartEvent):
+                    raise ValueError('No YAML object could be decoded')
+                loader.get_event()
+                # Compose and construct one top level value, or one user, at a time
+                while not loader.check_event(yaml.MappingEndEvent):
+                    key = loader.construct_document(loader.compose_node(None, None))
+                    if key == 'users' and loader.check_event(yaml.SequenceStartEvent):
+                        loader.get_event()
+                        while not loader.check_event(yaml.SequenceEndEvent):
+                            user_node = loader.compose_node(None, None)
+                            yield cls.construct_user(user_dict=loader.construct_document(user_node))
+                        loader.get_event()
+                    else:
+                        loader.compose_node(None, None)
+                loader.get_event()  # End of the mapping
+                document_end = loader.get_event()
+                # As safe_load does, refuse a stream of more than one document
+                if not loader.check_event(yaml.StreamEndEvent):
+                    raise yaml.composer.ComposerError('expected a single document in the stream',
+                                                      document_end.start_mark, 'but found another document',
+                                                      loader.get_event().start_mark)
+            finally:
+                loader.dispose()
+
+    @classmethod
+    def iter_from_json(cls, file_path=None):
+        """Yield each user in a JSON file as it is decoded, without loading the whole document.
+
+        Users are yielded before the rest of the file is read, so a syntax error later in the file is only
+        raised once the users preceding it have been consumed.
+        """
+        with io.open(file_path, encoding=text_type('utf-8')) as stream:
+            reader = _JSONReader(stream=stream)
+            reader.expect('{')
+            if reader.peek() == '}':
+                reader.expect('}')
+            else:
+                while True:
+                    key = reader.value()
+                    reader.expect(':')
+                    if key == 'users' and reader.peek() == '[':
+                        reader.expect('[')
+                        if reader.peek() == ']':
+                            reader.expect(']')
+                        else:
+                            while True:
+                                yield cls.construct_user(user_dict=reader.value())
+                                if reader.expect(',]') == ']':
+                                    break
+                    else:
+                        reader.value()
+                    if reader.expect(',}') == '}':
+                        break
+            # As json.load does, refuse anything after the object
+            if reader.peek():
                 raise ValueError('No JSON object could be decoded')
-            return cls.construct_user_list(raw_users=users_json.get('users'))
 
     @staticmethod
-    def from_passwd(uid_min=None, uid_max=None):
-        """Create collection from locally discovered data, e.g. /etc/passwd."""
-        import pwd
+    def from_passwd(uid_min=None, uid_max=None, root_path=None, use_nss=False, cache_path=None):
+        """Create collection from locally discovered data, e.g. /etc/passwd.
+
+        args:
+            uid_min (int): lowest uid to include
+            uid_max (int): highest uid to include
+            root_path (str): read the passwd file from an alternate filesystem root, e.g. a chroot
+            use_nss (bool): enumerate users through NSS (pwd.getpwall) instead of parsing the passwd file.
+                            This includes remote (e.g. LDAP or sssd) users and can be slow.
+            cache_path (str): location of a discovery cache. Files that haven't changed since the previous
+                              discovery are not read again.
+
+        returns:
+            Users: the discovered users
+        """
+        check_environment()
         users = Users(oktypes=User)
-        passwd_list = pwd.getpwall()
+        if root_path and not (uid_min and uid_max):
+            # The uid range is the image's own, not that of the system running creds
+            root_uid_min, root_uid_max = constants.login_defs(root_path=root_path)
+            uid_min = uid_min or root_uid_min
+            uid_max = uid_max or root_uid_max
         if not uid_min:
-            uid_min = UID_MIN
+            uid_min = constants.UID_MIN
         if not uid_max:
-            uid_max = UID_MAX
-        sudoers_entries = read_sudoers()
+            uid_max = constants.UID_MAX
+        discovery_cache = DiscoveryCache(path=cache_path, root_path=root_path) if cache_path else None
+        if use_nss:
+            if root_path:
+                raise ValueError('NSS enumeration cannot be combined with an alternate root path.')
+            import pwd
+            passwd_list = [pwd_entry for pwd_entry in pwd.getpwall() if uid_min <= pwd_entry.pw_uid <= uid_max]
+        elif discovery_cache:
+            passwd_list = discovery_cache.passwd_entries(uid_min=uid_min, uid_max=uid_max)
+        else:
+            passwd_list = list(read_passwd(root_path=root_path, uid_min=uid_min, uid_max=uid_max))
+        home_dirs = dict((pwd_entry.pw_name, rooted_path(pwd_entry.pw_dir, root_path=root_path))
+                         for pwd_entry in passwd_list)
+        with command_caller('discovery'):
+            if discovery_cache:
+                authorized_keys = discovery_cache.authorized_keys(home_dirs=home_dirs)
+                sudoers = discovery_cache.sudoers()
+            else:
+                authorized_keys = read_authorized_keys_bulk(home_dirs=home_dirs)
+                sudoers = load_sudoers(root_path=root_path)
         for pwd_entry in passwd_list:
-            if uid_min <= pwd_entry.pw_uid <= uid_max:
-                user = User(name=text_type(pwd_entry.pw_name),
-                            passwd=text_type(pwd_entry.pw_passwd),
-                            uid=pwd_entry.pw_uid,
-                            gid=pwd_entry.pw_gid,
-                            gecos=text_type(pwd_entry.pw_gecos),
-                            home_dir=text_type(pwd_entry.pw_dir),
-                            shell=text_type(pwd_entry.pw_shell),
-                            public_keys=read_authorized_keys(username=pwd_entry.pw_name),
-                            sudoers_entry=get_sudoers_entry(username=pwd_entry.pw_name,
-                                                            sudoers_entries=sudoers_entries))
-                users.append(user)
+            user = User(name=text_type(pwd_entry.pw_name),
+                        passwd=text_type(pwd_entry.pw_passwd),
+                        uid=pwd_entry.pw_uid,
+                        gid=pwd_entry.pw_gid,
+                        gecos=text_type(pwd_entry.pw_gecos),
+                        home_dir=text_type(pwd_entry.pw_dir),
+                        shell=text_type(pwd_entry.pw_shell),
+                        public_keys=authorized_keys.get(pwd_entry.pw_name),
+                        sudoers_entry=sudoers.get_entry(username=pwd_entry.pw_name))
+            users.append(user)
+        if discovery_cache:
+            discovery_cache.set_digests(digests=users.digests())
+            discovery_cache.save()
         return users
 
     @staticmethod
@@ -209,21 +512,26 @@ class Users(MutableSequence):
         """Construct a list of User objects from a list of dicts."""
         users = Users(oktypes=User)
         for user_dict in raw_users:
-            public_keys = None
-            if user_dict.get('public_keys'):
-                public_keys = [PublicKey(b64encoded=x, raw=None)
-                               for x in user_dict.get('public_keys')]
-            users.append(User(name=user_dict.get('name'),
-                              passwd=user_dict.get('passwd'),
-                              uid=user_dict.get('uid'),
-                              gid=user_dict.get('gid'),
-                              home_dir=user_dict.get('home_dir'),
-                              gecos=user_dict.get('gecos'),
-                              shell=user_dict.get('shell'),
-                              public_keys=public_keys,
-                              sudoers_entry=user_dict.get('sudoers_entry')))
+            users.append(Users.construct_user(user_dict=user_dict))
         return users
 
+    @staticmethod
+    def construct_user(user_dict=None):
+        """Construct a User object from a dict."""
+        public_keys = None
+        if user_dict.get('public_keys'):
+            public_keys = [PublicKey(b64encoded=x, raw=None)
+                           for x in user_dict.get('public_keys')]
+        return User(name=user_dict.get('name'),
+                    passwd=user_dict.get('passwd'),
+                    uid=user_dict.get('uid'),
+                    gid=user_dict.get('gid'),
+                    home_dir=user_dict.get('home_dir'),
+                    gecos=user_dict.get('gecos'),
+                    shell=user_dict.get('shell'),
+                    public_keys=public_keys,
+                    sudoers_entry=user_dict.get('sudoers_entry'))
+
     def to_dict(self):
         """ Return a dict of the users. """
         users = dict(users=list())
@@ -242,19 +550,22 @@ class Users(MutableSequence):
             return True
 
 
-def generate_add_user_command(proposed_user=None, manage_home=None):
+def generate_add_user_command(proposed_user=None, manage_home=None, root_path=None):
     """Generate command to add a user.
 
     args:
         proposed_user (User): User
         manage_home: bool
+        root_path (str): apply the change to an alternate filesystem root, e.g. a chroot or container image
 
     returns:
         list: The command string split into shell-like syntax
     """
     command = None
     if get_platform() in ('Linux', 'OpenBSD'):
-        command = '{0} {1}'.format(sudo_check(), LINUX_CMD_USERADD)
+        command = '{0} {1}'.format(sudo_check(), constants.LINUX_CMD_USERADD)
+        if root_path:
+            command = '{0} -R {1}'.format(command, root_path)
         if proposed_user.uid:
             command = '{0} -u {1}'.format(command, proposed_user.uid)
         if proposed_user.gid:
@@ -263,15 +574,18 @@ def generate_add_user_command(proposed_user=None, manage_home=None):
             command = '{0} -c \'{1}\''.format(command, proposed_user.gecos)
         if manage_home:
             if proposed_user.home_dir:
-                if os.path.exists(proposed_user.home_dir):
+                if os.path.exists(rooted_path(proposed_user.home_dir, root_path=root_path)):
                     command = '{0} -d {1}'.format(command, proposed_user.home_dir)
-            elif not os.path.exists('/home/{0}'.format(proposed_user.name)):
+            elif not os.path.exists(rooted_path('/home/{0}'.format(proposed_user.name), root_path=root_path)):
                 command = '{0} -m'.format(command)
         if proposed_user.shell:
             command = '{0} -s {1}'.format(command, proposed_user.shell)
         command = '{0} {1}'.format(command, proposed_user.name)
     elif get_platform() == 'FreeBSD':  # pragma: FreeBSD
-        command = '{0} {1} useradd'.format(sudo_check(), FREEBSD_CMD_PW)
+        command = '{0} {1}'.format(sudo_check(), constants.FREEBSD_CMD_PW)
+        if root_path:
+            command = '{0} -R {1}'.format(command, root_path)
+        command = '{0} useradd'.format(command)
         if proposed_user.uid:
             command = '{0} -u {1}'.format(command, proposed_user.uid)
         if proposed_user.gid:
@@ -291,11 +605,68 @@ def generate_add_user_command(proposed_user=None, manage_home=None):
         return shlex.split(str(command))
 
 
-def generate_modify_user_command(task=None, manage_home=None):
+def generate_newusers_entry(proposed_user=None, password=None):
+    """Generate the line newusers reads to create a user.
+
+    args:
+        proposed_user (User): User
+        password (str): the user's initial password, in clear text (newusers always sets one)
+
+    returns:
+        str: the line in passwd format, or None if the user's details can't be written as one
+    """
+    fields = [proposed_user.name, password, proposed_user.uid, proposed_user.gid,
+              # gecos is double quoted for the user commands; newusers takes it verbatim
+              proposed_user.gecos[1:-1] if proposed_user.gecos else None,
+              proposed_user.home_dir or '/home/{0}'.format(proposed_user.name), proposed_user.shell]
+    fields = ['' if field is None else text_type(field) for field in fields]
+    if any(':' in field or '\n' in field for field in fields):
+        return None
+    return ':'.join(fields)
+
+
+def generate_bulk_add_user_command(input_path=None, root_path=None):
+    """Generate command to add the users in a file of newusers lines, in a single run.
+
+    args:
+        input_path (str): file of lines generated by generate_newusers_entry
+        root_path (str): apply the change to an alternate filesystem root, e.g. a chroot or container image
+
+    returns:
+        list: The command, or None if the platform has no bulk equivalent of useradd
+    """
+    if get_platform() != 'Linux' or not constants.LINUX_CMD_NEWUSERS:
+        return None
+    command = '{0} {1}'.format(sudo_check(), constants.LINUX_CMD_NEWUSERS)
+    if root_path:
+        command = '{0} -R {1}'.format(command, root_path)
+    return command_with_input(command=shlex.split(str(command)), input_path=input_path)
+
+
+def generate_lock_passwords_command(input_path=None, root_path=None):
+    """Generate command to set the encrypted passwords in a file of name:password lines, e.g. ! to lock them.
+
+    args:
+        input_path (str): file of name:password lines
+        root_path (str): apply the change to an alternate filesystem root, e.g. a chroot or container image
+
+    returns:
+        list: The command, or None if the platform has no chpasswd
+    """
+    if get_platform() != 'Linux' or not constants.LINUX_CMD_CHPASSWD:
+        return None
+    command = '{0} {1} -e'.format(sudo_check(), constants.LINUX_CMD_CHPASSWD)
+    if root_path:
+        command = '{0} -R {1}'.format(command, root_path)
+    return command_with_input(command=shlex.split(str(command)), input_path=input_path)
+
+
+def generate_modify_user_command(task=None, manage_home=None, root_path=None):
     """Generate command to modify existing user to become the proposed user.
 
     args:
         task (dict): A proposed user and the differences between it and the existing user
+        root_path (str): apply the change to an alternate filesystem root, e.g. a chroot or container image
 
     returns:
         list: The command string split into shell-like syntax
@@ -304,7 +675,9 @@ def generate_modify_user_command(task=None, manage_home=None):
     comparison_result = task['user_comparison']['result']
     command = None
     if get_platform() in ('Linux', 'OpenBSD'):
-        command = '{0} {1}'.format(sudo_check(), LINUX_CMD_USERMOD)
+        command = '{0} {1}'.format(sudo_check(), constants.LINUX_CMD_USERMOD)
+        if root_path:
+            command = '{0} -R {1}'.format(command, root_path)
         if comparison_result.get('replacement_uid_value'):
             command = '{0} -u {1}'.format(command, comparison_result.get('replacement_uid_value'))
         if comparison_result.get('replacement_gid_value'):
@@ -317,7 +690,10 @@ def generate_modify_user_command(task=None, manage_home=None):
                 command = '{0} -d {1}'.format(command, comparison_result.get('replacement_home_dir_value'))
         command = '{0} {1}'.format(command, name)
     if get_platform() == 'FreeBSD':  # pragma: FreeBSD
-        command = '{0} {1} usermod'.format(sudo_check(), FREEBSD_CMD_PW)
+        command = '{0} {1}'.format(sudo_check(), constants.FREEBSD_CMD_PW)
+        if root_path:
+            command = '{0} -R {1}'.format(command, root_path)
+        command = '{0} usermod'.format(command)
         if comparison_result.get('replacement_uid_value'):
             command = '{0} -u {1}'.format(command, comparison_result.get('replacement_uid_value'))
         if comparison_result.get('replacement_gid_value'):
@@ -333,23 +709,26 @@ def generate_modify_user_command(task=None, manage_home=None):
         return shlex.split(str(command))
 
 
-def generate_delete_user_command(username=None, manage_home=None):
+def generate_delete_user_command(username=None, manage_home=None, root_path=None):
     """Generate command to delete a user.
 
     args:
         username (str): user name
         manage_home (bool): manage home directory
+        root_path (str): apply the change to an alternate filesystem root, e.g. a chroot or container image
 
     returns:
         list: The user delete command string split into shell-like syntax
     """
     command = None
     remove_home = '-r' if manage_home else ''
+    root = '-R {0}'.format(root_path) if root_path else ''
 
     if get_platform() in ('Linux', 'OpenBSD'):
-        command = '{0} {1} {2} {3}'.format(sudo_check(), LINUX_CMD_USERDEL, remove_home, username)
+        command = '{0} {1} {2} {3} {4}'.format(sudo_check(), constants.LINUX_CMD_USERDEL, root, remove_home, username)
     elif get_platform() == 'FreeBSD':  # pragma: FreeBSD
-        command = '{0} {1} userdel {2} -n {3}'.format(sudo_check(), FREEBSD_CMD_PW, remove_home, username)
+        command = '{0} {1} {2} userdel {3} -n {4}'.format(sudo_check(), constants.FREEBSD_CMD_PW, root, remove_home,
+                                                          username)
     if command:
         return shlex.split(str(command))
 
@@ -414,9 +793,7 @@ def compare_user(passed_user=None, user_list=None):
     # Check if existing and passed keys exist, and if so, compare
     if all((existing_keys, passed_keys)) and len(existing_keys) == len(passed_user.public_keys):
         # Compare each key, and if any differences, replace
-        existing = set(key.raw for key in existing_keys)
-        replacement = set(key.raw for key in passed_keys)
-        if set.difference(existing, replacement):
+        if set(existing_keys).difference(passed_keys):
             replace_keys = True
     # If not existing keys but keys passed set, then
     elif passed_keys and not existing_keys:
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-from typing import List, Dict, AnyStr, Optional, Any, MutableSequence
+import json
+from typing import List, Dict, AnyStr, Optional, Any, Iterator, KeysView, MutableSequence, TextIO
 
 from creds.ssh import PublicKey
 
@@ -18,18 +19,58 @@ class User(object):
         self.shell = shell
         self.public_keys = public_keys
         self.sudoers_entry = sudoers_entry
+        self._digest = None
 
     def gecos(self) -> str: pass
 
+    @property
+    def digest(self) -> str: pass
+
     def to_dict(self) -> dict: pass
 
 
+JSON_CHUNK_SIZE: int
+JSON_NUMBER_CHARACTERS: str
+
+
+def _import_yaml() -> Any: pass
+
+
+def _parse_yaml_users(source: str) -> List[Dict]: pass
+
+
+def _parse_json_users(source: str) -> List[Dict]: pass
+
+
+class _JSONReader(object):
+    def __init__(self, stream: TextIO) -> None:
+        self.stream = stream
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool: pass
+
+    def peek(self) -> str: pass
+
+    def expect(self, characters: str) -> str: pass
+
+    def value(self) -> Any: pass
+
+
 class Users(MutableSequence):
     def __init__(self) -> None:
         self._user_list = list()
         self.oktypes = User
 
-    def describe_users(self, users_filter: Dict) -> List: pass
+    def digests(self) -> Dict[str, str]: pass
+
+    def names(self) -> KeysView[str]: pass
+
+    def uids(self) -> KeysView[int]: pass
+
+    def describe_users(self, users_filter: Dict) -> List[User]: pass
 
     def check(self, value: Any) -> None: pass
 
@@ -51,25 +92,47 @@ class Users(MutableSequence):
     def from_dict(cls, input_dict: Dict) -> List: pass
 
     @classmethod
-    def from_yaml(cls, file_path: str) -> List: pass
+    def from_yaml(cls, file_path: str, compiled_cache: bool) -> List: pass
+
+    @classmethod
+    def from_json(cls, file_path: str, compiled_cache: bool) -> List: pass
 
     @classmethod
-    def from_json(cls, file_path: str) -> List: pass
+    def iter_from_yaml(cls, file_path: str) -> Iterator[User]: pass
+
+    @classmethod
+    def iter_from_json(cls, file_path: str) -> Iterator[User]: pass
 
     @staticmethod
-    def from_passwd(uid_min: int, uid_max: int) -> Users: pass
+    def from_passwd(uid_min: int, uid_max: int, root_path: Optional[str], use_nss: bool,
+                    cache_path: Optional[str]) -> Users: pass
 
     @staticmethod
     def construct_user_list(raw_users: dict) -> Users: pass
 
+    @staticmethod
+    def construct_user(user_dict: Dict) -> User: pass
+
+
+def generate_add_user_command(proposed_user: User, manage_home: bool, root_path: Optional[str]) -> List[str]: pass
+
+
+def generate_newusers_entry(proposed_user: User, password: str) -> Optional[str]: pass
+
+
+def generate_bulk_add_user_command(input_path: str, root_path: Optional[str]) -> Optional[List[str]]: pass
+
+
+def generate_lock_passwords_command(input_path: str, root_path: Optional[str]) -> Optional[List[str]]: pass
+
 
-def generate_add_user_command(proposed_user: User, manage_home: bool) -> List[str]: pass
+def generate_modify_user_command(task: dict, manage_home: bool, root_path: Optional[str]) -> List[str]: pass
 
 
-def generate_modify_user_command(task: dict) -> List[str]: pass
+def generate_delete_user_command(username: str, manage_home: bool, root_path: Optional[str]) -> List[str]: pass
 
 
 def compare_user(passed_user: User, user_list=Users) -> Dict: pass
 
 
-def get_user_by_uid(uid: int, users: Users) -> Users: pass
+def get_user_by_uid(uid: int, users: Users) -> List[User]: pass
@@ -3,16 +3,25 @@
 
 from __future__ import unicode_literals
 
+import atexit
 import base64
+import errno
+import io
+import json
 import os
 import platform
 import random
 import shlex
 import string
 import subprocess
-
-from creds.constants import (CMD_SUDO, RANDOM_FILE_EXT_LENGTH, LINUX_CMD_GROUP_ADD, LINUX_CMD_GROUP_DEL,
-                             LINUX_CMD_USERADD, LINUX_CMD_USERDEL, LINUX_CMD_USERMOD, FREEBSD_CMD_PW, LINUX_CMD_VISUDO)
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from creds import constants
+from creds.constants import RANDOM_FILE_EXT_LENGTH, SUDOERS_PATH, SUPPORTED_PLATFORMS
+from creds.helper import active_helper
 from external.six import (PY2, PY3, text_type)
 
 
@@ -20,7 +29,7 @@ def sudo_check():
     """Return the string 'sudo' if current user isn't root."""
     sudo_cmd = ''
     if os.geteuid() != 0:
-        sudo_cmd = CMD_SUDO
+        sudo_cmd = constants.CMD_SUDO
     return sudo_cmd
 
 
@@ -33,31 +42,252 @@ def get_missing_commands(_platform):
     """Check I can identify the necessary commands for managing users."""
     missing = list()
     if _platform in ('Linux', 'OpenBSD'):
-        if not LINUX_CMD_USERADD:
+        if not constants.LINUX_CMD_USERADD:
             missing.append('useradd')
-        if not LINUX_CMD_USERMOD:
+        if not constants.LINUX_CMD_USERMOD:
             missing.append('usermod')
-        if not LINUX_CMD_USERDEL:
+        if not constants.LINUX_CMD_USERDEL:
             missing.append('userdel')
-        if not LINUX_CMD_GROUP_ADD:
+        if not constants.LINUX_CMD_GROUP_ADD:
             missing.append('groupadd')
-        if not LINUX_CMD_GROUP_DEL:
+        if not constants.LINUX_CMD_GROUP_DEL:
             missing.append('groupdel')
     elif _platform == 'FreeBSD':  # pragma: FreeBSD
         # FREEBSD COMMANDS
-        if not FREEBSD_CMD_PW:
+        if not constants.FREEBSD_CMD_PW:
             missing.append('pw')
     if missing:
         print('\nMISSING = {0}'.format(missing))
     return missing
 
 
+_CHECKED_PLATFORMS = set()
+
+
+def check_environment():
+    """Check the platform is supported and has the commands for managing users. Each platform is checked once.
+
+    raises:
+        OSError: if the platform isn't supported or commands are missing.
+    """
+    platform = get_platform()
+    if platform in _CHECKED_PLATFORMS:
+        return
+    if platform not in SUPPORTED_PLATFORMS:
+        raise OSError('Linux, FreeBSD and OpenBSD are currently the only supported platforms for this library.')
+    missing_commands = get_missing_commands(platform)
+    if missing_commands:
+        raise OSError('Unable to find commands: {0}.\nPlease check PATH.'.format(', '.join(missing_commands)))
+    _CHECKED_PLATFORMS.add(platform)
+
+
+_COMMAND_RECORDER = threading.local()
+_COMMAND_CALLER = threading.local()
+
+
+@contextmanager
+def record_commands():
+    """Collect the commands run by execute_command in this thread while the context is active.
+
+    returns:
+        list: a dict for each command with the command, its exit code, stderr and wall-clock time in seconds
+    """
+    previous = getattr(_COMMAND_RECORDER, 'commands', None)
+    commands = _COMMAND_RECORDER.commands = list()
+    try:
+        yield commands
+    finally:
+        _COMMAND_RECORDER.commands = previous
+
+
+@contextmanager
+def command_caller(caller=None):
+    """Attribute the commands run by this thread while the context is active to a caller.
+
+    args:
+        caller (str): the stage running the commands, i.e. discovery, planning or execution
+    """
+    previous = getattr(_COMMAND_CALLER, 'caller', None)
+    _COMMAND_CALLER.caller = caller
+    try:
+        yield
+    finally:
+        _COMMAND_CALLER.caller = previous
+
+
+def current_caller():
+    """Return the caller the commands run by this thread are attributed to, or None."""
+    return getattr(_COMMAND_CALLER, 'caller', None)
+
+
+class CommandRunner(object):
+    """Runs the commands passed to execute_command. Subclasses can change how commands are run or observe them."""
+
+    def run(self, command=None):
+        """Run a command.
+
+        Commands run with sudo are passed to the privileged helper instead, if it has been started.
+
+        args:
+            command (list): the command and its arguments
+
+        returns:
+            tuple: ((stdout, stderr), returncode)
+        """
+        helper = active_helper()
+        if helper is not None and constants.CMD_SUDO and command and command[0] == constants.CMD_SUDO:
+            return helper.execute(command=command[1:])
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        process.wait()
+        return (stdout, stderr), process.returncode
+
+
+class TracingRunner(CommandRunner):
+    """Runs commands as CommandRunner does, writing a line of JSON to a trace file for each one.
+
+    Each line records the command, its caller, duration in seconds and exit code. A summary of the commands run
+    by each caller is written when the runner is closed, which happens at exit.
+    """
+
+    def __init__(self, trace_path=None, summary_stream=None):
+        """Create a tracing runner.
+
+        args:
+            trace_path (str): file the trace is appended to
+            summary_stream (file): stream the summary is written to (defaults to stderr)
+        """
+        self.trace_path = trace_path
+        self.summary_stream = summary_stream
+        self.lock = threading.Lock()
+        self.totals = dict()
+        self.trace_file = io.open(trace_path, mode='a', encoding='utf-8')
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return '<TracingRunner {0}>'.format(self.trace_path)
+
+    def run(self, command=None):
+        start = time.time()
+        output, returncode = super(TracingRunner, self).run(command=command)
+        duration = time.time() - start
+        caller = current_caller() or 'unknown'
+        line = json.dumps(dict(argv=list(command), caller=caller, duration=duration, returncode=returncode,
+                               time=start))
+        with self.lock:
+            if not self.trace_file.closed:
+                self.trace_file.write('{0}\n'.format(line))
+                self.trace_file.flush()
+            count, total_duration = self.totals.get(caller, (0, 0.0))
+            self.totals[caller] = (count + 1, total_duration + duration)
+        return output, returncode
+
+    def summary(self):
+        """Return the number of commands run and their total duration in seconds, by caller.
+
+        returns:
+            dict: caller to a (count, duration) tuple
+        """
+        with self.lock:
+            return dict(self.totals)
+
+    def close(self):
+        """Close the trace file and write the summary, once."""
+        with self.lock:
+            if self.trace_file.closed:
+                return
+            self.trace_file.close()
+        totals = self.summary()
+        summary_stream = self.summary_stream or sys.stderr
+        summary_stream.write('creds: {0} commands in {1:.3f}s, traced to {2}\n'.format(
+            sum(count for count, _ in totals.values()), sum(duration for _, duration in totals.values()),
+            self.trace_path))
+        for caller in sorted(totals):
+            summary_stream.write('creds:   {0:<12}{1:>8} commands {2:>10.3f}s\n'.format(caller, *totals[caller]))
+
+
+_COMMAND_RUNNER = CommandRunner()
+
+
+def set_command_runner(runner=None):
+    """Replace the runner used by execute_command.
+
+    args:
+        runner (CommandRunner): the new runner (the default runner if None)
+
+    returns:
+        CommandRunner: the previous runner
+    """
+    global _COMMAND_RUNNER
+    previous, _COMMAND_RUNNER = _COMMAND_RUNNER, runner if runner is not None else CommandRunner()
+    return previous
+
+
 def execute_command(command=None):
-    """Execute a command and return the stdout and stderr."""
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stdin = process.communicate()
-    process.wait()
-    return (stdout, stdin), process.returncode
+    """Execute a command and return the stdout and stderr.
+
+    Commands are run by the runner set with set_command_runner, which passes commands run with sudo to the
+    privileged helper, if it has been started.
+    """
+    start = time.time()
+    output, returncode = _COMMAND_RUNNER.run(command=command)
+    commands = getattr(_COMMAND_RECORDER, 'commands', None)
+    if commands is not None:
+        commands.append(dict(command=list(command), returncode=returncode,
+                             stderr=output[1].decode('utf-8', 'replace'), elapsed=time.time() - start))
+    return output, returncode
+
+
+def command_with_input(command=None, input_path=None):
+    """Return a command that runs the command provided with its standard input read from a file.
+
+    The redirection is made by sh, so it also applies when the command is run with sudo or by the privileged
+    helper.
+
+    args:
+        command (list): the command and its arguments, including any sudo prefix
+        input_path (str): file to read standard input from
+
+    returns:
+        list: the wrapped command
+    """
+    prefix = list()
+    if command and constants.CMD_SUDO and command[0] == constants.CMD_SUDO:
+        prefix, command = [command[0]], command[1:]
+    return prefix + ['sh', '-c', 'input_path="$1"; shift; exec "$@" < "$input_path"', 'sh', input_path] + list(command)
+
+
+def rooted_path(path=None, root_path=None):
+    """Return the path as seen from an alternate filesystem root.
+
+    args:
+        path (str): absolute path on the target system
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
+
+    returns:
+        str: the path prefixed with the root (unchanged if no root provided)
+    """
+    if not root_path:
+        return path
+    return os.path.join(root_path, path.lstrip(os.sep))
+
+
+def file_signature(path=None):
+    """Return the details used to detect a change to a file or directory.
+
+    args:
+        path (str): path to the file or directory.
+
+    returns:
+        tuple: (path, mtime, inode, size), (path, None) if it doesn't exist or None if it can't be checked.
+    """
+    try:
+        stat_result = os.stat(path)
+    except OSError as error:
+        if error.errno in (errno.ENOENT, errno.ENOTDIR):
+            return path, None
+        return None
+    return path, stat_result.st_mtime, stat_result.st_ino, stat_result.st_size
 
 
 def random_string(length=None):
@@ -91,16 +321,31 @@ def base64decode(_input=None):
             return base64.b64decode(bytearray(_input, encoding='UTF-8')).decode('UTF-8')
 
 
-def read_sudoers():
+def sudoers_line_user(line=None):
+    """Return the user a sudoers line applies to, i.e. its first token.
+
+    args:
+        line (str): a line from the sudoers file.
+
+    returns:
+        str: the first token of the line, or None for blank lines.
+    """
+    tokens = line.split(None, 1)
+    if tokens:
+        return tokens[0]
+
+
+def read_sudoers(root_path=None):
     """ Read the sudoers entry for the specified user.
 
     args:
         username (str): username.
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
 
     returns:`r
         str: sudoers entry for the specified user.
     """
-    sudoers_path = '/etc/sudoers'
+    sudoers_path = rooted_path(SUDOERS_PATH, root_path=root_path)
     rnd_chars = random_string(length=RANDOM_FILE_EXT_LENGTH)
     tmp_sudoers_path = '/tmp/sudoers_{0}'.format(rnd_chars)
     sudoers_entries = list()
@@ -118,17 +363,18 @@ def read_sudoers():
     return sudoers_entries
 
 
-def write_sudoers_entry(username=None, sudoers_entry=None):
+def write_sudoers_entry(username=None, sudoers_entry=None, root_path=None):
     """Write sudoers entry.
 
     args:
         user (User): Instance of User containing sudoers entry.
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
 
     returns:
         str: sudoers entry for the specified user.
     """
 
-    sudoers_path = '/etc/sudoers'
+    sudoers_path = rooted_path(SUDOERS_PATH, root_path=root_path)
     rnd_chars = random_string(length=RANDOM_FILE_EXT_LENGTH)
     tmp_sudoers_path = '/tmp/sudoers_{0}'.format(rnd_chars)
     execute_command(
@@ -139,7 +385,7 @@ def write_sudoers_entry(username=None, sudoers_entry=None):
         sudoers_entries = tmp_sudoers_file.readlines()
     sudoers_output = list()
     for entry in sudoers_entries:
-        if entry and not entry.startswith(username):
+        if entry and sudoers_line_user(entry) != username:
             sudoers_output.append(entry)
     if sudoers_entry:
         sudoers_output.append('{0} {1}'.format(username, sudoers_entry))
@@ -147,7 +393,7 @@ def write_sudoers_entry(username=None, sudoers_entry=None):
     with open(tmp_sudoers_path, mode=text_type('w+')) as tmp_sudoers_file:
         tmp_sudoers_file.writelines(sudoers_output)
     sudoers_check_result = execute_command(
-        shlex.split(str('{0} {1} -cf {2}'.format(sudo_check(), LINUX_CMD_VISUDO, tmp_sudoers_path))))
+        shlex.split(str('{0} {1} -cf {2}'.format(sudo_check(), constants.LINUX_CMD_VISUDO, tmp_sudoers_path))))
     if sudoers_check_result[1] > 0:
         raise ValueError(sudoers_check_result[0][1])
     execute_command(
@@ -157,16 +403,17 @@ def write_sudoers_entry(username=None, sudoers_entry=None):
     execute_command(shlex.split(str('{0} rm {1}'.format(sudo_check(), tmp_sudoers_path))))
 
 
-def remove_sudoers_entry(username=None):
+def remove_sudoers_entry(username=None, root_path=None):
     """Remove sudoers entry.
 
     args:
         user (User): Instance of User containing sudoers entry.
+        root_path (str): alternate filesystem root, e.g. a chroot or container image
 
     returns:
         str: sudoers entry for the specified user.
     """
-    sudoers_path = '/etc/sudoers'
+    sudoers_path = rooted_path(SUDOERS_PATH, root_path=root_path)
     rnd_chars = random_string(length=RANDOM_FILE_EXT_LENGTH)
     tmp_sudoers_path = '/tmp/sudoers_{0}'.format(rnd_chars)
     execute_command(
@@ -177,7 +424,7 @@ def remove_sudoers_entry(username=None):
         sudoers_entries = tmp_sudoers_file.readlines()
     sudoers_output = list()
     for entry in sudoers_entries:
-        if not entry.startswith(username):
+        if sudoers_line_user(entry) != username:
             sudoers_output.append(entry)
     with open(tmp_sudoers_path, mode=text_type('w+')) as tmp_sudoers_file:
         tmp_sudoers_file.writelines(sudoers_output)
@@ -199,5 +446,10 @@ def get_sudoers_entry(username=None, sudoers_entries=None):
         str: sudoers entry for the specified user.
     """
     for entry in sudoers_entries:
-        if entry.startswith(username):
-            return entry.replace(username, '').strip()
+        tokens = entry.split(None, 1)
+        if tokens and tokens[0] == username:
+            return tokens[1].strip() if len(tokens) > 1 else ''
+
+
+if os.environ.get('CREDS_TRACE'):  # pragma: no cover
+    set_command_runner(TracingRunner(trace_path=os.environ['CREDS_TRACE']))
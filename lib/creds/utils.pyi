@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
-from typing import Tuple, List, Optional, Union
+import io
+import threading
+from typing import ContextManager, Dict, Tuple, List, Optional, TextIO, Union
 
 
 def sudo_check() -> str: pass
@@ -12,9 +14,52 @@ def get_platform() -> str: pass
 def get_missing_commands(_platform: str) -> List: pass
 
 
+def check_environment() -> None: pass
+
+
+def record_commands() -> ContextManager[List[dict]]: pass
+
+
+def command_caller(caller: Optional[str]) -> ContextManager[None]: pass
+
+
+def current_caller() -> Optional[str]: pass
+
+
+class CommandRunner(object):
+    def run(self, command: List[str]) -> Tuple[Tuple[bytes, bytes], int]: pass
+
+
+class TracingRunner(CommandRunner):
+    def __init__(self, trace_path: str, summary_stream: Optional[TextIO]) -> None:
+        self.trace_path = trace_path
+        self.summary_stream = summary_stream
+        self.lock = threading.Lock()
+        self.totals = dict()
+        self.trace_file = io.open(trace_path, mode='a', encoding='utf-8')
+
+    def run(self, command: List[str]) -> Tuple[Tuple[bytes, bytes], int]: pass
+
+    def summary(self) -> Dict[str, Tuple[int, float]]: pass
+
+    def close(self) -> None: pass
+
+
+def set_command_runner(runner: Optional[CommandRunner]) -> CommandRunner: pass
+
+
 def execute_command(command: List) -> Tuple: pass
 
 
+def command_with_input(command: List[str], input_path: str) -> List[str]: pass
+
+
+def rooted_path(path: str, root_path: Optional[str]) -> str: pass
+
+
+def file_signature(path: str) -> Optional[Tuple]: pass
+
+
 def random_string(length: Optional[int]) -> str: pass
 
 
@@ -24,13 +69,16 @@ def base64encode(_input: Union[bytes, str]) -> str: pass
 def base64decode(_input: Union[bytes, str]) -> str: pass
 
 
-def remove_sudoers_entry(username=Optional[str]) -> None: pass
+def remove_sudoers_entry(username=Optional[str], root_path=Optional[str]) -> None: pass
+
+
+def write_sudoers_entry(username=Optional[str], sudoers_entry=Optional[str], root_path=Optional[str]) -> None: pass
 
 
-def write_sudoers_entry(username=Optional[str], sudoers_entry=Optional[str]) -> None: pass
+def sudoers_line_user(line: str) -> Optional[str]: pass
 
 
-def read_sudoers() -> List: pass
+def read_sudoers(root_path=Optional[str]) -> List: pass
 
 
 def get_sudoers_entry(username=Optional[str], sudoers_entries=List) -> str: pass
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+import marshal
+import os
+
+import pytest
+
+from creds.cache import (DiscoveryCache, compiled_manifest_path, load_compiled_manifest)
+from creds.users import Users
+from .sample_data import PUBLIC_KEYS
+
+
+@pytest.fixture
+def root(tmpdir):
+    etc = tmpdir.mkdir('etc')
+    etc.join('passwd').write('bob:x:1001:1001::/home/bob:/bin/sh\njane:x:1002:1002::/home/jane:/bin/sh\n')
+    etc.join('sudoers').write('bob ALL=(ALL) ALL\n')
+    home = tmpdir.mkdir('home')
+    for index, username in enumerate(('bob', 'jane')):
+        keys_file = home.mkdir(username).mkdir('.ssh').join('authorized_keys')
+        keys_file.write('{0}\n'.format(PUBLIC_KEYS[index]['raw']))
+    return tmpdir
+
+
+def discover(root, cache_path):
+    return Users.from_passwd(uid_min=1000, uid_max=60000, root_path=root.strpath, cache_path=cache_path)
+
+
+def test_discovery_cache_reuses_unchanged_users(root, tmpdir):
+    cache_path = tmpdir.join('discovery.json').strpath
+    users = discover(root, cache_path)
+    cached_users = discover(root, cache_path)
+    assert [user.name for user in cached_users] == [user.name for user in users]
+    assert cached_users[0].public_keys == users[0].public_keys
+    assert cached_users[0].sudoers_entry == 'ALL=(ALL) ALL'
+    cache = DiscoveryCache(path=cache_path, root_path=root.strpath)
+    cache.authorized_keys(home_dirs=dict(bob=root.join('home', 'bob').strpath,
+                                         jane=root.join('home', 'jane').strpath))
+    assert (cache.hits, cache.misses) == (2, 0)
+    assert cache.digests() == users.digests()
+
+
+def test_discovery_cache_rereads_changed_sources(root, tmpdir):
+    cache_path = tmpdir.join('discovery.json').strpath
+    discover(root, cache_path)
+    root.join('home', 'jane', '.ssh', 'authorized_keys').write('{0}\n'.format(PUBLIC_KEYS[2]['raw']))
+    root.join('etc', 'sudoers').write('jane ALL=(ALL) ALL\n')
+    root.join('etc', 'passwd').write('jane:x:1002:1002::/home/jane:/bin/bash\n')
+    users = discover(root, cache_path)
+    assert len(users) == 1
+    assert users[0].shell == '/bin/bash'
+    assert users[0].public_keys[0].raw == PUBLIC_KEYS[2]['raw']
+    assert users[0].sudoers_entry == 'ALL=(ALL) ALL'
+
+
+def test_discovery_cache_ignores_other_roots(root, tmpdir):
+    cache_path = tmpdir.join('discovery.json').strpath
+    discover(root, cache_path)
+    assert DiscoveryCache(path=cache_path, root_path=root.strpath).data['passwd']
+    assert not DiscoveryCache(path=cache_path, root_path='/other').data['passwd']
+
+
+def test_discovery_cache_must_be_private(root, tmpdir):
+    """ A cache someone else could have written is ignored, and cached users outside the uid range are dropped. """
+    cache_path = tmpdir.join('discovery.json')
+    discover(root, cache_path.strpath)
+    cache = DiscoveryCache(path=cache_path.strpath, root_path=root.strpath)
+    cache.data['passwd']['entries'].insert(0, ['root', 'x', 0, 0, 'root', '/root', '/bin/sh'])
+    cache.save()
+    assert [user.name for user in discover(root, cache_path.strpath)] == ['bob', 'jane']
+    cache.save()
+    cache_path.chmod(0o666)
+    assert not DiscoveryCache(path=cache_path.strpath, root_path=root.strpath).data['passwd']
+    planted = tmpdir.join('planted.json')
+    cache_path.move(planted)
+    planted.chmod(0o600)
+    cache_path.mksymlinkto(planted)
+    assert not DiscoveryCache(path=cache_path.strpath, root_path=root.strpath).data['passwd']
+
+
+@pytest.mark.parametrize('manifest_format', ['yaml', 'json'])
+def test_compiled_manifest_is_used_until_manifest_changes(tmpdir, manifest_format):
+    manifest = tmpdir.join('users.{0}'.format(manifest_format))
+    users = Users.from_dict(dict(users=[dict(name='bob', uid=1001, public_keys=[PUBLIC_KEYS[0]['encoded']])]))
+    users.export(file_path=manifest.strpath, export_format=manifest_format)
+    load = Users.from_yaml if manifest_format == 'yaml' else Users.from_json
+    assert [user.to_dict() for user in load(file_path=manifest.strpath, compiled_cache=True)] == \
+        [user.to_dict() for user in users]
+    assert tmpdir.join('.users.{0}.creds-cache'.format(manifest_format)).check()
+
+    parsed = list()
+
+    def parse(source):
+        parsed.append(source)
+        return list()
+
+    assert load_compiled_manifest(file_path=manifest.strpath, parse=parse)[0]['name'] == 'bob'
+    assert parsed == []
+    users.append(Users.construct_user(user_dict=dict(name='jane', uid=1002)))
+    users[1].public_keys = list()
+    users.export(file_path=manifest.strpath, export_format=manifest_format)
+    assert [user.name for user in load(file_path=manifest.strpath, compiled_cache=True)] == ['bob', 'jane']
+
+
+def test_compiled_manifest_must_be_private(tmpdir):
+    """ A compiled form that someone else could have written is ignored, even if its key matches. """
+    manifest = tmpdir.join('users.yml')
+    manifest.write('users: []\n')
+    cache = tmpdir.join(os.path.basename(compiled_manifest_path(file_path=manifest.strpath)))
+
+    def parse(source):
+        return list()
+
+    load_compiled_manifest(file_path=manifest.strpath, parse=parse)
+    key = marshal.loads(cache.read_binary())[0]
+    injected = marshal.dumps((key, [dict(name='mallory')]))
+    cache.write_binary(injected)
+    cache.chmod(0o666)
+    assert load_compiled_manifest(file_path=manifest.strpath, parse=parse) == []
+    planted = tmpdir.join('planted')
+    planted.write_binary(injected)
+    cache.remove()
+    cache.mksymlinkto(planted)
+    assert load_compiled_manifest(file_path=manifest.strpath, parse=parse) == []
+    cache.remove()
+    cache.write_binary(injected)
+    cache.chmod(0o600)
+    assert load_compiled_manifest(file_path=manifest.strpath, parse=parse) == [dict(name='mallory')]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+import sys
+
+import pytest
+from creds import constants
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='constants are discovered on import')
+def test_constants_are_discovered_on_first_use(monkeypatch, tmpdir):
+    tmpdir.join('grep').write('')
+    monkeypatch.setenv('PATH', tmpdir.strpath)
+    for name in ('CMD_GREP', 'UID_MIN', 'UID_MAX'):
+        # Recorded first, so the discovered values are removed again afterwards
+        monkeypatch.setitem(vars(constants), name, None)
+        monkeypatch.delitem(vars(constants), name)
+    assert constants.CMD_GREP == tmpdir.join('grep').strpath
+    assert 'CMD_GREP' in vars(constants)
+    assert constants.UID_MIN <= constants.UID_MAX
+    assert 'UID_MAX' in vars(constants)
+    with pytest.raises(AttributeError):
+        constants.NOT_A_CONSTANT
+
+
+def test_find_executable(monkeypatch, tmpdir):
+    tmpdir.join('useradd').write('')
+    monkeypatch.setenv('PATH', tmpdir.strpath)
+    assert constants.find_executable('useradd') == tmpdir.join('useradd').strpath
+    assert constants.find_executable('missing') is None
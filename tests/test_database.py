@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+import fcntl
+import os
+
+import pytest
+
+from creds.database import (AccountDatabase, get_passwd_entry, lock_account_database, open_account_database,
+                            read_passwd, read_shadow)
+from creds.users import (Users, User)
+
+PASSWD = """root:x:0:0:root:/root:/bin/bash
+# a comment
++nisuser::::::
+bob:x:1001:1001:Bob Smith:/home/bob:/bin/sh
+bobby:x:1002:1002::/home/bobby:/bin/false
+broken:x:notanumber:1003::/home/broken:/bin/sh
+nobody:x:65534:65534:nobody:/nonexistent:/usr/sbin/nologin
+"""
+
+SHADOW = """root:*:17000:0:99999:7:::
+bob:$6$salt$hash:17000:0:99999:7:::
+bobby:!:17000:0:99999:7:::
+"""
+
+GROUP = """root:x:0:
+bob:x:1001:
+bobby:x:1002:
+admins:x:2000:bob,bobby
+"""
+
+
+@pytest.fixture
+def root(tmpdir):
+    etc = tmpdir.mkdir('etc')
+    etc.join('passwd').write(PASSWD)
+    etc.join('shadow').write(SHADOW)
+    return tmpdir
+
+
+@pytest.fixture
+def writable_root(root):
+    root.join('etc', 'group').write(GROUP)
+    root.join('etc', 'login.defs').write('UID_MIN 1000\nUID_MAX 60000\n')
+    skel = root.join('etc').mkdir('skel')
+    skel.join('.profile').write('umask 022\n')
+    os.symlink('.profile', skel.join('.bashrc').strpath)
+    return root
+
+
+def test_read_passwd_filters_by_uid(root):
+    entries = list(read_passwd(root_path=root.strpath, uid_min=1000, uid_max=60000))
+    assert [entry.pw_name for entry in entries] == ['bob', 'bobby']
+    assert entries[0].pw_uid == 1001
+    assert entries[0].pw_gid == 1001
+    assert entries[0].pw_gecos == 'Bob Smith'
+    assert entries[0].pw_dir == '/home/bob'
+    assert entries[0].pw_shell == '/bin/sh'
+
+
+def test_read_passwd_without_range(root):
+    names = [entry.pw_name for entry in read_passwd(root_path=root.strpath)]
+    assert names == ['root', 'bob', 'bobby', 'nobody']
+
+
+def test_read_shadow(root):
+    entries = list(read_shadow(root_path=root.strpath, usernames=set(['bob'])))
+    assert len(entries) == 1
+    assert entries[0].sp_namp == 'bob'
+    assert entries[0].sp_pwdp == '$6$salt$hash'
+
+
+def test_users_from_passwd_with_root_path(root):
+    users = Users.from_passwd(uid_min=1000, uid_max=60000, root_path=root.strpath)
+    assert [user.name for user in users] == ['bob', 'bobby']
+    assert isinstance(users[0], User)
+
+
+def test_users_from_passwd_nss_rejects_root_path(root):
+    with pytest.raises(ValueError):
+        Users.from_passwd(root_path=root.strpath, use_nss=True)
+
+
+def test_get_passwd_entry_reads_the_file_once(root, monkeypatch):
+    """ Lookups share one index of the passwd file, rebuilt only when the file changes. """
+    reads = list()
+    monkeypatch.setattr('creds.database.read_passwd', lambda **kwargs: reads.append(kwargs) or read_passwd(**kwargs))
+    assert get_passwd_entry(username='bob', root_path=root.strpath).pw_uid == 1001
+    assert get_passwd_entry(username='bobby', root_path=root.strpath).pw_uid == 1002
+    assert get_passwd_entry(username='missing', root_path=root.strpath) is None
+    assert len(reads) == 1
+    root.join('etc', 'passwd').write(PASSWD + 'jane:x:1004:1004::/home/jane:/bin/sh\n')
+    assert get_passwd_entry(username='jane', root_path=root.strpath).pw_uid == 1004
+    assert len(reads) == 2
+
+
+def test_account_database_writes_each_file_once(writable_root):
+    """ Changes are made in memory and each changed file is replaced once, keeping a backup. """
+    etc = writable_root.join('etc')
+    with open_account_database(root_path=writable_root.strpath) as database:
+        jane = database.add_user(name='jane', gecos='Jane Doe', shell='/bin/bash')
+        database.add_user(name='joe', uid=1010, gid=2000)
+        database.modify_user(name='bob', shell='/bin/bash')
+        assert database.delete_user(name='bobby').pw_uid == 1002
+        assert database.delete_user(name='missing') is None
+        # Nothing is written until the context exits
+        assert etc.join('passwd').read() == PASSWD
+    assert (jane.pw_uid, jane.pw_gid, jane.pw_dir) == (1000, 1000, '/home/jane')
+    assert etc.join('passwd').read() == PASSWD.replace(
+        'bob:x:1001:1001:Bob Smith:/home/bob:/bin/sh', 'bob:x:1001:1001:Bob Smith:/home/bob:/bin/bash').replace(
+        'bobby:x:1002:1002::/home/bobby:/bin/false\n', '') + \
+        'jane:x:1000:1000:Jane Doe:/home/jane:/bin/bash\njoe:x:1010:2000::/home/joe:\n'
+    assert etc.join('group').read() == 'root:x:0:\nbob:x:1001:\nadmins:x:2000:bob\njane:x:1000:\n'
+    shadow = etc.join('shadow').read().splitlines()
+    assert [line.split(':')[:2] for line in shadow[2:]] == [['jane', '!'], ['joe', '!']]
+    assert etc.join('passwd-').read() == PASSWD
+    assert etc.join('group-').read() == GROUP
+    assert etc.join('.pwd.lock').check()
+    assert sorted(etc.listdir(lambda path: path.basename.startswith('.creds_'))) == []
+
+
+def test_account_database_unchanged_files_are_not_written(writable_root):
+    with open_account_database(root_path=writable_root.strpath) as database:
+        database.modify_user(name='bob', gecos='Robert Smith')
+    assert writable_root.join('etc', 'passwd-').check()
+    assert not writable_root.join('etc', 'shadow-').check()
+    assert not writable_root.join('etc', 'group-').check()
+
+
+@pytest.mark.skipif(not hasattr(os, 'setxattr'), reason='requires os.setxattr')
+def test_account_database_keeps_security_context_and_invalidates_caches(writable_root, monkeypatch):
+    """ Files keep their SELinux context, and nscd and sssd are told when the running system's users change. """
+    # A user attribute stands in for security.selinux, which can only be set on SELinux hosts
+    monkeypatch.setattr('creds.database.SELINUX_XATTR', 'user.creds_test')
+    passwd = writable_root.join('etc', 'passwd')
+    os.setxattr(passwd.strpath, 'user.creds_test', b'system_u:object_r:passwd_file_t:s0')
+    commands = list()
+    monkeypatch.setattr('creds.database.execute_command', lambda command: commands.append(command) or ((b'', b''), 0))
+    monkeypatch.setattr('creds.constants.LINUX_CMD_NSCD', '/usr/sbin/nscd')
+    monkeypatch.setattr('creds.constants.LINUX_CMD_SSS_CACHE', None)
+    with open_account_database(root_path=writable_root.strpath) as database:
+        database.modify_user(name='bob', shell='/bin/bash')
+    assert os.getxattr(passwd.strpath, 'user.creds_test') == b'system_u:object_r:passwd_file_t:s0'
+    # The caches of the running system don't hold the users of an alternate root
+    assert commands == []
+    database = AccountDatabase(root_path=writable_root.strpath)
+    database.save()
+    database.modify_user(name='bob', shell='/bin/sh')
+    database.root_path = None
+    database.save()
+    assert commands == [['/usr/sbin/nscd', '-i', 'passwd'], ['/usr/sbin/nscd', '-i', 'group']]
+
+
+def test_account_database_is_not_written_on_error(writable_root):
+    with pytest.raises(ValueError):
+        with open_account_database(root_path=writable_root.strpath) as database:
+            database.add_user(name='jane')
+            database.add_user(name='bob')
+    assert writable_root.join('etc', 'passwd').read() == PASSWD
+
+
+def test_account_database_lock_timeout(writable_root):
+    """ The lock is a lockf lock, as taken by lckpwdf, so another process holding it blocks the writer. """
+    locked_read, locked_write = os.pipe()
+    release_read, release_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        lock_file = os.open(writable_root.join('etc', '.pwd.lock').strpath, os.O_WRONLY | os.O_CREAT)
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        os.write(locked_write, b'x')
+        os.read(release_read, 1)
+        os._exit(0)
+    try:
+        os.read(locked_read, 1)
+        with pytest.raises(OSError):
+            with lock_account_database(root_path=writable_root.strpath, timeout=0.2):
+                pass
+    finally:
+        os.write(release_write, b'x')
+        os.waitpid(pid, 0)
+    with lock_account_database(root_path=writable_root.strpath, timeout=0.2):
+        pass
+
+
+def test_account_database_homes(writable_root):
+    database = AccountDatabase(root_path=writable_root.strpath)
+    jane = database.add_user(name='jane')
+    database.create_home(passwd_entry=jane)
+    home = writable_root.join('home', 'jane')
+    assert home.join('.profile').read() == 'umask 022\n'
+    assert home.join('.bashrc').islink()
+    assert oct(home.stat().mode & 0o777) == oct(0o700)
+    if os.geteuid() == 0:
+        assert home.join('.profile').stat().uid == jane.pw_uid
+    jane = jane._replace(pw_uid=home.stat().uid)
+    database.delete_user(name='jane')
+    assert database.remove_home(passwd_entry=jane)
+    assert not home.check()
+
+
+def test_account_database_only_removes_homes_of_the_user(writable_root):
+    """ As with userdel -r, / and homes that are shared, owned by someone else or not directories are kept. """
+    shared = writable_root.mkdir('srv').mkdir('shared')
+    owner = shared.stat().uid
+    database = AccountDatabase(root_path=writable_root.strpath)
+    for name in ('one', 'two'):
+        database.add_user(name=name, uid=owner if name == 'one' else None, home_dir='/srv/shared')
+    one = database.delete_user(name='one')
+    assert not database.remove_home(passwd_entry=one)
+    two = database.delete_user(name='two')
+    assert not database.remove_home(passwd_entry=two._replace(pw_uid=owner + 1))
+    assert not database.remove_home(passwd_entry=two._replace(pw_uid=owner, pw_dir='/'))
+    writable_root.join('srv', 'link').mksymlinkto(shared)
+    assert not database.remove_home(passwd_entry=two._replace(pw_uid=owner, pw_dir='/srv/link'))
+    assert shared.check(dir=True)
+    assert database.remove_home(passwd_entry=two._replace(pw_uid=owner))
+    assert not shared.check()
+
+
+def test_account_database_groups(writable_root):
+    """ Private groups reuse an existing group of the user's name, and gshadow is kept in step with group. """
+    etc = writable_root.join('etc')
+    etc.join('group').write(GROUP + 'jane:x:3000:\n')
+    etc.join('gshadow').write('root:*::\nbob:!::\nbobby:!::\nadmins:!:bobby:bob,bobby\njane:!::\n')
+    with open_account_database(root_path=writable_root.strpath) as database:
+        assert database.add_user(name='jane').pw_gid == 3000
+        assert database.add_user(name='joe').pw_gid == 1003
+        database.delete_user(name='bobby')
+    assert etc.join('group').read() == 'root:x:0:\nbob:x:1001:\nadmins:x:2000:bob\njane:x:3000:\njoe:x:1003:\n'
+    assert etc.join('gshadow').read() == 'root:*::\nbob:!::\nadmins:!::bob\njane:!::\njoe:!::\n'
+
+
+def test_account_database_allocates_ids_in_order(writable_root):
+    database = AccountDatabase(root_path=writable_root.strpath)
+    assert [database.add_user(name='user{0}'.format(index)).pw_uid for index in range(3)] == [1000, 1003, 1004]
+    database.delete_user(name='user0')
+    assert database.add_user(name='user3').pw_uid == 1000
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='requires root')
+def test_account_database_reowns_home(writable_root):
+    """ As with usermod -u and -g, files in the home directory owned by the previous ids are given the new ones. """
+    home = writable_root.mkdir('home').mkdir('bob')
+    home.join('mine').write('')
+    home.join('theirs').write('')
+    os.chown(home.strpath, 1001, 1001)
+    os.chown(home.join('mine').strpath, 1001, 1001)
+    os.chown(home.join('theirs').strpath, 4000, 1001)
+    database = AccountDatabase(root_path=writable_root.strpath)
+    previous = database.modify_user(name='bob', uid=1100, gid=2000)
+    database.reown_home(previous=previous, passwd_entry=database.get_user(name='bob'))
+    assert (home.stat().uid, home.stat().gid) == (1100, 2000)
+    assert (home.join('mine').stat().uid, home.join('mine').stat().gid) == (1100, 2000)
+    assert (home.join('theirs').stat().uid, home.join('theirs').stat().gid) == (4000, 2000)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+import pytest
+from creds.fanout import (LocalTransport, Transport, deserialise, fan_out, serialise)
+from creds.users import (Users, User)
+from .sample_data import PUBLIC_KEYS
+
+
+def make_root(tmpdir, name, passwd):
+    root = tmpdir.mkdir(name)
+    root.mkdir('etc').join('passwd').write(passwd)
+    root.join('etc', 'sudoers').write('')
+    return root.strpath
+
+
+@pytest.fixture
+def users():
+    users = Users()
+    users.append(User(name='bob', uid=1001, gid=1001, shell='/bin/sh', sudoers_entry='ALL=(ALL) ALL',
+                      public_keys=Users.construct_user(dict(public_keys=[PUBLIC_KEYS[0]['encoded']])).public_keys))
+    users.append(User(name='jane', uid=1002, gid=1002, shell='/bin/sh'))
+    return users
+
+
+def test_payload_round_trip(users):
+    proposed_users, options = deserialise(serialise(users=users, purge_undefined=True))
+    assert [user.to_dict() for user in proposed_users] == [user.to_dict() for user in users]
+    assert proposed_users[0].sudoers_entry == 'ALL=(ALL) ALL'
+    assert options == dict(purge_undefined=True)
+    with pytest.raises(ValueError):
+        serialise(users=users, not_an_option=True)
+    with pytest.raises(ValueError):
+        deserialise(b'not a payload')
+
+
+def test_fan_out_to_local_roots(users, tmpdir):
+    targets = [make_root(tmpdir, 'empty', ''),
+               make_root(tmpdir, 'partial', 'bob:x:1001:1001::/home/bob:/bin/bash\nold:x:1003:1003::/:/bin/sh\n')]
+    results = dict((result['target'], result) for result in fan_out(
+        users=users, targets=targets + [tmpdir.join('missing').strpath], transport=LocalTransport(), workers=2,
+        purge_undefined=True))
+    assert results[targets[0]]['ok']
+    assert results[targets[0]]['plan'] == [dict(action='add', username='bob'), dict(action='add', username='jane')]
+    assert results[targets[1]]['plan'] == [dict(action='update', username='bob'), dict(action='add', username='jane'),
+                                           dict(action='delete', username='old')]
+    assert not results[targets[1]]['executed']
+    # Targets fail independently
+    assert not results[tmpdir.join('missing').strpath]['ok']
+
+
+def test_fan_out_reports_transport_errors(users):
+    class FailingTransport(Transport):
+        def apply(self, target=None, payload=None):
+            raise OSError('unreachable')
+
+    results = list(fan_out(users=users, targets=['host1', 'host2'], transport=FailingTransport()))
+    assert sorted(result['target'] for result in results) == ['host1', 'host2']
+    assert all(result['error'] == 'OSError: unreachable' for result in results)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+import io
+import os
+import stat
+import sys
+import threading
+
+import pytest
+from creds import helper as creds_helper
+from creds.helper import (PrivilegedHelper, read_message, write_message)
+from creds.ssh import (PublicKey, write_authorized_keys)
+from creds.users import User
+from creds.utils import execute_command
+
+from .sample_data import PUBLIC_KEYS
+
+
+@pytest.fixture
+def privileged_helper():
+    """ A helper run without sudo, as the current user. """
+    helper = PrivilegedHelper(sudo='')
+    yield helper
+    helper.close()
+
+
+def test_message_framing():
+    stream = io.BytesIO()
+    write_message(stream, dict(op='ping', args=dict()))
+    write_message(stream, dict(op='exec', args=dict(command=['true'])))
+    stream.seek(0)
+    assert read_message(stream) == dict(op='ping', args=dict())
+    assert read_message(stream) == dict(op='exec', args=dict(command=['true']))
+    assert read_message(stream) is None
+
+
+def test_helper_execute(privileged_helper):
+    assert privileged_helper.euid == os.geteuid()
+    (stdout, stderr), returncode = privileged_helper.execute(command=[sys.executable, '-c', 'print("hello")'])
+    assert (stdout, stderr, returncode) == (b'hello\n', b'', 0)
+
+
+def test_helper_file_operations(privileged_helper, tmpdir):
+    path = tmpdir.join('a', 'b', 'file').strpath
+    privileged_helper.makedirs(path=os.path.dirname(path), mode=0o700)
+    privileged_helper.write_file(path=path, data=b'first\n', mode=0o640)
+    privileged_helper.write_file(path=path, data=b'second\n')
+    assert privileged_helper.read_file(path=path) == b'second\n'
+    privileged_helper.chmod(path=path, mode=0o600)
+    privileged_helper.chown(path=path, uid=os.geteuid())
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert os.listdir(os.path.dirname(path)) == ['file']
+
+
+def test_helper_errors_are_raised(privileged_helper, tmpdir):
+    with pytest.raises(OSError):
+        privileged_helper.read_file(path=tmpdir.join('missing').strpath)
+    # The helper carries on after a failed request
+    assert privileged_helper.request('ping') == os.geteuid()
+
+
+def test_helper_is_thread_safe(privileged_helper):
+    results = list()
+
+    def run(index):
+        results.append(privileged_helper.execute(command=['echo', str(index)])[0][0] == '{0}\n'.format(index).encode())
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 20
+
+
+def test_execute_command_uses_helper(privileged_helper, monkeypatch):
+    """ Commands run with sudo are passed to the helper, others are run directly. """
+    commands = list()
+    monkeypatch.setattr('creds.constants.CMD_SUDO', '/usr/bin/sudo')
+    monkeypatch.setattr(creds_helper, '_HELPER', privileged_helper)
+    monkeypatch.setattr(privileged_helper, 'execute', lambda command=None: commands.append(command) or ((b'', b''), 0))
+    execute_command(['/usr/bin/sudo', 'true'])
+    assert execute_command(['true'])[1] == 0
+    assert commands == [['true']]
+
+
+def test_write_authorized_keys_uses_helper(privileged_helper, monkeypatch, tmpdir):
+    """ Keys are written through the helper, without running any commands. """
+    home_dir = tmpdir.mkdir('bob')
+    monkeypatch.setattr('creds.ssh.sudo_check', lambda: 'sudo')
+    monkeypatch.setattr('creds.ssh.active_helper', lambda: privileged_helper)
+    monkeypatch.setattr('creds.ssh.execute_command', lambda command=None: pytest.fail('command run'))
+    monkeypatch.setattr('os.path.expanduser', lambda path: home_dir.strpath)
+    write_authorized_keys(User(name='bob', uid=os.geteuid(), public_keys=[PublicKey(raw=PUBLIC_KEYS[0]['raw'])]))
+    authorized_keys_path = home_dir.join('.ssh', 'authorized_keys')
+    assert authorized_keys_path.read() == '{0}\n'.format(PUBLIC_KEYS[0]['raw'])
+    assert stat.S_IMODE(authorized_keys_path.stat().mode) == 0o600
+
+
+def test_helper_ignores_working_directory(monkeypatch, tmpdir):
+    """ Modules in the caller's working directory aren't imported by the helper, which runs as root. """
+    tmpdir.join('json.py').write('open({0!r}, "w").close()\n'.format(tmpdir.join('imported').strpath))
+    monkeypatch.chdir(tmpdir)
+    helper = PrivilegedHelper(sudo='')
+    try:
+        assert helper.request('ping') == os.geteuid()
+    finally:
+        helper.close()
+    assert not tmpdir.join('imported').check()
+
+
+def test_helper_write_authorized_keys_refuses_symlinks(privileged_helper, tmpdir):
+    target = tmpdir.mkdir('target')
+    tmpdir.mkdir('bob').join('.ssh').mksymlinkto(target)
+    with pytest.raises(OSError):
+        privileged_helper.write_authorized_keys(authorized_keys_dir=tmpdir.join('bob', '.ssh').strpath,
+                                                data=b'key\n', uid=os.geteuid())
+    assert target.listdir() == []
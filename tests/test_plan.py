@@ -369,6 +369,150 @@ def test_execute_plan_to_update_existing_user_with_multiple_keys():
     delete_test_user_and_group()
 
 
+def test_execute_plan_with_workers_returns_results_in_plan_order(monkeypatch):
+    """ Run a plan concurrently with user database commands stubbed out """
+    executed = list()
+
+    def fake_execute_command(command=None):
+        executed.append(command)
+        return (b'', b''), 0
+
+    monkeypatch.setattr('creds.plan.execute_command', fake_execute_command)
+    monkeypatch.setattr('creds.plan.write_authorized_keys', lambda user, root_path=None: None)
+    monkeypatch.setattr('creds.plan.remove_sudoers_entry', lambda username, root_path=None: None)
+    existing_users = Users()
+    proposed_users = Users()
+    for index in range(20):
+        proposed_users.append(User(name='parallel{0}'.format(index), uid=50000 + index))
+    plan = create_plan(existing_users=existing_users, proposed_users=proposed_users, manage_home=False)
+    results = execute_plan(plan=plan, workers=4)['results']
+    assert len(executed) == 20
+    assert [result['task'] for result in results] == plan
+    assert all(result['command_output'] == ((b'', b''), 0) for result in results)
+
+
+def test_execute_plan_reports_steps(monkeypatch):
+    """ Each task's phases are timed, with the commands they ran """
+    monkeypatch.setattr('creds.users.sudo_check', lambda: '')
+    monkeypatch.setattr('creds.constants.LINUX_CMD_USERADD', 'true')
+    monkeypatch.setattr('creds.constants.LINUX_CMD_USERDEL', 'false')
+    existing_users = Users()
+    existing_users.append(User(name='gone', uid=50001))
+    proposed_users = Users()
+    proposed_users.append(User(name='added', uid=50000))
+    plan = create_plan(existing_users=existing_users, proposed_users=proposed_users, purge_undefined=True,
+                       manage_home=False)
+    metrics = list()
+    report = execute_plan(plan=plan, metrics_sink=lambda name, value, tags: metrics.append((name, value, tags)))
+    add_result, delete_result = report['results']
+    assert [step['phase'] for step in add_result['steps']] == ['user_database']
+    assert add_result['steps'][0]['commands'][0]['command'] == ['true', '-u', '50000', 'added']
+    assert add_result['steps'][0]['commands'][0]['returncode'] == 0
+    assert delete_result['steps'][0]['commands'][0]['returncode'] == 1
+    assert report['counters'] == dict(tasks=2, add=1, update=0, delete=1, fail=0, commands=2, failed_commands=1)
+    assert report['elapsed'] >= add_result['elapsed'] >= add_result['steps'][0]['elapsed'] >= 0
+    assert ('creds.plan.failed_commands', 1, dict()) in metrics
+    assert [tags for name, _, tags in metrics if name == 'creds.step.seconds'] == [
+        dict(phase='user_database', action='add'), dict(phase='user_database', action='delete')]
+
+
+def fake_command(tmpdir, name, returncode):
+    """ Write a command that saves its standard input alongside it. """
+    command = tmpdir.join(name)
+    command.write('#!/bin/sh\ncat > "$0.in"\nexit {0}\n'.format(returncode))
+    command.chmod(0o755)
+    return command.strpath
+
+
+@pytest.mark.parametrize('newusers_returncode', [0, 1])
+def test_execute_plan_bulk_add(monkeypatch, tmpdir, newusers_returncode):
+    """ Added users are created with one newusers run and locked with chpasswd, or with useradd if it fails. """
+    monkeypatch.setattr('creds.users.sudo_check', lambda: '')
+    monkeypatch.setattr('creds.constants.LINUX_CMD_USERADD', 'true')
+    monkeypatch.setattr('creds.constants.LINUX_CMD_NEWUSERS', fake_command(tmpdir, 'newusers', newusers_returncode))
+    monkeypatch.setattr('creds.constants.LINUX_CMD_CHPASSWD', fake_command(tmpdir, 'chpasswd', 0))
+    proposed_users = Users()
+    proposed_users.append(User(name='bulk1', uid=50000, gecos='Bulk user', shell='/bin/sh'))
+    proposed_users.append(User(name='bulk2', home_dir='/srv/bulk2'))
+    proposed_users.append(User(name='bulk3', gecos='not:representable'))
+    plan = create_plan(existing_users=Users(), proposed_users=proposed_users)
+    report = execute_plan(plan=plan, bulk_add=True)
+    lines = tmpdir.join('newusers.in').read().splitlines()
+    assert [line.split(':')[:1] + line.split(':')[2:] for line in lines] == [
+        ['bulk1', '50000', '', 'Bulk user', '/home/bulk1', '/bin/sh'], ['bulk2', '', '', '', '/srv/bulk2', '']]
+    assert all(len(line.split(':')[1]) == 32 for line in lines)
+    useradd_users = [result['task']['proposed_user'].name for result in report['results'] if result['steps']]
+    if newusers_returncode:
+        assert not tmpdir.join('chpasswd.in').exists()
+        assert useradd_users == ['bulk1', 'bulk2', 'bulk3']
+    else:
+        assert tmpdir.join('chpasswd.in').read() == 'bulk1:!\nbulk2:!\n'
+        assert useradd_users == ['bulk3']
+        assert report['results'][0]['command_output'] == ((b'', b''), 0)
+    assert [step['phase'] for step in report['steps']] == ['user_database']
+
+
+def test_execute_plan_write_database(monkeypatch, tmpdir):
+    """ Every user database change is made with one write of passwd, shadow and group, without useradd et al. """
+    for name in ('LINUX_CMD_USERADD', 'LINUX_CMD_USERMOD', 'LINUX_CMD_USERDEL'):
+        monkeypatch.setattr('creds.constants.{0}'.format(name), 'false')
+    etc = tmpdir.mkdir('etc')
+    etc.join('passwd').write('changed:x:50001:50001::/home/changed:/bin/sh\ngone:x:50002:50002::/home/gone:/bin/sh\n')
+    etc.join('shadow').write('changed:!:17000::::::\ngone:!:17000::::::\n')
+    etc.join('group').write('changed:x:50001:\ngone:x:50002:\n')
+    etc.join('sudoers').write('')
+    gone_home = tmpdir.mkdir('home').mkdir('gone')
+    if os.geteuid() == 0:
+        # Home directories are only removed if they belong to the user
+        os.chown(gone_home.strpath, 50002, 50002)
+    existing_users = Users()
+    existing_users.append(User(name='changed', uid=50001, gid=50001, shell='/bin/sh'))
+    existing_users.append(User(name='gone', uid=50002, gid=50002, shell='/bin/sh'))
+    proposed_users = Users()
+    proposed_users.append(User(name='changed', uid=50001, gid=50001, shell='/bin/bash'))
+    proposed_users.append(User(name='added', uid=50003, gecos='Added user'))
+    plan = create_plan(existing_users=existing_users, proposed_users=proposed_users, purge_undefined=True)
+    report = execute_plan(plan=plan, root_path=tmpdir.strpath, write_database=True)
+    assert [step['phase'] for step in report['steps']] == ['user_database']
+    assert all(result['command_output'] is None for result in report['results'])
+    assert etc.join('passwd').read() == ('changed:x:50001:50001::/home/changed:/bin/bash\n'
+                                         'added:x:50003:50003:Added user:/home/added:\n')
+    assert etc.join('group').read() == 'changed:x:50001:\nadded:x:50003:\n'
+    assert tmpdir.join('home', 'added').isdir()
+    assert gone_home.check() != (os.geteuid() == 0)
+
+
+def test_create_plan_from_streamed_users(tmpdir):
+    """ A plan can be created from users streamed from a manifest, in a single pass. """
+    existing_users = Users()
+    existing_users.append(User(name='unchanged', uid=50000, shell='/bin/sh'))
+    existing_users.append(User(name='changed', uid=50001, shell='/bin/sh'))
+    manifest = tmpdir.join('manifest.yml')
+    manifest.write(yaml.safe_dump(dict(users=[dict(name='unchanged', uid=50000, shell='/bin/sh'),
+                                              dict(name='changed', uid=50001, shell='/bin/bash'),
+                                              dict(name='added', uid=50002)])))
+    plan = create_plan(existing_users=existing_users, proposed_users=Users.iter_from_yaml(file_path=manifest.strpath),
+                       purge_undefined=True, protected_users=['root'])
+    assert [(task['action'], task['proposed_user'].name) for task in plan] == [
+        ('update', 'changed'), ('add', 'added')]
+
+
+def test_create_plan_classifies_users():
+    """ Adds, updates, uid clashes and deletes are found without touching the system. """
+    existing_users = Users()
+    for name, uid in (('root', 0), ('same', 50000), ('changed', 50001), ('undefined', 50002), ('undefined', 50003)):
+        existing_users.append(User(name=name, uid=uid, shell='/bin/sh'))
+    proposed_users = [User(name='same', uid=50000, shell='/bin/sh'), User(name='changed', uid=50001, shell='/bin/bash'),
+                      User(name='clash', uid=50002), User(name='added', uid=50004), User(name='nouid')]
+    plan = create_plan(existing_users=existing_users, proposed_users=proposed_users, purge_undefined=True,
+                       protected_users=['root'])
+    assert [(task['action'], task.get('username') or task['proposed_user'].name) for task in plan] == [
+        ('update', 'changed'), ('fail', 'clash'), ('add', 'added'), ('add', 'nouid'), ('delete', 'undefined'),
+        ('delete', 'undefined')]
+    plan = create_plan(existing_users=existing_users, proposed_users=proposed_users, allow_non_unique_id=True)
+    assert [task['action'] for task in plan] == ['update', 'add', 'add', 'add']
+
+
 def delete_test_user_and_group():
     if PLATFORM == 'Linux':
         del_user_command = shlex.split(str('{0} {1} -r -f testuserx1234'.format(sudo_check(), LINUX_CMD_USERDEL)))
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+import os
+import shlex
+import subprocess
+
+import pytest
+from creds.constants import find_executable
+from creds.plan import create_plan
+from creds.script import (_heredoc, _rewrite_sudoers, compile_plan)
+from creds.sudoers import SudoersBatch
+from creds.users import (Users, User)
+from .sample_data import PUBLIC_KEYS
+
+
+@pytest.fixture
+def plan():
+    existing_users = Users()
+    existing_users.append(User(name='bob', uid=1001, shell='/bin/sh'))
+    existing_users.append(User(name='gone', uid=1003))
+    proposed_users = Users()
+    proposed_users.append(User(name='bob', uid=1001, shell='/bin/bash', sudoers_entry='ALL=(ALL) ALL'))
+    proposed_users.append(Users.construct_user(dict(name='jane', uid=1002, gecos='Jane Doe',
+                                                    public_keys=[PUBLIC_KEYS[0]['encoded']])))
+    proposed_users.append(User(name='clash', uid=1003))
+    return create_plan(existing_users=existing_users, proposed_users=proposed_users, purge_undefined=True)
+
+
+@pytest.fixture
+def root(tmpdir, monkeypatch):
+    for name in ('LINUX_CMD_USERADD', 'LINUX_CMD_USERMOD', 'LINUX_CMD_USERDEL', 'LINUX_CMD_VISUDO'):
+        monkeypatch.setattr('creds.constants.{0}'.format(name), 'true')
+    monkeypatch.setattr('creds.users.sudo_check', lambda: '')
+    tmpdir.mkdir('etc').join('passwd').write('bob:x:1001:1001::/home/bob:/bin/sh\ngone:x:1003:1003::/:/bin/sh\n')
+    tmpdir.join('etc', 'sudoers').write('root ALL=(ALL:ALL) ALL\nbobby ALL=(ALL) ALL\ngone ALL=(ALL) ALL')
+    return tmpdir
+
+
+def test_heredoc_delimiter_is_not_in_the_lines():
+    assert _heredoc(lines=['a', 'CREDS_EOF']) == "<<'CREDS_EOF_'\na\nCREDS_EOF\nCREDS_EOF_"
+
+
+def test_compile_plan(plan, root):
+    script = compile_plan(plan=plan, root_path=root.strpath)
+    lines = script.splitlines()
+    assert lines[:3] == ['#!/bin/sh', '# Generated by creds from a plan of 4 tasks', 'set -e']
+    assert 'true -R {0} -s /bin/bash bob'.format(root.strpath) in lines
+    assert 'true -R {0} -u 1002 -c \'"Jane Doe"\' -m jane'.format(root.strpath) in lines
+    assert '# skipped clash: uid_clash' in lines
+    assert PUBLIC_KEYS[0]['raw'] in lines
+    # Sudoers is rewritten once, after every other change
+    assert script.count('mv -f "$sudoers_tmp"') == 1
+    assert script.index('# sudoers') > script.index('# delete gone')
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='requires root')
+def test_compiled_plan_runs(plan, root):
+    """ The script writes the keys and sudoers file under the root. """
+    process = subprocess.Popen(['sh', '-c', compile_plan(plan=plan, root_path=root.strpath)], stderr=subprocess.PIPE)
+    assert process.communicate()[1] == b''
+    assert process.returncode == 0
+    assert root.join('etc', 'sudoers').read() == 'root ALL=(ALL:ALL) ALL\nbobby ALL=(ALL) ALL\nbob ALL=(ALL) ALL\n'
+    authorized_keys_path = root.join('home', 'jane', '.ssh', 'authorized_keys')
+    assert authorized_keys_path.read() == '{0}\n'.format(PUBLIC_KEYS[0]['raw'])
+    assert authorized_keys_path.stat().uid == 1002
+    assert oct(authorized_keys_path.stat().mode & 0o777) == oct(0o600)
+    assert root.join('home', 'jane', '.ssh').listdir() == [authorized_keys_path]
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='requires root')
+def test_compiled_plan_does_not_follow_symlinks(plan, root):
+    """ A symlinked keys directory stops the script, and a symlinked authorized_keys is replaced, not written to. """
+    target = root.mkdir('target')
+    home_dir = root.mkdir('home').mkdir('jane')
+    home_dir.join('.ssh').mksymlinkto(target)
+    process = subprocess.Popen(['sh', '-c', compile_plan(plan=plan, root_path=root.strpath)], stderr=subprocess.PIPE)
+    assert b'refusing to write keys through a symlink' in process.communicate()[1]
+    assert process.returncode != 0
+    assert target.listdir() == []
+    home_dir.join('.ssh').remove()
+    home_dir.mkdir('.ssh').join('authorized_keys').mksymlinkto(target.join('shadow'))
+    assert subprocess.call(['sh', '-c', compile_plan(plan=plan, root_path=root.strpath)]) == 0
+    assert not target.join('shadow').check()
+    assert not home_dir.join('.ssh', 'authorized_keys').islink()
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='requires root')
+def test_compiled_plan_does_not_follow_symlinks_swapped_in_after_the_check(plan, root, tmpdir):
+    """ The keys directory is swapped for a symlink once the script has checked it, while it is being chowned. """
+    target = root.mkdir('target')
+    home_dir = root.mkdir('home').mkdir('jane')
+    bin_dir = tmpdir.mkdir('bin')
+    chown = bin_dir.join('chown')
+    chown.write('#!/bin/sh\n[ -e {0}/.ssh-moved ] || {{ mv {0}/.ssh {0}/.ssh-moved; ln -s {1} {0}/.ssh; }}\n'
+                'exec {2} "$@"\n'.format(home_dir.strpath, target.strpath, find_executable('chown')))
+    chown.chmod(0o755)
+    environment = dict(os.environ, PATH='{0}{1}{2}'.format(bin_dir.strpath, os.pathsep, os.environ['PATH']))
+    assert subprocess.call(['sh', '-c', compile_plan(plan=plan, root_path=root.strpath)], env=environment) == 0
+    assert target.listdir() == []
+    assert home_dir.join('.ssh-moved', 'authorized_keys').read() == '{0}\n'.format(PUBLIC_KEYS[0]['raw'])
+
+
+def test_rewrite_sudoers_quotes_user_names(root):
+    batch = SudoersBatch(root_path=root.strpath)
+    batch.remove_entry(username='it\'s"a\\name')
+    lines = _rewrite_sudoers(batch=batch, root_path=root.strpath)
+    awk = [line for line in lines if line.startswith('awk ')][0]
+    assert shlex.split(awk)[1].startswith('BEGIN { n = split("it\'s\\"a\\\\name", names, " ");')
+    batch.remove_entry(username='two words')
+    with pytest.raises(ValueError):
+        _rewrite_sudoers(batch=batch, root_path=root.strpath)
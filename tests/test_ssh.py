@@ -2,8 +2,14 @@
 
 from __future__ import (absolute_import, unicode_literals, print_function)
 
+import os
+import stat
+
 import pytest
-from creds.ssh import PublicKey
+from creds.ssh import (PublicKey, read_authorized_keys, read_authorized_keys_bulk, write_authorized_keys)
+from creds.utils import execute_command
+
+from creds.users import User
 
 from .sample_data import PUBLIC_KEYS
 
@@ -31,3 +37,118 @@ def test_create_public_key_from_raw():
 def test_public_key_repr_and_str():
     public_key = PublicKey(raw=PUBLIC_KEYS[0]['raw'])
     assert str(public_key) == public_key.__repr__()
+
+
+def make_home_dirs(tmpdir):
+    home_dirs = dict()
+    for index, username in enumerate(('bob', 'bobby', 'nokeys')):
+        home_dir = tmpdir.mkdir(username)
+        if username != 'nokeys':
+            home_dir.mkdir('.ssh').join('authorized_keys').write('{0}\n'.format(PUBLIC_KEYS[index]['raw']))
+        home_dirs[username] = home_dir.strpath
+    return home_dirs
+
+
+def test_read_authorized_keys_bulk(tmpdir):
+    keys = read_authorized_keys_bulk(home_dirs=make_home_dirs(tmpdir))
+    assert keys['bob'][0].raw == PUBLIC_KEYS[0]['raw']
+    assert keys['bobby'][0].raw == PUBLIC_KEYS[1]['raw']
+    assert keys['nokeys'] == []
+
+
+def test_read_authorized_keys_bulk_privileged(tmpdir, monkeypatch):
+    """ Files that can't be read directly are read with a single elevated grep. """
+    commands = list()
+
+    def fake_execute_command(command=None):
+        commands.append(command)
+        return execute_command(command[1:])
+
+    monkeypatch.setattr('creds.ssh.sudo_check', lambda: 'sudo')
+    monkeypatch.setattr('creds.ssh.execute_command', fake_execute_command)
+    monkeypatch.setattr('os.access', lambda path, mode: False)
+    keys = read_authorized_keys_bulk(home_dirs=make_home_dirs(tmpdir))
+    assert len(commands) == 1
+    assert keys['bob'][0].raw == PUBLIC_KEYS[0]['raw']
+    assert keys['bobby'][0].raw == PUBLIC_KEYS[1]['raw']
+    assert keys['nokeys'] == []
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='requires root')
+def test_write_authorized_keys_as_root(tmpdir, monkeypatch):
+    """ As root the keys are written in-process, without running any commands. """
+    home_dir = tmpdir.mkdir('bob')
+    monkeypatch.setattr('creds.ssh.execute_command', lambda command=None: pytest.fail('command run'))
+    monkeypatch.setattr('os.path.expanduser', lambda path: home_dir.strpath)
+    user = User(name='nobody', public_keys=[PublicKey(raw=PUBLIC_KEYS[0]['raw'])])
+    write_authorized_keys(user)
+    authorized_keys_path = home_dir.join('.ssh', 'authorized_keys')
+    assert authorized_keys_path.read() == '{0}\n'.format(PUBLIC_KEYS[0]['raw'])
+    assert stat.S_IMODE(authorized_keys_path.stat().mode) == 0o600
+    assert stat.S_IMODE(home_dir.join('.ssh').stat().mode) == 0o700
+    assert home_dir.join('.ssh').stat().uid == authorized_keys_path.stat().uid != 0
+    assert home_dir.join('.ssh').listdir() == [authorized_keys_path]
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='requires root')
+def test_write_authorized_keys_as_root_does_not_follow_symlinks(tmpdir, monkeypatch):
+    """ A symlink planted by the user, as the keys directory or a file in it, is never written through. """
+    home_dir = tmpdir.mkdir('bob')
+    target = tmpdir.mkdir('target')
+    monkeypatch.setattr('os.path.expanduser', lambda path: home_dir.strpath)
+    user = User(name='nobody', public_keys=[PublicKey(raw=PUBLIC_KEYS[0]['raw'])])
+    home_dir.join('.ssh').mksymlinkto(target)
+    with pytest.raises(OSError):
+        write_authorized_keys(user)
+    assert target.listdir() == []
+    assert target.stat().uid == 0
+    home_dir.join('.ssh').remove()
+    home_dir.mkdir('.ssh').join('authorized_keys').mksymlinkto(target.join('shadow'))
+    write_authorized_keys(user)
+    assert not target.join('shadow').check()
+    assert not home_dir.join('.ssh', 'authorized_keys').islink()
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='requires root')
+def test_write_authorized_keys_to_alternate_root(tmpdir):
+    """ Keys are written to the home directory under the root, owned by the uid in the root's passwd file. """
+    tmpdir.mkdir('etc').join('passwd').write('bob:x:4321:4321::/home/bob:/bin/sh\n')
+    write_authorized_keys(User(name='bob', public_keys=[PublicKey(raw=PUBLIC_KEYS[0]['raw'])]),
+                          root_path=tmpdir.strpath)
+    authorized_keys_path = tmpdir.join('home', 'bob', '.ssh', 'authorized_keys')
+    assert authorized_keys_path.read() == '{0}\n'.format(PUBLIC_KEYS[0]['raw'])
+    assert authorized_keys_path.stat().uid == 4321
+    assert read_authorized_keys(username='bob', root_path=tmpdir.strpath)[0].raw.strip() == PUBLIC_KEYS[0]['raw']
+
+
+def test_public_key_forms_are_computed_once():
+    public_key = PublicKey(b64encoded=PUBLIC_KEYS[0]['encoded'])
+    assert public_key.raw is public_key.raw
+    assert not hasattr(public_key, '__dict__')
+
+
+def test_public_key_parsed():
+    key_type, blob, comment = PublicKey(raw=PUBLIC_KEYS[2]['raw']).parsed
+    assert key_type == 'ssh-rsa'
+    assert blob == PUBLIC_KEYS[2]['raw'].split()[1]
+    assert comment == 'bob@example.com'
+    with_options = PublicKey(raw='no-pty,from="10.0.0.1" {0}'.format(PUBLIC_KEYS[0]['raw']))
+    assert with_options.parsed == ('ssh-rsa', PUBLIC_KEYS[0]['raw'].split()[1], None)
+    assert PublicKey(raw='not a key').parsed == (None, None, None)
+
+
+def test_public_key_fingerprint():
+    public_key = PublicKey(raw=PUBLIC_KEYS[2]['raw'])
+    # As reported by ssh-keygen -l
+    assert public_key.fingerprint == 'SHA256:0GD6j4I3i9WcCM+w9fT01Mlt6EjAJv5uYHGGJSikfLU'
+    # The fingerprint only covers the key itself, not its comment
+    assert public_key.fingerprint == PublicKey(raw=PUBLIC_KEYS[2]['raw'].rsplit(' ', 1)[0]).fingerprint
+    assert PublicKey(raw='not a key').fingerprint is None
+
+
+def test_public_key_equality_and_hashing():
+    from_raw = PublicKey(raw=PUBLIC_KEYS[0]['raw'])
+    from_encoded = PublicKey(b64encoded=PUBLIC_KEYS[0]['encoded'])
+    assert from_raw == from_encoded
+    assert from_raw != PublicKey(raw=PUBLIC_KEYS[1]['raw'])
+    assert len(set([from_raw, from_encoded])) == 1
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+import pytest
+
+from creds.plan import create_plan
+from creds.sudoers import (Sudoers, SudoersBatch, load_sudoers)
+from creds.utils import get_sudoers_entry
+from creds.users import (Users, User)
+
+SUDOERS = """Defaults env_reset
+root ALL=(ALL:ALL) ALL
+bob ALL=(ALL) NOPASSWD: ALL
+bobby ALL=(ALL) ALL
+"""
+
+
+@pytest.fixture
+def sudoers_path(tmpdir, monkeypatch):
+    sudoers_file = tmpdir.join('sudoers')
+    sudoers_file.write(SUDOERS)
+    monkeypatch.setattr('creds.sudoers.SUDOERS_PATH', sudoers_file.strpath)
+    monkeypatch.setattr('creds.sudoers.sudo_check', lambda: '')
+    monkeypatch.setattr('creds.constants.LINUX_CMD_VISUDO', 'true')
+    return sudoers_file
+
+
+def test_sudoers_batch_render_matches_whole_user_names():
+    batch = SudoersBatch()
+    batch.set_entry(username='bob', sudoers_entry='ALL=(ALL) ALL')
+    batch.remove_entry(username='root')
+    batch.set_entry(username='jane', sudoers_entry='ALL=(ALL) NOPASSWD: ALL')
+    assert batch.render(sudoers_lines=SUDOERS.splitlines(True)) == [
+        'Defaults env_reset\n', 'bobby ALL=(ALL) ALL\n', 'bob ALL=(ALL) ALL\n', 'jane ALL=(ALL) NOPASSWD: ALL\n']
+
+
+def test_sudoers_batch_from_plan(sudoers_path):
+    sudoers_path.write('gone ALL=(ALL) ALL\n')
+    existing_users = Users()
+    existing_users.append(User(name='bob', uid=1001, sudoers_entry='ALL=(ALL) ALL'))
+    existing_users.append(User(name='gone', uid=1002))
+    proposed_users = Users()
+    proposed_users.append(User(name='bob', uid=1001, sudoers_entry='ALL=(ALL) NOPASSWD: ALL'))
+    proposed_users.append(User(name='jane', uid=1003, sudoers_entry='ALL=(ALL) ALL'))
+    proposed_users.append(User(name='fred', uid=1004))
+    plan = create_plan(existing_users=existing_users, proposed_users=proposed_users, purge_undefined=True)
+    batch = SudoersBatch.from_plan(plan=plan)
+    assert dict(batch.changes) == {'bob': 'ALL=(ALL) NOPASSWD: ALL', 'jane': 'ALL=(ALL) ALL', 'gone': None}
+
+
+def test_sudoers_batch_apply(sudoers_path):
+    batch = SudoersBatch()
+    batch.set_entry(username='bob', sudoers_entry='ALL=(ALL) ALL')
+    batch.remove_entry(username='bobby')
+    batch.apply()
+    assert sudoers_path.read() == 'Defaults env_reset\nroot ALL=(ALL:ALL) ALL\nbob ALL=(ALL) ALL\n'
+
+
+def test_sudoers_batch_apply_leaves_file_untouched_if_invalid(sudoers_path, monkeypatch):
+    monkeypatch.setattr('creds.constants.LINUX_CMD_VISUDO', 'false')
+    batch = SudoersBatch()
+    batch.set_entry(username='bob', sudoers_entry='INVALID')
+    with pytest.raises(ValueError):
+        batch.apply()
+    assert sudoers_path.read() == SUDOERS
+
+
+def test_sudoers_batch_apply_to_alternate_root(tmpdir, monkeypatch):
+    monkeypatch.setattr('creds.sudoers.sudo_check', lambda: '')
+    monkeypatch.setattr('creds.constants.LINUX_CMD_VISUDO', 'true')
+    sudoers_file = tmpdir.mkdir('etc').join('sudoers')
+    sudoers_file.write(SUDOERS)
+    batch = SudoersBatch(root_path=tmpdir.strpath)
+    batch.remove_entry(username='bob')
+    batch.apply()
+    assert sudoers_file.read() == 'Defaults env_reset\nroot ALL=(ALL:ALL) ALL\nbobby ALL=(ALL) ALL\n'
+
+
+def test_sudoers_model_follows_includes(tmpdir):
+    tmpdir.join('sudoers').write(SUDOERS + '#include extra\n#includedir sudoers.d\n')
+    tmpdir.join('extra').write('jane ALL=(ALL) ALL\nbob ALL=(ALL) ALL\n')
+    included = tmpdir.mkdir('sudoers.d')
+    included.join('10-fred').write('fred ALL=(ALL) \\\n    NOPASSWD: ALL\n')
+    included.join('ignored~').write('ignored ALL=(ALL) ALL\n')
+    included.join('ignored.rpmsave').write('ignored ALL=(ALL) ALL\n')
+    sudoers = Sudoers.from_file(path=tmpdir.join('sudoers').strpath)
+    assert sudoers.get_entry(username='bob') == 'ALL=(ALL) NOPASSWD: ALL'
+    assert sudoers.get_entry(username='bobby') == 'ALL=(ALL) ALL'
+    assert sudoers.get_entry(username='bo') is None
+    # Entries in included files are kept apart, as only the sudoers file itself is rewritten
+    assert sudoers.get_entry(username='jane') is None
+    assert sudoers.included_entries == {'jane': 'ALL=(ALL) ALL', 'bob': 'ALL=(ALL) ALL',
+                                        'fred': 'ALL=(ALL) NOPASSWD: ALL'}
+
+
+def test_sudoers_entries_in_included_files_are_not_compared(sudoers_path):
+    """ Once a user's entry in the sudoers file is written, they aren't changed again by an entry elsewhere. """
+    sudoers_path.write(SUDOERS + '#includedir sudoers.d\n')
+    sudoers_path.dirpath().mkdir('sudoers.d').join('10-jane').write('jane ALL=(ALL) NOPASSWD: ALL\n')
+    proposed_users = Users()
+    proposed_users.append(User(name='jane', uid=1005, sudoers_entry='ALL=(ALL) ALL'))
+
+    def plan():
+        existing_users = Users()
+        existing_users.append(User(name='jane', uid=1005, sudoers_entry=load_sudoers().get_entry(username='jane')))
+        return create_plan(existing_users=existing_users, proposed_users=proposed_users)
+
+    SudoersBatch.from_plan(plan=plan()).apply()
+    assert sudoers_path.read().endswith('#includedir sudoers.d\njane ALL=(ALL) ALL\n')
+    assert [task['action'] for task in plan()] == []
+
+
+def test_sudoers_absolute_includes_are_read_from_the_root(tmpdir):
+    """ An absolute #includedir in an image's sudoers file names the image's directory, not this system's. """
+    etc = tmpdir.mkdir('etc')
+    etc.join('sudoers').write(SUDOERS + '#includedir /etc/sudoers.d\n#include /etc/extra\n')
+    etc.mkdir('sudoers.d').join('10-fred').write('fred ALL=(ALL) ALL\n')
+    etc.join('extra').write('jane ALL=(ALL) ALL\n')
+    sudoers = load_sudoers(root_path=tmpdir.strpath)
+    assert sudoers.included_entries == {'fred': 'ALL=(ALL) ALL', 'jane': 'ALL=(ALL) ALL'}
+    assert etc.join('sudoers.d').strpath in [source[0] for source in sudoers.sources]
+
+
+def test_load_sudoers_is_cached_until_changed(sudoers_path):
+    sudoers = load_sudoers()
+    assert load_sudoers() is sudoers
+    sudoers_path.write('bob ALL=(ALL) ALL\n')
+    reloaded = load_sudoers()
+    assert reloaded is not sudoers
+    assert reloaded.get_entry(username='bob') == 'ALL=(ALL) ALL'
+    assert reloaded.get_entry(username='root') is None
+
+
+def test_get_sudoers_entry_matches_whole_user_name():
+    entries = ['bobby ALL=(ALL) ALL', 'bob ALL=(ALL) NOPASSWD: ALL']
+    assert get_sudoers_entry(username='bob', sudoers_entries=entries) == 'ALL=(ALL) NOPASSWD: ALL'
+    assert get_sudoers_entry(username='bo', sudoers_entries=entries) is None
@@ -2,13 +2,15 @@
 
 from __future__ import (absolute_import, unicode_literals, print_function)
 
+import json
 import os
 
 import pytest
+import yaml
 
 from creds.ssh import PublicKey
-from creds.users import (Users, User)
-from creds.utils import sudo_check
+from creds.users import (Users, User, generate_add_user_command, generate_delete_user_command)
+from creds.utils import (check_environment, sudo_check)
 from tests.sample_data import PUBLIC_KEYS
 from .sample_data import SAMPLE_DICT
 
@@ -96,6 +98,28 @@ def test_get_users_from_passwd():
     assert isinstance(users, Users)
 
 
+def test_get_users_from_passwd_in_alternate_root(tmpdir):
+    """ The uid range is read from the root's own login.defs. """
+    etc = tmpdir.mkdir('etc')
+    etc.join('login.defs').write('UID_MIN 2000\nUID_MAX 2999\n')
+    etc.join('passwd').write('root:x:0:0:root:/root:/bin/bash\nbob:x:1500:1500::/home/bob:/bin/sh\n'
+                             'jane:x:2500:2500::/home/jane:/bin/sh\n')
+    etc.join('sudoers').write('jane ALL=(ALL) ALL\n')
+    users = Users.from_passwd(root_path=tmpdir.strpath)
+    assert [user.name for user in users] == ['jane']
+    assert users[0].sudoers_entry == 'ALL=(ALL) ALL'
+
+
+def test_generate_commands_for_alternate_root():
+    user = User(name='bob', uid=1001, shell='/bin/sh')
+    add_command = generate_add_user_command(proposed_user=user, root_path='/srv/image')
+    assert add_command[-1] == 'bob'
+    assert add_command[add_command.index('-R') + 1] == '/srv/image'
+    delete_command = generate_delete_user_command(username='bob', root_path='/srv/image')
+    assert delete_command[delete_command.index('-R') + 1] == '/srv/image'
+    assert '-R' not in generate_add_user_command(proposed_user=user)
+
+
 def test_get_users_from_dict():
     """ Test creation of a Users collection based on a predefined dict. """
     users = Users.from_dict(input_dict=SAMPLE_DICT)
@@ -122,6 +146,44 @@ def test_get_users_from_json():
     assert isinstance(users[0].uid, int)
 
 
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 65536])
+def test_iter_users_from_yaml_and_json(monkeypatch, tmpdir, chunk_size):
+    """ Streamed users match those loaded from the whole document, whatever the read size. """
+    monkeypatch.setattr('creds.users.JSON_CHUNK_SIZE', chunk_size)
+    manifest = dict(version=12345, users=[dict(name='user{0}'.format(index), uid=10000 + index, gid=10000 + index,
+                                               gecos='gecos, "quoted" [{0}]'.format(index), shell='/bin/sh',
+                                               public_keys=[PUBLIC_KEYS[index % 3]['encoded']])
+                                          for index in range(20)], ratio=12.5, scale=-1.25e+10, count=-3,
+                    trailer=[1.5, 2e-05, None])
+    yaml_file = tmpdir.join('manifest.yml')
+    yaml_file.write(yaml.safe_dump(manifest, default_flow_style=False))
+    json_file = tmpdir.join('manifest.json')
+    json_file.write(json.dumps(manifest, indent=1))
+    expected = [user.to_dict() for user in Users.from_dict(manifest)]
+    yaml_users = Users.iter_from_yaml(file_path=yaml_file.strpath)
+    json_users = Users.iter_from_json(file_path=json_file.strpath)
+    assert not isinstance(yaml_users, Users) and not isinstance(json_users, Users)
+    assert [user.to_dict() for user in yaml_users] == expected
+    assert [user.to_dict() for user in json_users] == expected
+
+
+def test_iter_users_refuses_trailing_input(tmpdir):
+    """ As with the whole document readers, only a single YAML document or JSON object is accepted. """
+    yaml_file = tmpdir.join('manifest.yml')
+    yaml_file.write('users:\n- name: rod\n---\nusers:\n- name: jane\n')
+    with pytest.raises(yaml.YAMLError):
+        list(Users.iter_from_yaml(file_path=yaml_file.strpath))
+    yaml_file.write('users:\n- name: rod\n...\n')
+    assert [user.name for user in Users.iter_from_yaml(file_path=yaml_file.strpath)] == ['rod']
+    json_file = tmpdir.join('manifest.json')
+    for trailer in (' garbage', '{}', ']'):
+        json_file.write('{"users": [{"name": "rod"}]}' + trailer)
+        with pytest.raises(ValueError):
+            list(Users.iter_from_json(file_path=json_file.strpath))
+    json_file.write('{}\n')
+    assert list(Users.iter_from_json(file_path=json_file.strpath)) == []
+
+
 def test_get_users_from_invalid_yaml():
     """ Test a ValueError is raised if loading a yaml file of users with invalid syntax. """
     with pytest.raises(ValueError):
@@ -168,6 +230,29 @@ def test_users_filters():
     assert not users.describe_users(users_filter=dict(uid=1000))
 
 
+def test_users_indexes_follow_mutations():
+    """ Test the name and uid indexes are kept in step with the collection. """
+    users = Users()
+    users.append(User(name='rod', uid=1001, gid=1001))
+    users.append(User(name='jane', uid=1002, gid=1002))
+    users.insert(0, User(name='freddy', uid=1002, gid=1003))
+    assert users.describe_users(users_filter=dict(name='rod'))[0].name == 'rod'
+    assert sorted(user.name for user in users.describe_users(users_filter=dict(uid=1002))) == ['freddy', 'jane']
+    users[1] = User(name='emu', uid=1004, gid=1004)
+    assert not users.describe_users(users_filter=dict(name='rod'))
+    assert users.describe_users(users_filter=dict(uid=1004))[0].name == 'emu'
+    del users[0]
+    assert not users.describe_users(users_filter=dict(name='freddy'))
+    assert [user.name for user in users.describe_users(users_filter=dict(uid=1002))] == ['jane']
+    users.remove(username='jane')
+    assert not users.describe_users(users_filter=dict(uid=1002))
+    users.append(User(name='nouid'))
+    assert not users.describe_users(users_filter=dict(name='rod'))
+    assert users.describe_users(users_filter=dict(name='nouid'))[0].name == 'nouid'
+    assert set(users.names()) == set(user.name for user in users)
+    assert None not in users.uids()
+
+
 def test_user_instance_creation():
     name = 'Fred'
     uid = 1024
@@ -204,6 +289,33 @@ def test_user_instance_creation_precommented_gecos():
     assert test_user.shell == shell
 
 
+def test_user_instance_has_no_dict():
+    rod = User(name='rod', uid=1001, gid=1001, gecos='\'rod comment\'')
+    assert not hasattr(rod, '__dict__')
+    assert rod.gecos == '\"rod comment\"'
+    with pytest.raises(AttributeError):
+        rod.nickname = 'roddy'
+
+
+def test_user_digest():
+    """ Digests cover the fields compared when planning, ignoring key order, and follow changes. """
+    keys = [PublicKey(raw=PUBLIC_KEYS[0]['raw']), PublicKey(raw=PUBLIC_KEYS[1]['raw'])]
+    user = User(name='rod', passwd='x', uid=1001, gid=1001, gecos='rod', shell='/bin/sh', public_keys=list(keys))
+    same = User(name='freddy', uid=1001, gid=1001, gecos='"rod"', shell='/bin/sh', public_keys=keys[::-1])
+    assert user.digest == same.digest
+    assert len(user.digest) == 64
+    digest = user.digest
+    user.shell = '/bin/bash'
+    assert user.digest != digest
+    user.shell = '/bin/sh'
+    assert user.digest == digest
+    user.public_keys.append(PublicKey(raw=PUBLIC_KEYS[2]['raw']))
+    assert user.digest != digest
+    users = Users()
+    users.append(same)
+    assert users.digests() == dict(freddy=digest)
+
+
 def test_user_instance_with_missing_gecos():
     rod = User(name='rod', uid=1001, gid=1001, home_dir='/home/rod', shell='/bin/sh')
     assert rod.gecos == None
@@ -211,8 +323,12 @@ def test_user_instance_with_missing_gecos():
 
 def test_platform_detection(monkeypatch):
     monkeypatch.setattr("platform.system", lambda: 'Darwin')
-    with pytest.raises(SystemExit):
-        Users()
+    with pytest.raises(OSError):
+        check_environment()
+    with pytest.raises(OSError):
+        Users.from_passwd()
+    # Collections can still be built and compared, e.g. to check manifests
+    assert len(Users.from_dict(SAMPLE_DICT))
 
 
 def test_user_detection(monkeypatch):
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, unicode_literals, print_function)
+
+import io
+import json
+
+import pytest
+from creds.utils import (CommandRunner, TracingRunner, command_caller, current_caller, execute_command,
+                         set_command_runner)
+
+
+@pytest.fixture
+def restore_runner():
+    yield
+    set_command_runner(None)
+
+
+def test_command_caller_is_restored():
+    assert current_caller() is None
+    with command_caller('discovery'):
+        with command_caller('execution'):
+            assert current_caller() == 'execution'
+        assert current_caller() == 'discovery'
+    assert current_caller() is None
+
+
+def test_set_command_runner(restore_runner):
+    class RecordingRunner(CommandRunner):
+        commands = list()
+
+        def run(self, command=None):
+            self.commands.append(command)
+            return (b'', b'stubbed'), 3
+
+    assert isinstance(set_command_runner(RecordingRunner()), CommandRunner)
+    assert execute_command(['false']) == ((b'', b'stubbed'), 3)
+    assert RecordingRunner.commands == [['false']]
+
+
+def test_tracing_runner(tmpdir, restore_runner):
+    """ Each command is written to the trace, and a summary by caller is written on close. """
+    trace_path = tmpdir.join('trace.jsonl')
+    summary_stream = io.StringIO()
+    runner = TracingRunner(trace_path=trace_path.strpath, summary_stream=summary_stream)
+    set_command_runner(runner)
+    with command_caller('discovery'):
+        assert execute_command(['true'])[1] == 0
+    assert execute_command(['false'])[1] == 1
+    runner.close()
+    runner.close()
+    trace = [json.loads(line) for line in trace_path.readlines()]
+    assert [(line['argv'], line['caller'], line['returncode']) for line in trace] == [
+        (['true'], 'discovery', 0), (['false'], 'unknown', 1)]
+    assert all(line['duration'] >= 0 for line in trace)
+    assert sorted(runner.summary()) == ['discovery', 'unknown']
+    summary = summary_stream.getvalue()
+    assert summary.startswith('creds: 2 commands in ')
+    assert summary.count('\n') == 3